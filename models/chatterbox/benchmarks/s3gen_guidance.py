@@ -0,0 +1,83 @@
+"""
+Speed versus accuracy of limiting the classifier-free guidance of the S3Gen flow matching, on CPU.
+
+    python benchmarks/s3gen_guidance.py --checkpoint s3gen.safetensors --ref voice.wav --threads 8
+
+Converts the same speech tokens to mels with guidance at every step (the default), without guidance (`cfg_rate=0`),
+and with guidance only within intervals of the flow times. Guided steps run the estimator on a batch of two, the
+others on one. For each, reports the real-time factor (RTF, compute time over audio duration) of the flow matching
+and the mean absolute difference of the mels to those with full guidance, in log-mel units. The noise of the flow is
+fixed, so differences come from the guidance only. Without `--checkpoint`, weights are random, so only the timings
+are meaningful.
+"""
+import argparse
+import time
+
+import librosa
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.s3gen import S3Gen, S3GEN_SR
+from chatterbox.models.s3gen.flow_matching import SOLVERS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="s3gen.safetensors")
+    parser.add_argument("--ref", default=None, help="reference audio; a synthetic tone by default")
+    parser.add_argument("--solver", default="euler", choices=list(SOLVERS))
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument(
+        "--intervals", type=float, nargs="+", default=[0.0, 0.5, 0.0, 0.3, 0.2, 0.8, 0.5, 1.0],
+        help="pairs of (start, end) flow times of the guided steps",
+    )
+    parser.add_argument("--n-tokens", type=int, default=150, help="25 tokens per second of audio")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if len(args.intervals) % 2:
+        parser.error("--intervals takes pairs of times")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    s3gen = S3Gen()
+    if args.checkpoint:
+        s3gen.load_state_dict(load_safetensors(args.checkpoint), strict=False)
+    s3gen.eval()
+
+    if args.ref:
+        ref_wav, _ = librosa.load(args.ref, sr=S3GEN_SR, duration=10)
+        ref_wav = torch.from_numpy(ref_wav)[None]
+    else:
+        t = torch.arange(5 * S3GEN_SR) / S3GEN_SR
+        ref_wav = 0.3 * torch.sin(2 * torch.pi * 150 * t * (1 + 0.1 * torch.sin(3 * t)))[None]
+    ref_dict = s3gen.embed_ref(ref_wav, S3GEN_SR)
+    speech_tokens = torch.randint(0, 6561, (1, args.n_tokens))
+
+    intervals = list(zip(args.intervals[::2], args.intervals[1::2]))
+    configs = {"full guidance (reference)": dict(), "no guidance": dict(cfg_rate=0)}
+    configs.update({f"guidance in [{lo:.2f}, {hi:.2f}]": dict(guidance_interval=(lo, hi)) for lo, hi in intervals})
+
+    # warmup
+    s3gen.flow_inference(speech_tokens[:, :25], ref_dict=ref_dict, finalize=True, n_timesteps=2)
+
+    reference = None
+    for name, config in configs.items():
+        flow_time = 0
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            mels = s3gen.flow_inference(
+                speech_tokens, ref_dict=ref_dict, finalize=True, n_timesteps=args.steps, solver=args.solver, **config,
+            )
+            flow_time += time.perf_counter() - start
+        duration = args.repeats * mels.size(2) / 50  # 50 mel frames per second
+        if reference is None:
+            reference = mels
+        distance = (mels - reference).abs().mean().item()
+        print(f"{name:>26}: flow RTF {flow_time / duration:.3f}  mel distance {distance:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Speed versus accuracy of the S3Gen flow matching ODE solvers on CPU.
+
+    python benchmarks/s3gen_solvers.py --checkpoint s3gen.safetensors --ref voice.wav --threads 8
+
+Converts the same speech tokens to audio with each solver and number of steps, and the `FLOW_PRESETS`. For each,
+reports the real-time factor (RTF, compute time over audio duration) of the flow matching and of the whole
+token-to-wav, and the mean absolute difference of the mels to those of the 10-step Euler reference, in log-mel units.
+The noise of the flow is fixed, so differences come from the solvers only. Without `--checkpoint`, weights are random,
+so only the timings are meaningful.
+"""
+import argparse
+import time
+
+import librosa
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.s3gen import S3Gen, S3GEN_SR, FLOW_PRESETS
+from chatterbox.models.s3gen.flow_matching import SOLVERS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="s3gen.safetensors")
+    parser.add_argument("--ref", default=None, help="reference audio; a synthetic tone by default")
+    parser.add_argument("--solvers", nargs="+", default=list(SOLVERS))
+    parser.add_argument("--steps", type=int, nargs="+", default=[2, 4, 6, 10])
+    parser.add_argument("--n-tokens", type=int, default=150, help="25 tokens per second of audio")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    s3gen = S3Gen()
+    if args.checkpoint:
+        s3gen.load_state_dict(load_safetensors(args.checkpoint), strict=False)
+    s3gen.eval()
+
+    if args.ref:
+        ref_wav, _ = librosa.load(args.ref, sr=S3GEN_SR, duration=10)
+        ref_wav = torch.from_numpy(ref_wav)[None]
+    else:
+        t = torch.arange(5 * S3GEN_SR) / S3GEN_SR
+        ref_wav = 0.3 * torch.sin(2 * torch.pi * 150 * t * (1 + 0.1 * torch.sin(3 * t)))[None]
+    ref_dict = s3gen.embed_ref(ref_wav, S3GEN_SR)
+    speech_tokens = torch.randint(0, 6561, (1, args.n_tokens))
+
+    configs = {f"{solver} x{n}": dict(solver=solver, n_timesteps=n) for solver in args.solvers for n in args.steps}
+    configs.update({f"preset {name}": preset for name, preset in FLOW_PRESETS.items()})
+    configs = {"euler x10 (reference)": dict(solver="euler", n_timesteps=10), **configs}
+
+    # warmup
+    s3gen.inference(speech_tokens[:, :25], ref_dict=ref_dict, n_timesteps=2)
+
+    reference = None
+    for name, config in configs.items():
+        flow_time = total_time = 0
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            mels = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True, **config)
+            flow_time += time.perf_counter() - start
+            wav, _ = s3gen.hift_inference(mels)
+            total_time += time.perf_counter() - start
+        duration = args.repeats * wav.size(1) / S3GEN_SR
+        if reference is None:
+            reference = mels
+        distance = (mels - reference).abs().mean().item()
+        print(
+            f"{name:>22}: flow RTF {flow_time / duration:.3f}  total RTF {total_time / duration:.3f}"
+            f"  mel distance {distance:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Time to first audio of streaming S3Gen token-to-wav on CPU, against converting the whole utterance at once.
+
+    python benchmarks/s3gen_streaming.py --checkpoint s3gen.safetensors --ref voice.wav --threads 8
+
+Converts the same speech tokens (a 20 s line by default) with `S3Token2Wav.inference`, then with `S3Token2Wav.stream`,
+the tokens being available from the start. Reports the compute time of both, the time to the first audio of the
+stream, and the stalls of a playback starting with the first audio: the time it would wait for pieces which aren't
+ready when the previous one ends. Without `--checkpoint`, weights are random, which doesn't change the timings.
+"""
+import argparse
+import time
+
+import librosa
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.s3gen import S3Gen, S3GEN_SR, FLOW_PRESETS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="s3gen.safetensors")
+    parser.add_argument("--ref", default=None, help="reference audio; a synthetic tone by default")
+    parser.add_argument("--preset", default="standard", choices=list(FLOW_PRESETS))
+    parser.add_argument("--n-tokens", type=int, default=500, help="25 tokens per second of audio")
+    parser.add_argument("--chunk-tokens", type=int, default=25)
+    parser.add_argument("--chunk-growth", type=float, default=2.0)
+    parser.add_argument("--max-chunk-tokens", type=int, default=200)
+    parser.add_argument("--overlap-tokens", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    s3gen = S3Gen()
+    if args.checkpoint:
+        s3gen.load_state_dict(load_safetensors(args.checkpoint), strict=False)
+    s3gen.eval()
+
+    if args.ref:
+        ref_wav, _ = librosa.load(args.ref, sr=S3GEN_SR, duration=10)
+        ref_wav = torch.from_numpy(ref_wav)[None]
+    else:
+        t = torch.arange(5 * S3GEN_SR) / S3GEN_SR
+        ref_wav = 0.3 * torch.sin(2 * torch.pi * 150 * t * (1 + 0.1 * torch.sin(3 * t)))[None]
+    ref_dict = s3gen.embed_ref(ref_wav, S3GEN_SR)
+    speech_tokens = torch.randint(0, 6561, (args.n_tokens,))
+    flow_params = FLOW_PRESETS[args.preset]
+    stream_params = dict(
+        chunk_tokens=args.chunk_tokens,
+        chunk_growth=args.chunk_growth,
+        max_chunk_tokens=args.max_chunk_tokens,
+        overlap_tokens=args.overlap_tokens,
+    )
+
+    # warmup
+    s3gen.inference(speech_tokens[:25], ref_dict=dict(ref_dict), n_timesteps=2)
+
+    start = time.perf_counter()
+    wav, _ = s3gen.inference(speech_tokens, ref_dict=dict(ref_dict), **flow_params)
+    full_time = time.perf_counter() - start
+    duration = wav.size(1) / S3GEN_SR
+
+    start = time.perf_counter()
+    ready, lengths = [], []
+    for piece in s3gen.stream(speech_tokens, ref_dict, **flow_params, **stream_params):
+        ready.append(time.perf_counter() - start)
+        lengths.append(piece.size(1) / S3GEN_SR)
+    stream_time = time.perf_counter() - start
+
+    # playback starts with the first piece, and waits for the next one when it runs out of audio
+    playback, stalls = ready[0], 0.0
+    for ready_at, length in zip(ready, lengths):
+        stalls += max(0.0, ready_at - playback)
+        playback = max(playback, ready_at) + length
+
+    print(f"{duration:.1f}s of audio, preset {args.preset}")
+    print(f"  inference: {full_time:.2f}s (RTF {full_time / duration:.3f})")
+    print(
+        f"  stream: first audio after {ready[0]:.2f}s ({ready[0] / full_time:.0%} of inference), "
+        f"{len(ready)} pieces in {stream_time:.2f}s (RTF {stream_time / duration:.3f}), playback stalls {stalls:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
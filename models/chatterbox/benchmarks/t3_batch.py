@@ -0,0 +1,69 @@
+"""
+Throughput of batched T3 inference against sequential `T3.inference` calls, using randomly initialized weights.
+
+    python benchmarks/t3_batch.py --n-texts 8 --max-new-tokens 200 --threads 16
+
+Texts of random lengths are generated with CFG, either one at a time or all together with `T3.inference_batch`.
+Speech lengths are random too (EOS is sampled from an untrained model), so throughput is reported in generated tokens
+per second.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+
+def random_texts(t3: T3, n_texts: int, min_len: int, max_len: int):
+    lens = torch.randint(min_len, max_len + 1, (n_texts,))
+    text_tokens = torch.zeros(n_texts, int(lens.max()) + 2, dtype=torch.long)
+    for n, length in enumerate(lens.tolist()):
+        tokens = torch.randint(3, t3.hp.text_tokens_dict_size, (length,))
+        tokens = F.pad(tokens, (1, 0), value=t3.hp.start_text_token)
+        text_tokens[n, :length + 2] = F.pad(tokens, (0, 1), value=t3.hp.stop_text_token)
+    return text_tokens, lens + 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-texts", type=int, default=8)
+    parser.add_argument("--min-text-len", type=int, default=20)
+    parser.add_argument("--max-text-len", type=int, default=80)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual()).eval()
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, t3.hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, t3.hp.start_speech_token, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    text_tokens, text_token_lens = random_texts(t3, args.n_texts, args.min_text_len, args.max_text_len)
+    kwargs = dict(max_new_tokens=args.max_new_tokens, cfg_weight=0.5)
+
+    start = time.perf_counter()
+    n_tokens = 0
+    for tokens, n_text in zip(text_tokens, text_token_lens.tolist()):
+        out = t3.inference(t3_cond=t3_cond, text_tokens=tokens[:n_text].expand(2, -1), **kwargs)
+        n_tokens += out.size(1)
+    elapsed = time.perf_counter() - start
+    print(f"sequential: {n_tokens:5d} tokens in {elapsed:6.1f}s, {n_tokens / elapsed:7.1f} tokens/s")
+
+    start = time.perf_counter()
+    outs = t3.inference_batch(t3_conds=t3_cond, text_tokens=text_tokens, text_token_lens=text_token_lens, **kwargs)
+    n_tokens = sum(out.size(1) for out in outs)
+    elapsed = time.perf_counter() - start
+    print(f"   batched: {n_tokens:5d} tokens in {elapsed:6.1f}s, {n_tokens / elapsed:7.1f} tokens/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Accuracy versus speed of the T3 CFG policies on CPU.
+
+    python benchmarks/t3_cfg.py --checkpoint t3_mtl23ls_v2.safetensors --threads 8
+
+Generates the same texts with full CFG, without CFG, and with guidance truncated after a number of tokens or once the
+alignment is stable (see `T3CFGPolicy`). For each policy, reports the throughput in generated tokens per second and,
+as a proxy for accuracy, how closely the tokens follow the full CFG ones at a low temperature: the share of matching
+tokens and the mean relative length difference. Without `--checkpoint`, weights are random and the alignment policy
+never triggers.
+"""
+import argparse
+import time
+
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.inference.cfg_policy import T3CFGPolicy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="t3_mtl23ls_v2.safetensors")
+    parser.add_argument("--guided-tokens", type=int, nargs="+", default=[25, 50, 100])
+    parser.add_argument("--stable-steps", type=int, nargs="+", default=[10])
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--temperature", type=float, default=0.1)
+    parser.add_argument("--n-texts", type=int, default=4)
+    parser.add_argument("--text-len", type=int, default=60)
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual())
+    if args.checkpoint:
+        t3_state = load_safetensors(args.checkpoint)
+        if "model" in t3_state.keys():
+            t3_state = t3_state["model"][0]
+        t3.load_state_dict(t3_state)
+    t3.eval()
+
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, t3.hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, t3.hp.start_speech_token, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    texts = []
+    for _ in range(args.n_texts):
+        text = torch.randint(3, t3.hp.text_tokens_dict_size, (args.text_len,))
+        texts.append(torch.cat([torch.tensor([t3.hp.start_text_token]), text, torch.tensor([t3.hp.stop_text_token])]))
+
+    policies = {"full CFG": (args.cfg_weight, None), "no CFG": (0.0, None)}
+    for n in args.guided_tokens:
+        policies[f"first {n} tokens"] = (args.cfg_weight, T3CFGPolicy(max_guided_tokens=n))
+    for n in args.stable_steps:
+        policies[f"until {n} stable"] = (args.cfg_weight, T3CFGPolicy(stable_alignment_steps=n))
+
+    # warmup
+    t3.inference(t3_cond=t3_cond, text_tokens=texts[0].expand(2, -1), max_new_tokens=10)
+
+    reference = None
+    baseline = None
+    for name, (cfg_weight, cfg_policy) in policies.items():
+        outs = []
+        start = time.perf_counter()
+        for text in texts:
+            outs.append(t3.inference(
+                t3_cond=t3_cond,
+                text_tokens=text.expand(2, -1),
+                max_new_tokens=args.max_new_tokens,
+                temperature=args.temperature,
+                cfg_weight=cfg_weight,
+                cfg_policy=cfg_policy,
+                generator=torch.Generator().manual_seed(0),
+            )[0])
+        elapsed = time.perf_counter() - start
+        n_tokens = sum(len(out) for out in outs)
+        tokens_per_sec = n_tokens / elapsed
+        baseline = baseline or tokens_per_sec
+        reference = reference or outs
+
+        matches = sum((out[:len(ref)] == ref[:len(out)]).sum().item() for out, ref in zip(outs, reference))
+        length_diff = sum(abs(len(out) - len(ref)) / len(ref) for out, ref in zip(outs, reference)) / len(outs)
+        print(
+            f"{name:>18}: {tokens_per_sec:6.1f} tokens/s  speedup x{tokens_per_sec / baseline:.2f}"
+            f"  matching tokens {matches / sum(len(ref) for ref in reference):6.1%}  length diff {length_diff:6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
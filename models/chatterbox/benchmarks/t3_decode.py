@@ -0,0 +1,118 @@
+"""
+Per-token latency of the T3 decode loop on CPU, using randomly initialized weights.
+
+    python benchmarks/t3_decode.py --steps 200 --threads 8
+
+Modes:
+- `full`: every forward requests `output_attentions` and `output_hidden_states`, forcing eager attention in all
+  layers and materializing every hidden state (the previous behaviour).
+- `selective`: only the alignment layers (see `LLAMA_ALIGNED_HEADS`) produce attention weights, all other layers stay
+  on SDPA, and only the last hidden state is returned.
+- `static`: as `selective`, writing into a preallocated `StaticCache` instead of HF's growing dynamic cache.
+
+Use a large `--steps` (eg 1000, a long audiobook line) to compare how the per-token cost grows with length.
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.inference.t3_hf_backend import T3HuggingfaceBackend
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+
+
+MODES = {
+    "full": dict(output_attentions=True, output_hidden_states=True),
+    "selective": dict(),
+    "static": dict(),
+}
+
+
+@torch.inference_mode()
+def bench_mode(t3: T3, backend: T3HuggingfaceBackend, mode: str, prompt_len: int, text_len: int, steps: int):
+    # CFG runs two rows: conditional and unconditional
+    seq_len = prompt_len + text_len + 1
+    embeds = torch.randn(2, seq_len, t3.dim)
+
+    if mode == "static":
+        past = t3.get_static_cache(2, seq_len + steps, dtype=embeds.dtype)
+        max_cache_len = past.key_cache[0].size(2)
+        min_dtype = torch.finfo(embeds.dtype).min
+        mask = torch.full((seq_len, max_cache_len), min_dtype).triu_(1)[None, None].expand(2, 1, -1, -1)
+        output = backend(inputs_embeds=embeds, past_key_values=past, attention_mask=mask, cache_position=torch.arange(seq_len))
+
+        step_mask = torch.full((2, 1, 1, max_cache_len), min_dtype)
+        step_mask[..., :seq_len] = 0
+
+        def static_kwargs(pos):
+            step_mask[..., pos] = 0
+            return dict(attention_mask=step_mask, cache_position=torch.tensor([pos]))
+    else:
+        output = backend(inputs_embeds=embeds, **{"output_attentions": True, **MODES[mode]})
+
+        def static_kwargs(pos):
+            return {}
+    past = output.past_key_values
+
+    timings = []
+    for i in range(steps):
+        token = torch.randint(0, t3.hp.start_speech_token, (1, 1))
+        embed = t3.speech_emb(token) + t3.speech_pos_emb.get_fixed_embedding(i + 1)
+        embed = torch.cat([embed, embed])
+
+        start = time.perf_counter()
+        output = backend(inputs_embeds=embed, past_key_values=past, **static_kwargs(seq_len + i), **MODES[mode])
+        timings.append(time.perf_counter() - start)
+        past = output.past_key_values
+
+    return torch.tensor(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--prompt-len", type=int, default=34, help="conditioning prefix length")
+    parser.add_argument("--text-len", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual()).eval()
+
+    # the analyzer installs the attention spies on the alignment layers, shared by all modes
+    analyzer = AlignmentStreamAnalyzer(
+        t3.tfmr,
+        None,
+        text_tokens_slice=(args.prompt_len, args.prompt_len + args.text_len),
+        eos_idx=t3.hp.stop_speech_token,
+    )
+    backend = T3HuggingfaceBackend(
+        config=t3.cfg,
+        llama=t3.tfmr,
+        speech_enc=t3.speech_emb,
+        speech_head=t3.speech_head,
+        alignment_stream_analyzer=analyzer,
+    )
+
+    baseline = None
+    for mode in args.modes:
+        timings = bench_mode(t3, backend, mode, args.prompt_len, args.text_len, args.steps)
+        ms = 1000 * timings[5:]  # skip warmup steps
+        mean = ms.mean().item()
+        baseline = baseline or mean
+        tenth = max(len(ms) // 10, 1)
+        print(
+            f"{mode:>10}: {mean:7.2f} ms/token (p50 {ms.median().item():7.2f}, p90 {ms.quantile(0.9).item():7.2f})"
+            f"  first/last 10%: {ms[:tenth].mean().item():7.2f} / {ms[-tenth:].mean().item():7.2f}"
+            f"  speedup x{baseline / mean:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
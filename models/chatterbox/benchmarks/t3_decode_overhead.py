@@ -0,0 +1,86 @@
+"""
+Microbenchmark of the per-token bookkeeping of the T3 decode loop, ie everything except the transformer forward and
+the sampling: recording the sampled token, checking for EOS and building the next input embedding.
+
+    python benchmarks/t3_decode_overhead.py --steps 1000
+
+Compares the previous loop body (`torch.cat` on the token history and the CFG pair, `get_fixed_embedding`, and a
+host sync on every token) against `T3DecodeEngine`, reporting time and tensor allocations per token.
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.inference.decode_engine import T3DecodeEngine
+
+
+def legacy_loop(t3: T3, tokens: torch.Tensor):
+    generated_ids = tokens[:, :1].clone()
+    for i in range(tokens.size(1) - 1):
+        next_token = tokens[:, i + 1:i + 2]
+        generated_ids = torch.cat([generated_ids, next_token], dim=1)
+        if next_token.view(-1) == t3.hp.stop_speech_token:
+            break
+        next_token_embed = t3.speech_emb(next_token)
+        next_token_embed = next_token_embed + t3.speech_pos_emb.get_fixed_embedding(i + 1)
+        next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+
+def engine_loop(engine: T3DecodeEngine, tokens: torch.Tensor):
+    for i in range(tokens.size(1) - 1):
+        engine.record_token(i, tokens[:, i + 1:i + 2])
+        if (i + 1) % engine.eos_check_interval == 0 and engine.eos_found.item():
+            break
+        engine.write_step_embeds(i)
+
+
+def measure(fn, steps):
+    fn()  # warmup
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    n_allocs = sum(1 for e in prof.events() if e.name == "[memory]" and e.cpu_memory_usage > 0)
+    return 1e6 * elapsed / steps, n_allocs / steps
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual()).eval()
+
+    # random speech tokens, no EOS
+    tokens = torch.randint(0, t3.hp.start_speech_token, (1, args.steps + 1))
+    tokens[0, 0] = t3.hp.start_speech_token
+
+    # only the buffers are exercised here, the backend is never called
+    backend = SimpleNamespace(alignment_stream_analyzer=None)
+    engine = T3DecodeEngine(
+        t3, backend, batch_size=2, prompt_len=100, max_new_tokens=args.steps, dtype=t3.speech_emb.weight.dtype,
+    )
+
+    for name, fn in [
+        ("legacy", lambda: legacy_loop(t3, tokens)),
+        ("engine", lambda: engine_loop(engine, tokens)),
+    ]:
+        us, allocs = measure(fn, args.steps)
+        print(f"{name:>8}: {us:8.2f} us/token, {allocs:6.2f} tensor allocations/token")
+
+
+if __name__ == "__main__":
+    main()
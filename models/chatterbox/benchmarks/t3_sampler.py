@@ -0,0 +1,80 @@
+"""
+Microbenchmark of the T3 sampling step: from the last hidden states of the CFG pair to the next speech token.
+
+    python benchmarks/t3_sampler.py --steps 500
+
+Compares the previous path (full `speech_head` projection of both rows, CFG on the logits, and the HF repetition
+penalty / min-p / top-p processors over the token history) against `T3Sampler`.
+"""
+import argparse
+import time
+
+import torch
+from transformers.generation.logits_process import TopPLogitsWarper, RepetitionPenaltyLogitsProcessor, MinPLogitsWarper
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.inference.sampler import T3Sampler
+
+
+def hf_loop(t3: T3, hidden, steps, cfg_weight, temperature, top_p, min_p, repetition_penalty):
+    min_p_warper = MinPLogitsWarper(min_p=min_p)
+    top_p_warper = TopPLogitsWarper(top_p=top_p)
+    repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+    ids = torch.full((1, 1), t3.hp.start_speech_token, dtype=torch.long, device=hidden.device)
+    for i in range(steps):
+        logits = t3.speech_head(hidden[i])
+        logits = logits[0:1] + cfg_weight * (logits[0:1] - logits[1:2])
+        logits = repetition_penalty_processor(ids, logits)
+        logits = logits / temperature
+        logits = min_p_warper(ids, logits)
+        logits = top_p_warper(ids, logits)
+        next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+        ids = torch.cat([ids, next_token], dim=1)
+
+
+def fused_loop(t3: T3, hidden, steps, cfg_weight, temperature, top_p, min_p, repetition_penalty, top_k):
+    sampler = T3Sampler(
+        t3.speech_head.weight, t3.hp, temperature=temperature, top_p=top_p, min_p=min_p,
+        repetition_penalty=repetition_penalty, top_k=top_k, generator=torch.Generator(hidden.device).manual_seed(0),
+    )
+    for i in range(steps):
+        sampler.sample(sampler.logits(hidden[i], cfg_weight))
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--min-p", type=float, default=0.05)
+    parser.add_argument("--top-k", type=int, default=256)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual()).to(args.device).eval()
+    hidden = torch.randn(args.steps, 2, t3.dim, device=args.device)
+    kwargs = dict(cfg_weight=0.5, temperature=0.8, top_p=args.top_p, min_p=args.min_p, repetition_penalty=2.0)
+
+    for name, fn in [
+        ("hf", lambda: hf_loop(t3, hidden, args.steps, **kwargs)),
+        ("fused", lambda: fused_loop(t3, hidden, args.steps, top_k=args.top_k, **kwargs)),
+    ]:
+        fn()  # warmup
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>6}: {1e6 * elapsed / args.steps:8.2f} us/token")
+
+
+if __name__ == "__main__":
+    main()
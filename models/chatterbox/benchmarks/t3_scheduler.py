@@ -0,0 +1,61 @@
+"""
+Throughput of the continuous batching `T3Scheduler`, using randomly initialized weights.
+
+    python benchmarks/t3_scheduler.py --n-requests 16 --max-rows 8 --threads 16
+
+Requests with random text lengths and random `max_new_tokens` (to mimic lines of very different durations) are
+submitted at once; the scheduler metrics are printed while they run. Use a small `--kv-tokens` to see preemption.
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.inference.scheduler import T3Scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-requests", type=int, default=16)
+    parser.add_argument("--max-rows", type=int, default=8)
+    parser.add_argument("--min-new-tokens", type=int, default=50)
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    parser.add_argument("--kv-tokens", type=int, default=8192)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual()).eval()
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, t3.hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, t3.hp.start_speech_token, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    scheduler = T3Scheduler(t3, max_rows=args.max_rows, kv_tokens=args.kv_tokens)
+
+    start = time.perf_counter()
+    requests = []
+    for _ in range(args.n_requests):
+        text = torch.randint(3, t3.hp.text_tokens_dict_size, (int(torch.randint(20, 80, ())),))
+        text = torch.cat([torch.tensor([t3.hp.start_text_token]), text, torch.tensor([t3.hp.stop_text_token])])
+        max_new_tokens = int(torch.randint(args.min_new_tokens, args.max_new_tokens + 1, ()))
+        requests.append(scheduler.submit(t3_cond, text, max_new_tokens=max_new_tokens, cfg_weight=0.5))
+
+    while not all(req.future.done() for req in requests):
+        time.sleep(1.0)
+        print(scheduler.metrics())
+
+    n_tokens = sum(req.result().size(1) for req in requests)
+    elapsed = time.perf_counter() - start
+    print(f"{n_tokens} tokens in {elapsed:.1f}s, {n_tokens / elapsed:.1f} tokens/s")
+    scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Acceptance rate and speedup of self-speculative T3 decoding on CPU.
+
+    python benchmarks/t3_speculative.py --checkpoint t3_mtl23ls_v2.safetensors --draft-layers 8 12 16 --threads 8
+
+Generates the same texts with `T3.inference`, normally and with `draft_layers` set, and reports the draft acceptance
+rate and the throughput in generated tokens per second. Without `--checkpoint`, weights are random, which says
+nothing about the acceptance rate of the trained model: the draft and full model then barely agree.
+"""
+import argparse
+import time
+
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="t3_mtl23ls_v2.safetensors")
+    parser.add_argument("--draft-layers", type=int, nargs="+", default=[8, 12, 16])
+    parser.add_argument("--n-draft-tokens", type=int, default=4)
+    parser.add_argument("--n-texts", type=int, default=4)
+    parser.add_argument("--text-len", type=int, default=60)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    t3 = T3(T3Config.multilingual())
+    if args.checkpoint:
+        t3_state = load_safetensors(args.checkpoint)
+        if "model" in t3_state.keys():
+            t3_state = t3_state["model"][0]
+        t3.load_state_dict(t3_state)
+    t3.eval()
+
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, t3.hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, t3.hp.start_speech_token, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    texts = []
+    for _ in range(args.n_texts):
+        text = torch.randint(3, t3.hp.text_tokens_dict_size, (args.text_len,))
+        texts.append(torch.cat([torch.tensor([t3.hp.start_text_token]), text, torch.tensor([t3.hp.stop_text_token])]))
+
+    baseline = None
+    for draft_layers in [0] + args.draft_layers:
+        n_tokens = drafted = accepted = 0
+        start = time.perf_counter()
+        for text in texts:
+            out = t3.inference(
+                t3_cond=t3_cond,
+                text_tokens=text.expand(2, -1),
+                max_new_tokens=args.max_new_tokens,
+                draft_layers=draft_layers,
+                n_draft_tokens=args.n_draft_tokens,
+                generator=torch.Generator().manual_seed(0),
+            )
+            n_tokens += out.size(1)
+            if draft_layers:
+                drafted += t3.decode_engine.n_drafted
+                accepted += t3.decode_engine.n_accepted
+        elapsed = time.perf_counter() - start
+        tokens_per_sec = n_tokens / elapsed
+        baseline = baseline or tokens_per_sec
+
+        name = f"draft {draft_layers} layers" if draft_layers else "baseline"
+        acceptance = f"acceptance {accepted / drafted:6.1%}" if drafted else " " * 17
+        print(
+            f"{name:>16}: {n_tokens:5d} tokens, {tokens_per_sec:6.1f} tokens/s  {acceptance}"
+            f"  speedup x{tokens_per_sec / baseline:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Throughput of the voice encoder on CPU, in embedded clips per minute.
+
+    python benchmarks/voice_encoder.py --checkpoint ve.safetensors --threads 8
+
+Embeds synthetic clips of random lengths with `VoiceEncoder.embeds_from_wavs`, with the default trimming and partial
+rate, and reports the time spent in the front-end (trimming and mels) and in the LSTM over the partials. Without
+`--checkpoint`, weights are random, which doesn't change the timings.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from safetensors.torch import load_file as load_safetensors
+
+from chatterbox.models.voice_encoder import VoiceEncoder
+from chatterbox.models.voice_encoder.voice_encoder import pack
+from chatterbox.models.voice_encoder.melspec import melspectrogram_torch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="ve.safetensors")
+    parser.add_argument("--n-clips", type=int, default=256)
+    parser.add_argument("--min-seconds", type=float, default=1.0)
+    parser.add_argument("--max-seconds", type=float, default=10.0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    ve = VoiceEncoder()
+    if args.checkpoint:
+        ve.load_state_dict(load_safetensors(args.checkpoint))
+    ve.eval()
+
+    sr = ve.hp.sample_rate
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(int(args.min_seconds * sr), int(args.max_seconds * sr), args.n_clips)
+    wavs = [(0.1 * rng.standard_normal(n)).astype(np.float32) for n in lengths]
+
+    # warmup
+    ve.embeds_from_wavs(wavs[:4], sr, batch_size=args.batch_size)
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        mels = [melspectrogram_torch(torch.from_numpy(wav), ve.hp).T for wav in wavs]
+    frontend = time.perf_counter() - start
+    start = time.perf_counter()
+    ve.embeds_from_mels(pack(mels), [len(mel) for mel in mels], batch_size=args.batch_size, rate=1.3)
+    encoder = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ve.embeds_from_wavs(wavs, sr, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.n_clips} clips of {lengths.mean() / sr:.1f}s on average")
+    print(f"  front-end {frontend:.2f}s  encoder {encoder:.2f}s")
+    print(f"  embeds_from_wavs {elapsed:.2f}s: {args.n_clips / elapsed * 60:.0f} clips/min")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Sequence
+
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from .s3gen.const import S3GEN_SR
+from .s3gen.s3gen import get_resampler
+from .s3gen.utils.mel import mel_spectrogram
+from .s3tokenizer import S3_SR, S3_HOP
+from .voice_encoder.melspec import melspectrogram_torch
+
+
+# Seconds decoded past the decoder reference, so that the end of the partial decode, where the resamplers see no
+# following samples, stays out of the features
+LOAD_MARGIN = 0.5
+
+@dataclass
+class ReferenceFeatures:
+    """
+    Features of a reference clip that the voice conditionals are computed from (see `ReferenceFrontend`).
+    """
+    prompt_feat: Tensor  # (1, T, 80) S3Gen mel of the decoder reference, at 24 kHz
+    ref_wav_16: Tensor  # (1, L) decoder reference at 16 kHz, for the CAMPPlus x-vector (which computes its fbank)
+    ref_log_mel: Tensor  # (128, T) S3 tokenizer log-mel of the decoder reference
+    prompt_log_mel: Tensor  # (128, T) S3 tokenizer log-mel of the T3 speech prompt
+    ve_mel: Tensor  # (T, 40) voice encoder mel of the loaded reference, silences trimmed
+
+
+class ReferenceFrontend:
+    """
+    Audio front-end of the voice conditionals. Each reference is decoded once (at 24 kHz) and resampled once to 16 kHz
+    on the model device; every feature is then computed from these two signals with torch ops on the device:
+        * the S3Gen mel, over the first `dec_cond_len` samples at 24 kHz
+        * the S3 tokenizer log-mels of the decoder reference and of the T3 speech prompt, which are prefixes of the
+          same 16 kHz signal: they share one STFT, and only the frames past the end of the shorter one, whose
+          reflection padding differs, are computed again
+        * the voice encoder mel of the loaded reference. It has the same STFT parameters as the S3 tokenizer, but is
+          computed over the trimmed signal, so it can't share its frames.
+
+    NOTE: only the first `load_duration` seconds of a file are decoded (see `load`), so the voice encoder no longer
+    sees the whole of a long reference.
+
+    NOTE: previously the 16 kHz signals came from two resamplers: librosa for the T3 prompt and the voice encoder, and
+    torchaudio (of the 10 s crop) for S3Gen. Both now come from the latter, so features differ slightly from before,
+    within resampling precision.
+    """
+
+    def __init__(self, s3_tokenizer, ve_hp, device, enc_cond_len: int, dec_cond_len: int):
+        self.s3_tokenizer = s3_tokenizer
+        self.ve_hp = ve_hp
+        self.device = device
+        self.enc_cond_len = enc_cond_len  # in 16 kHz samples
+        self.dec_cond_len = dec_cond_len  # in 24 kHz samples
+
+    @property
+    def load_duration(self) -> float:
+        "Seconds of each file that `load` decodes: the decoder reference, and a margin for the resamplers."
+        return self.dec_cond_len / S3GEN_SR + LOAD_MARGIN
+
+    def load(self, wav_fpaths: Sequence, num_workers=8) -> List[np.ndarray]:
+        """
+        Decodes the first `load_duration` seconds of the files at 24 kHz, in a thread pool. Only these frames are read
+        and resampled (`soundfile` seeks in the file), so loading doesn't depend on the length of the upload.
+        """
+        def load(wav_fpath):
+            return librosa.load(wav_fpath, sr=S3GEN_SR, duration=self.load_duration)[0]
+
+        if len(wav_fpaths) == 1:
+            return [load(wav_fpaths[0])]
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            return list(pool.map(load, wav_fpaths))
+
+    @torch.inference_mode()
+    def __call__(self, wavs: Sequence[np.ndarray]) -> List[ReferenceFeatures]:
+        """
+        Features of 24 kHz references. References with the same length up to the end of the longest crop, eg all the
+        references longer than `dec_cond_len`, have their STFTs computed in one batch.
+        """
+        wavs_24 = [torch.from_numpy(wav).float().to(self.device)[None] for wav in wavs]  # (1, L)
+        wavs_16 = [get_resampler(S3GEN_SR, S3_SR, self.device)(wav_24) for wav_24 in wavs_24]
+
+        # the decoder reference at 16 kHz, as if the 24 kHz crop was resampled
+        ref_lens_16 = [int(np.ceil(min(w.size(1), self.dec_cond_len) * S3_SR / S3GEN_SR)) for w in wavs_24]
+        groups = {}
+        for i, (wav_24, wav_16) in enumerate(zip(wavs_24, wavs_16)):
+            len_16 = min(wav_16.size(1), max(ref_lens_16[i], self.enc_cond_len))
+            groups.setdefault((min(wav_24.size(1), self.dec_cond_len), len_16), []).append(i)
+
+        features = [None] * len(wavs)
+        window = self.s3_tokenizer.window.to(self.device)
+        for (ref_len_24, len_16), idxs in groups.items():
+            ref_wav_24 = torch.cat([wavs_24[i][:, :ref_len_24] for i in idxs])  # (B, L)
+            prompt_feats = mel_spectrogram(ref_wav_24).transpose(1, 2)
+            ref_len_16 = ref_lens_16[idxs[0]]
+            ref_power, prompt_power = prefix_power_spectrograms(
+                torch.cat([wavs_16[i][:, :len_16] for i in idxs]), [ref_len_16, self.enc_cond_len],
+                self.s3_tokenizer.n_fft, S3_HOP, window,
+            )
+            ref_log_mels = self.log_mel(ref_power)
+            prompt_log_mels = self.log_mel(prompt_power)
+
+            for j, i in enumerate(idxs):
+                wav_16 = wavs_16[i][0]
+                features[i] = ReferenceFeatures(
+                    prompt_feat=prompt_feats[j:j + 1],
+                    ref_wav_16=wavs_16[i][:, :ref_len_16],
+                    ref_log_mel=ref_log_mels[j],
+                    prompt_log_mel=prompt_log_mels[j],
+                    ve_mel=self.ve_mel(wav_16),
+                )
+        return features
+
+    @torch.inference_mode()
+    def ve_mels(self, wavs: Sequence[np.ndarray]) -> List[Tensor]:
+        "Only the voice encoder mels of 24 kHz references, eg to compare voices (see `ReferenceFeatures.ve_mel`)."
+        resampler = get_resampler(S3GEN_SR, S3_SR, self.device)
+        return [self.ve_mel(resampler(torch.from_numpy(wav).float().to(self.device)[None])[0]) for wav in wavs]
+
+    def ve_mel(self, wav_16: Tensor) -> Tensor:
+        return melspectrogram_torch(trim_silence(wav_16, top_db=20), self.ve_hp).T
+
+    def log_mel(self, power: Tensor) -> Tensor:
+        "`S3Tokenizer.log_mel_spectrogram` from (B, F, T) power spectrograms."
+        mel_spec = self.s3_tokenizer._mel_filters.to(self.device) @ power[..., :-1]
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(1, 2), keepdim=True) - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+
+def prefix_power_spectrograms(
+    wav: Tensor, lengths: Sequence[int], n_fft: int, hop: int, window: Tensor,
+) -> List[Tensor]:
+    """
+    (B, F, T) power spectrograms of prefixes of the (B, L) `wav`, as `torch.stft` with `center=True` and reflection
+    padding computes them for each prefix. Frames that only cover samples of a prefix are the same for every longer
+    prefix, so a single STFT of the longest prefix is computed, and only the last frames of the other ones.
+    """
+    lengths = [min(length, wav.size(-1)) for length in lengths]
+    longest = max(lengths)
+    full = torch.stft(wav[:, :longest], n_fft, hop, window=window, pad_mode="reflect", return_complex=True)
+    full = full.abs() ** 2
+
+    powers = []
+    for length in lengths:
+        if length == longest:
+            powers.append(full)
+            continue
+        # frames k with k * hop + n_fft // 2 <= length don't reach the padding at the end
+        n_shared = max(0, (length - n_fft // 2) // hop + 1)
+        padded = F.pad(wav[:, :length], (n_fft // 2, n_fft // 2), mode="reflect")
+        tail = torch.stft(
+            padded[:, n_shared * hop:], n_fft, hop, window=window, center=False, return_complex=True,
+        ).abs() ** 2
+        powers.append(torch.cat([full[..., :n_shared], tail], dim=-1))
+    return powers
+
+
+def trim_silence(wav: Tensor, top_db=20, frame_length=2048, hop_length=512) -> Tensor:
+    "`librosa.effects.trim` with torch ops: drops the leading and trailing frames `top_db` below the loudest one."
+    padded = F.pad(wav[None], (frame_length // 2, frame_length // 2))[0]
+    rms = padded.unfold(0, frame_length, hop_length).pow(2).mean(dim=1).sqrt()
+
+    # `librosa.amplitude_to_db`, relative to the loudest frame
+    amin = 1e-5
+    db = 10 * torch.log10(torch.clamp(rms ** 2, min=amin ** 2))
+    db = db - 10 * torch.log10(torch.clamp(rms.max() ** 2, min=amin ** 2))
+    nonzero = torch.nonzero(db > -top_db)[:, 0].tolist()
+    if not nonzero:
+        return wav[:0]
+    start = nonzero[0] * hop_length
+    end = min(wav.size(0), (nonzero[-1] + 1) * hop_length)
+    return wav[start:end]
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from torch import Tensor
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(eq=False)
+class S3GenRequest:
+    """
+    Speech tokens to convert to audio with `S3GenBatcher`. `future` resolves to the (1, L) waveform, as returned by
+    `S3Token2Wav.inference`.
+    """
+    speech_tokens: Tensor  # (T,), without invalid tokens
+    ref_dict: dict
+    flow_params: dict  # `n_timesteps`, `solver`, `cfg_rate`, `guidance_interval`
+    future: Future = field(default_factory=Future, repr=False)
+
+    @property
+    def batch_key(self):
+        "Requests with the same flow parameters can be batched"
+        return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in self.flow_params.items()))
+
+    def result(self, timeout=None) -> Tensor:
+        return self.future.result(timeout)
+
+
+class S3GenBatcher:
+    """
+    Batches the token-to-wav of concurrent requests with `S3Token2Wav.inference_batch`, eg of audiobook lines whose
+    speech tokens come out of the `T3Scheduler` around the same time. Once a request is queued, the batcher waits up to
+    `max_wait` seconds for others to join, then converts up to `max_batch` of the queued requests which have the same
+    flow parameters at once.
+
+    Requests are converted on a background thread; `submit` is thread-safe.
+
+    NOTE: items of a batch are padded to the longest one, which every item then costs. Batching pays off where a
+    single utterance doesn't saturate the device, ie on GPU; on CPU, it is about as fast as converting one by one.
+    """
+
+    def __init__(self, s3gen: 'S3Token2Wav', *, max_batch: int = 8, max_wait: float = 0.05):
+        self.s3gen = s3gen
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queue: deque = deque()
+        self._lock = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def submit(self, speech_tokens: Tensor, ref_dict: dict, **flow_params) -> S3GenRequest:
+        "Queues a request and returns it."
+        req = S3GenRequest(speech_tokens=speech_tokens.view(-1), ref_dict=ref_dict, flow_params=flow_params)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("batcher is shut down")
+            self.queue.append(req)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="S3GenBatcher", daemon=True)
+                self._thread.start()
+            self._lock.notify()
+        return req
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped and not self.queue:
+                    self._lock.wait()
+                if self._stopped:
+                    break
+                # give the requests of concurrent callers time to join
+                deadline = time.perf_counter() + self.max_wait
+                while not self._stopped and len(self.queue) < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                batch = self._take_batch()
+
+            batch = [req for req in batch if req.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                wavs = self.s3gen.inference_batch(
+                    [req.speech_tokens for req in batch], [req.ref_dict for req in batch], **batch[0].flow_params,
+                )
+            except Exception as e:
+                logger.exception("S3Gen batch failed")
+                for req in batch:
+                    req.future.set_exception(e)
+                continue
+            for req, wav in zip(batch, wavs):
+                req.future.set_result(wav)
+
+        with self._lock:
+            pending, self.queue = list(self.queue), deque()
+        for req in pending:
+            if not req.future.done():
+                req.future.set_exception(CancelledError())
+
+    def _take_batch(self) -> List[S3GenRequest]:
+        "Dequeues up to `max_batch` requests which can be batched with the first one. Called with the lock held."
+        key = self.queue[0].batch_key
+        batch, rest = [], deque()
+        for req in self.queue:
+            if len(batch) < self.max_batch and req.batch_key == key:
+                batch.append(req)
+            else:
+                rest.append(req)
+        self.queue = rest
+        return batch
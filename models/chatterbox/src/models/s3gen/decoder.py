@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -22,6 +25,22 @@ from .matcha.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample
 from .matcha.transformer import BasicTransformerBlock
 
 
+@dataclass
+class DecoderContext:
+    "Step-invariant inputs of `ConditionalDecoder.forward`, see `ConditionalDecoder.prepare`."
+    static: torch.Tensor  # (b, c, t) `mu`, `spks` and `cond` channels
+    masks: List[torch.Tensor]  # (b, 1, t) mask of each resolution, from the finest
+    attn_biases: List[torch.Tensor]  # attention bias of each resolution
+
+    def head(self, n: int) -> "DecoderContext":
+        "The context of the first `n` items of the batch, eg the conditional pass of a CFG batch."
+        return DecoderContext(
+            static=self.static[:n],
+            masks=[mask[:n] for mask in self.masks],
+            attn_biases=[bias[:n] for bias in self.attn_biases],
+        )
+
+
 def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     assert mask.dtype == torch.bool
     assert dtype in [torch.float32, torch.bfloat16, torch.float16]
@@ -230,7 +249,32 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def prepare(self, mask, mu, spks=None, cond=None) -> DecoderContext:
+        """
+        The inputs of `forward` that don't depend on `x` and `t`, ie which are the same for all the ODE steps of an
+        utterance: the concatenated `mu`, `spks` and `cond` channels, and the masks and attention biases of every
+        resolution of the UNet.
+        """
+        static = [mu]
+        if spks is not None:
+            static.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
+        if cond is not None:
+            static.append(cond)
+
+        # the down blocks halve the resolution, except the last one; the mid and up blocks reuse these resolutions
+        masks = [mask]
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        attn_biases = []
+        for mask_res in masks:
+            # `add_optional_chunk_mask` only reads the length and device of its input, ie of x as (b, t, c)
+            attn_mask = add_optional_chunk_mask(
+                mask_res.transpose(1, 2), mask_res.bool(), False, False, 0, self.static_chunk_size, -1,
+            )
+            attn_biases.append(mask_to_bias(attn_mask == 1, mu.dtype))
+        return DecoderContext(static=pack(static, "b * t")[0], masks=masks, attn_biases=attn_biases)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, context: DecoderContext = None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +283,8 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (DecoderContext, optional): `prepare(mask, mu, spks, cond)`, computed once for all the steps of
+                an ODE solve. Computed here by default.
 
         Raises:
             ValueError: _description_
@@ -247,27 +293,20 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        if context is None:
+            context = self.prepare(mask, mu, spks, cond)
 
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        x = pack([x, context.static], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for (resnet, transformer_blocks, downsample), mask_down, attn_mask in zip(
+            self.down_blocks, context.masks, context.attn_biases,
+        ):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -277,16 +316,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+        mask_mid, attn_mask = context.masks[-1], context.attn_biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -295,15 +329,13 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_mask in zip(
+            self.up_blocks, reversed(context.masks), reversed(context.attn_biases),
+        ):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -132,7 +132,11 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_rate=None,
+                  guidance_interval=None):
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
@@ -171,9 +175,12 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            flow_cache=flow_cache
+            flow_cache=flow_cache,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            guidance_interval=guidance_interval,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -241,50 +248,136 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         # FIXME: this was missing - just putting it in as false
         self.fp16 = False
 
-    @torch.inference_mode()
-    def inference(self,
-                  token,
-                  token_len,
-                  prompt_token,
-                  prompt_token_len,
-                  prompt_feat,
-                  prompt_feat_len,
-                  embedding,
-                  finalize):
+    def encode(self, token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding, finalize):
+        """
+        Encodes the tokens after their prompt, see `inference`. Returns the (B, M, 80) `mu` of the flow matching, the
+        (B, 80, M) conditions, the projected speaker embeddings, the prompt lengths in mel frames and the total
+        lengths (B,).
+        """
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
 
-        assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full((prompt_feat.size(0),), prompt_feat.size(1))
+        if token.size(0) == 1:
+            token = torch.concat([prompt_token[:, :prompt_token_len[0]], token[:, :token_len[0]]], dim=1)
+        else:
+            token = nn.utils.rnn.pad_sequence([
+                torch.concat([p[:p_len], t[:t_len]])
+                for p, p_len, t, t_len in zip(prompt_token, prompt_token_len.tolist(), token, token_len.tolist())
+            ], batch_first=True)
+        token_len = prompt_token_len.to(token_len) + token_len
+        mask = (~make_pad_mask(token_len, token.size(1))).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0, max=self.input_embedding.num_embeddings-1)) * mask
 
         # text encode
-        h, h_lengths = self.encoder(token, token_len)
+        h, h_masks = self.encoder(token, token_len)
+        mel_len = h_masks.sum(dim=(1, 2))
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            mel_len = mel_len - self.pre_lookahead_len * self.token_mel_ratio
+            h = h[:, :mel_len.max()]
+        mel_len1 = prompt_feat_len.to(mel_len)
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([h.size(0), h.size(1), self.output_size], device=token.device).to(h.dtype)
+        for i, n in enumerate(mel_len1.tolist()):
+            conds[i, :n] = prompt_feat[i, :n]
         conds = conds.transpose(1, 2)
+        return h, conds, embedding, mel_len1, mel_len
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+    @torch.inference_mode()
+    def inference(self,
+                  token,
+                  token_len,
+                  prompt_token,
+                  prompt_token_len,
+                  prompt_feat,
+                  prompt_feat_len,
+                  embedding,
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_rate=None,
+                  guidance_interval=None):
+        """
+        Mels of a batch of token sequences, each following its own prompt. `token` (B, T), `prompt_token` (B, P) and
+        `prompt_feat` (B, F, 80) are padded to `token_len`, `prompt_token_len` and `prompt_feat_len` (B,), which is
+        all of `prompt_feat` if None. Returns the (B, 80, M) mels of the tokens, padded, and their lengths (B,).
+        """
+        h, conds, embedding, mel_len1, mel_len = self.encode(
+            token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding, finalize,
+        )
+        mel_len2 = mel_len - mel_len1
+
+        mask = (~make_pad_mask(mel_len, h.size(1))).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            guidance_interval=guidance_interval,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None  # NOTE jrm: why are they returning None here?
+        # the mels of the tokens, which follow the prompt of each item
+        if feat.size(0) == 1:
+            feat = feat[:, :, mel_len1[0]:mel_len[0]]
+        else:
+            feat = nn.utils.rnn.pad_sequence([
+                f[:, start:end].T for f, start, end in zip(feat, mel_len1.tolist(), mel_len.tolist())
+            ], batch_first=True).transpose(1, 2)
+        assert feat.shape[2] == mel_len2.max()
+        return feat.float(), mel_len2
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        finalize,
+                        mel_start,
+                        flow_cache=None,
+                        n_timesteps=10,
+                        solver=None,
+                        cfg_rate=None,
+                        guidance_interval=None):
+        """
+        Streaming `inference` of a batch of one: the tokens received so far are encoded, and the flow matching only
+        runs over the prompt and the mels from `mel_start` on, the first of which overlap the previous chunk. Their noise
+        and `mu` are taken from its `flow_cache`, so that they come out as they did. Returns the (1, 80, M) mels from
+        `mel_start` on and the flow cache of this chunk, the (1, 80, M, 2) noise and `mu` of these mels.
+        """
+        h, conds, embedding, mel_len1, _ = self.encode(
+            token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding, finalize,
+        )
+        prompt_len = mel_len1.item()
+        h = torch.concat([h[:, :prompt_len], h[:, prompt_len + mel_start:]], dim=1)
+        conds = conds[:, :, :h.size(1)]
+
+        mask = torch.ones(1, 1, h.size(1)).to(h)
+        feat, flow_cache = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            prompt_len=prompt_len,
+            noise_offset=mel_start,
+            flow_cache=flow_cache,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            guidance_interval=guidance_interval,
+        )
+        return feat[:, :, prompt_len:].float(), flow_cache
@@ -18,6 +18,16 @@ from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
 
 
+# ODE solvers of the flow, as names of `ConditionalCFM` methods. The estimator passes per step: 1 for euler and dpm,
+# 2 for heun and midpoint.
+SOLVERS = {
+    "euler": "solve_euler",
+    "heun": "solve_heun",
+    "midpoint": "solve_midpoint",
+    "dpm": "solve_dpm",
+}
+
+
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
@@ -35,7 +45,8 @@ class ConditionalCFM(BASECFM):
         self.lock = threading.Lock()
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2), solver=None,
+                cfg_rate=None, guidance_interval=None):
         """Forward diffusion
 
         Args:
@@ -48,6 +59,10 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, one of `SOLVERS`. Defaults to `cfm_params.solver`.
+            cfg_rate (float, optional): classifier-free guidance rate, 0 to disable guidance. Defaults to
+                `cfm_params.inference_cfg_rate`.
+            guidance_interval (tuple, optional): (start, end) times of the steps which are guided. Defaults to all.
 
         Returns:
             sample: generated mel-spectrogram
@@ -67,9 +82,21 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(
+            solver or self.solver, z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond,
+            cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        ), flow_cache
+
+    def solve(self, solver, x, t_span, mu, mask, spks, cond, **guidance):
+        """
+        Integrates the flow from the noise `x` over `t_span` with one of the `SOLVERS`. `guidance` are the
+        `cfg_rate` and `guidance_interval` of `guided_velocity`.
+        """
+        if solver not in SOLVERS:
+            raise ValueError(f"Unknown ODE solver '{solver}', expected one of {list(SOLVERS)}")
+        return getattr(self, SOLVERS[solver])(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, **guidance)
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, **guidance):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -83,6 +110,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            guidance: `cfg_rate` and `guidance_interval`, see `guided_velocity`
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -91,29 +119,9 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        velocity, guided = self.guided_velocity(x, mu, mask, spks, cond, t_span, **guidance)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = velocity(x, t, guided[step - 1])
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -122,17 +130,124 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1].float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, **guidance):
+        """
+        Heun's method (explicit trapezoidal rule): the Euler step is corrected with the velocity at its end. Second
+        order, with two estimator passes per step. Arguments as `solve_euler`.
+        """
+        velocity, guided = self.guided_velocity(x, mu, mask, spks, cond, t_span, **guidance)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            dphi_dt = velocity(x, t, guided[step - 1])
+            x_euler = x + dt * dphi_dt
+            x = x + 0.5 * dt * (dphi_dt + velocity(x_euler, t + dt, guided[step - 1]))
+        return x.float()
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, **guidance):
+        """
+        Explicit midpoint method: each step takes the velocity halfway along the Euler step. Second order, with two
+        estimator passes per step. Arguments as `solve_euler`.
+        """
+        velocity, guided = self.guided_velocity(x, mu, mask, spks, cond, t_span, **guidance)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1:step], t_span[step] - t_span[step - 1]
+            x_mid = x + 0.5 * dt * velocity(x, t, guided[step - 1])
+            x = x + dt * velocity(x_mid, t + 0.5 * dt, guided[step - 1])
+        return x.float()
+
+    def solve_dpm(self, x, t_span, mu, mask, spks, cond, **guidance):
+        """
+        DPM-Solver++(2M) multistep solver, with one estimator pass per step. The flow follows the path
+        x_t = t * x_1 + (1 - t) * x_0 (`sigma_min` is negligible), along which the data prediction is
+        x_1 = x_t + (1 - t) * v; each step extrapolates the data predictions of the last two steps in log-SNR
+        `lambda = log(t / (1 - t))`. The log-SNR is infinite at t = 0 and t = 1, so the steps from the first two times
+        and the last step are first order, ie Euler steps: the step ratio of the second step, `r = h_prev / h`, is
+        infinite, which cancels the correction. Arguments as `solve_euler`.
+        """
+        # infinite at both ends, which are never extrapolated from
+        lambdas = torch.logit(t_span.float())
+        velocity, guided = self.guided_velocity(x, mu, mask, spks, cond, t_span, **guidance)
+        data_prev = None
+        for step in range(1, len(t_span)):
+            t, s = t_span[step - 1], t_span[step]
+            data = x + (1 - t) * velocity(x, t[None], guided[step - 1])
+            if step <= 2 or step == len(t_span) - 1:
+                data_est = data
+            else:
+                r = (lambdas[step - 1] - lambdas[step - 2]) / (lambdas[step] - lambdas[step - 1])
+                data_est = data + (data - data_prev) / (2 * r)
+            # x_s = (sigma_s / sigma_t) x_t + alpha_s (1 - e^-h) x_1, with alpha_t = t and sigma_t = 1 - t
+            sigma_ratio = (1 - s) / (1 - t)
+            x = sigma_ratio * x + (s - t * sigma_ratio) * data_est
+            data_prev = data
+        return x.float()
+
+    def guided_velocity(self, x, mu, mask, spks, cond, t_span, cfg_rate=None, guidance_interval=None):
+        """
+        Returns a function of `(x, t, guided)` giving the velocity of the flow at `x` and time `t` (1,), and whether
+        each step of `t_span` is guided. Guided steps, those which start within `guidance_interval` (all by default),
+        use classifier-free guidance at rate `cfg_rate` (`inference_cfg_rate` by default): they batch the conditional
+        and unconditional passes of the B items, and the other steps only run the conditional ones.
+        The steps are decided on the host once, so that the solver loops don't synchronize with the device.
+        The passes use buffers allocated once for the whole solve, of which unguided steps use the first B rows, and
+        the inputs which are the same at every step are only set, and prepared by the estimator, once.
+        """
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        start, end = guidance_interval or (0.0, 1.0)
+        guided_steps = [cfg_rate > 0 and start <= t <= end for t in t_span[:-1].tolist()]
+        n_items = mu.size(0)
+        batch = 2 * n_items if any(guided_steps) else n_items
+
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        x_in = torch.zeros([batch, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([batch, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([batch, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([batch], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([batch, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([batch, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        mask_in[:] = mask.repeat(batch // n_items, 1, 1)
+        mu_in[:n_items] = mu
+        spks_in[:n_items] = spks
+        cond_in[:n_items] = cond
+        context = None
+        if isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, "prepare"):
+            context = self.estimator.prepare(mask_in, mu_in, spks_in, cond_in)
+
+        def velocity(x, t, guided: bool):
+            n = batch if guided else n_items
+            x_in[:n_items] = x
+            if guided:
+                x_in[n_items:] = x
+            t_in[:n] = t.unsqueeze(0)
+            dphi_dt = self.forward_estimator(
+                x_in[:n], mask_in[:n],
+                mu_in[:n], t_in[:n],
+                spks_in[:n],
+                cond_in[:n],
+                context=context if guided or context is None else context.head(n),
+            )
+            if not guided:
+                return dphi_dt
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [n_items, n_items], dim=0)
+            return (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
+
+        return velocity, guided_steps
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, context=None):
         if isinstance(self.estimator, torch.nn.Module):
+            if context is not None:
+                return self.estimator.forward(x, mask, mu, t, spks, cond, context=context)
             return self.estimator.forward(x, mask, mu, t, spks, cond)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                batch = x.size(0)
+                self.estimator.set_input_shape('x', (batch, 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (batch, 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (batch, 80, x.size(2)))
+                self.estimator.set_input_shape('t', (batch,))
+                self.estimator.set_input_shape('spks', (batch, 80))
+                self.estimator.set_input_shape('cond', (batch, 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -191,7 +306,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None,
+                cfg_rate=None, guidance_interval=None, prompt_len=0, noise_offset=0, flow_cache=None):
         """Forward diffusion
 
         Args:
@@ -204,15 +320,45 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, one of `SOLVERS`. Defaults to `cfm_params.solver`.
+            cfg_rate (float, optional): classifier-free guidance rate, 0 to disable guidance. Defaults to
+                `cfm_params.inference_cfg_rate`.
+            guidance_interval (tuple, optional): (start, end) times of the steps which are guided. Defaults to all.
+            prompt_len (int, optional): mel frames of the prompt, for streaming. Defaults to 0.
+            noise_offset (int, optional): position in the whole utterance of the first frame after the prompt, for
+                streaming. Defaults to 0.
+            flow_cache (torch.Tensor, optional): noise and mu of the first frames after the prompt, from the previous
+                chunk when streaming.
+                shape: (1, n_feats, cache_timesteps, 2)
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
+            flow_cache: noise and mu of the frames after the prompt
+                shape: (batch_size, n_feats, mel_timesteps - prompt_len, 2)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        # every item of a batch starts from the same noise, as if it was generated on its own, and every chunk of a
+        # stream from the noise of its frames in the whole utterance
+        if noise_offset:
+            z = torch.concat([
+                self.rand_noise[:, :, :prompt_len],
+                self.rand_noise[:, :, prompt_len + noise_offset:noise_offset + mu.size(2)],
+            ], dim=2)
+        else:
+            z = self.rand_noise[:, :, :mu.size(2)]
+        z = z.to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
+        if flow_cache is not None:
+            cache_size = flow_cache.size(2)
+            z[:, :, prompt_len:prompt_len + cache_size] = flow_cache[:, :, :, 0]
+            mu[:, :, prompt_len:prompt_len + cache_size] = flow_cache[:, :, :, 1]
+        z = z.expand(mu.size(0), -1, -1)
+        flow_cache = torch.stack([z[:, :, prompt_len:], mu[:, :, prompt_len:]], dim=-1)
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        return self.solve(
+            solver or self.solver, z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond,
+            cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        ), flow_cache
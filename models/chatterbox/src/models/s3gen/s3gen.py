@@ -17,8 +17,9 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from collections import defaultdict
 from functools import lru_cache
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
@@ -27,6 +28,7 @@ from .xvector import CAMPPlus
 from .utils.mel import mel_spectrogram
 from .f0_predictor import ConvRNNF0Predictor
 from .hifigan import HiFTGenerator
+from .streaming import S3GenStreamer
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
@@ -38,12 +40,44 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+# Log-mel of silence (see `mel_spectrogram`), which the mels of shorter items are padded with for the vocoder
+MEL_FLOOR = float(np.log(1e-5))
+
+
+def collate_ref_dicts(ref_dicts: List[dict], device) -> dict:
+    """
+    One ref dict for a batch of references (see `S3Token2Mel.embed_ref`): prompt tokens and mels are padded, with
+    their lengths, and the x-vectors stacked. Values may be numpy arrays, eg from a prod API call.
+    """
+    def tensor(value):
+        value = torch.from_numpy(value) if isinstance(value, np.ndarray) else value
+        return value.to(device)
+
+    prompt_tokens = [tensor(d["prompt_token"]).view(-1) for d in ref_dicts]
+    prompt_feats = [tensor(d["prompt_feat"]).squeeze(0) for d in ref_dicts]
+    return dict(
+        prompt_token=torch.nn.utils.rnn.pad_sequence(prompt_tokens, batch_first=True),
+        prompt_token_len=torch.tensor([len(t) for t in prompt_tokens], device=device),
+        prompt_feat=torch.nn.utils.rnn.pad_sequence(prompt_feats, batch_first=True),
+        prompt_feat_len=torch.tensor([len(f) for f in prompt_feats], device=device),
+        embedding=torch.cat([tensor(d["embedding"]).view(1, -1) for d in ref_dicts]),
+    )
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
     return ta.transforms.Resample(src_sr, dst_sr).to(device)
 
 
+# Steps and ODE solver of the flow matching, from previews to final renders. "standard" is the original 10-step Euler.
+FLOW_PRESETS = {
+    "draft": dict(n_timesteps=4, solver="dpm"),
+    "standard": dict(n_timesteps=10, solver="euler"),
+    "high": dict(n_timesteps=10, solver="heun"),
+}
+
+
 class S3Token2Mel(torch.nn.Module):
     """
     CosyVoice2's CFM decoder maps S3 speech tokens to mel-spectrograms.
@@ -156,6 +190,47 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def embed_refs(self, features: List["ReferenceFeatures"]) -> List[dict]:
+        """
+        `embed_ref` for many references at once, from their `ReferenceFeatures`. The S3 tokenizer runs over the padded
+        batch, which it masks; the x-vector runs over batches of references with the same length, as CAMPPlus would
+        pool over the padding. References are cut at 10 s, so most of them share that length.
+        """
+        # Speaker embeddings, batched by length
+        x_vectors = [None] * len(features)
+        by_length = defaultdict(list)
+        for i, f in enumerate(features):
+            by_length[f.ref_wav_16.size(1)].append(i)
+        for idxs in by_length.values():
+            embeds = self.speaker_encoder.inference(torch.cat([features[i].ref_wav_16 for i in idxs]))
+            for i, embed in zip(idxs, embeds):
+                x_vectors[i] = embed[None]
+
+        # Tokenize the 16khz references
+        speech_tokens, speech_token_lens = self.tokenizer.quantize_log_mels([f.ref_log_mel for f in features])
+
+        ref_dicts = []
+        for i, f in enumerate(features):
+            ref_mels_24 = f.prompt_feat
+            ref_speech_token_lens = speech_token_lens[i:i + 1].clone()
+            ref_speech_tokens = speech_tokens[i:i + 1, :ref_speech_token_lens[0]]
+            # See `embed_ref`
+            if ref_mels_24.shape[1] != 2 * ref_speech_tokens.shape[1]:
+                logging.warning(
+                    "Reference mel length is not equal to 2 * reference token length.\n"
+                )
+                ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
+                ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
+
+            ref_dicts.append(dict(
+                prompt_token=ref_speech_tokens,
+                prompt_token_len=ref_speech_token_lens,
+                prompt_feat=ref_mels_24,
+                prompt_feat_len=None,
+                embedding=x_vectors[i],
+            ))
+        return ref_dicts
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
@@ -165,6 +240,10 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -173,7 +252,7 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - This function is designed for batch_size=1 only, see `forward_batch` for batches.
 
         Args
         ----
@@ -181,6 +260,9 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_timesteps`, `solver`, `cfg_rate`, `guidance_interval`: steps, ODE solver and classifier-free guidance of the
+          flow matching (see `FLOW_PRESETS`). Guidance, at `cfg_rate` (0 to disable it), only applies to the steps
+          within the (start, end) `guidance_interval` of times in [0, 1], and unguided steps cost half as much.
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
@@ -204,10 +286,43 @@ class S3Token2Mel(torch.nn.Module):
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            guidance_interval=guidance_interval,
             **ref_dict,
         )
         return output_mels
 
+    def forward_batch(
+        self,
+        speech_tokens: List[torch.LongTensor],
+        ref_dicts: List[dict],
+        finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+    ):
+        """
+        `forward` for a batch of utterances, each with its own pre-computed ref dict: the token sequences and the
+        prompts are padded, and the encoder and the flow matching run once over the batch, masked. The noise of the
+        flow is the same for every item, so items come out as they would one by one, within float precision.
+        Returns the (B, 80, T) mels, padded, and their lengths (B,).
+        """
+        speech_tokens = [tokens.view(-1).to(self.device) for tokens in speech_tokens]
+        speech_token_lens = torch.tensor([len(tokens) for tokens in speech_tokens], device=self.device)
+        return self.flow.inference(
+            token=torch.nn.utils.rnn.pad_sequence(speech_tokens, batch_first=True),
+            token_len=speech_token_lens,
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            guidance_interval=guidance_interval,
+            **collate_ref_dicts(ref_dicts, self.device),
+        )
+
 
 class S3Token2Wav(S3Token2Mel):
     """
@@ -243,11 +358,19 @@ class S3Token2Wav(S3Token2Mel):
         ref_sr: Optional[int],
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
-        finalize: bool = False
+        finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
     ):
-        output_mels = super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        )
 
-        # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
+        # TODO jrm: ignoring the speed control (mel interpolation) for now. The HiFTGAN caching mechanisms are used by
+        # `stream`.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
         output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
@@ -268,8 +391,15 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        )
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -288,11 +418,76 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        """
+        `n_timesteps` and `solver` trade the quality of the flow matching for speed, eg with one of the `FLOW_PRESETS`:
+        the estimator runs `n_timesteps` times with the default "euler" solver (see `SOLVERS`).
+        `cfg_rate` and `guidance_interval` limit the classifier-free guidance of the flow matching, which doubles the
+        batch of the estimator, to some of the steps, or disable it with `cfg_rate=0`.
+        """
+        output_mels = self.flow_inference(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        )
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.LongTensor],
+        ref_dicts: List[dict],
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+    ) -> List[torch.Tensor]:
+        """
+        `inference` for a batch of utterances, eg lines of an audiobook: `speech_tokens` are 1D sequences without
+        invalid tokens, each with its own pre-computed ref dict. The flow runs over the padded batch (see
+        `forward_batch`), then HiFT over the mels, whose padding is set to silence; returns the (1, L) waveform of each
+        utterance, trimmed to its length.
+
+        NOTE: the last samples of shorter utterances are vocoded next to silent frames rather than HiFT's zero padding,
+        and HiFT's source excitation is random, so waveforms match `inference` closely but not exactly.
+        """
+        output_mels, mel_lens = self.forward_batch(
+            speech_tokens, ref_dicts, finalize=True,
+            n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        )
+        padding = torch.arange(output_mels.size(2), device=self.device) >= mel_lens[:, None]
+        output_mels = output_mels.masked_fill(padding[:, None], MEL_FLOOR)
+        output_wavs, _ = self.hift_inference(output_mels)
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+        output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+
+        samples_per_frame = output_wavs.size(1) // output_mels.size(2)
+        return [wav[None, :n * samples_per_frame] for wav, n in zip(output_wavs, mel_lens.tolist())]
+
+    def stream(
+        self,
+        speech_tokens: Iterable[torch.LongTensor],
+        ref_dict: dict,
+        **kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streaming `inference`: `speech_tokens` are chunks of 1D token sequences without invalid tokens, eg as they are
+        generated, or a single one. Yields the (1, L) waveform of the utterance piece by piece, as soon as each piece
+        is ready (see `S3GenStreamer`, which `kwargs` are passed to).
+        """
+        if torch.is_tensor(speech_tokens):
+            speech_tokens = [speech_tokens]
+        streamer = S3GenStreamer(self, ref_dict, **kwargs)
+        for tokens in speech_tokens:
+            streamer.push(tokens)
+            yield from streamer.synthesize()
+        yield from streamer.synthesize(finalize=True)
@@ -0,0 +1,147 @@
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+def fade_in_out(fade_in: Tensor, fade_out: Tensor, window: Tensor) -> Tensor:
+    "Crossfades the start of `fade_in` with the end of `fade_out` over the last dim, with the halves of `window`."
+    n = window.size(0) // 2
+    fade_in[..., :n] = fade_in[..., :n] * window[:n] + fade_out[..., -n:] * window[n:]
+    return fade_in
+
+
+class S3GenStreamer:
+    """
+    Streaming token-to-wav of one utterance: speech tokens are `push`ed as they come, and `synthesize` yields the
+    audio of each chunk of tokens as soon as it is ready, so that playback can start long before the whole utterance
+    is converted.
+        * chunks start at `chunk_tokens` tokens and grow by `chunk_growth` up to `max_chunk_tokens`: the first audio
+          comes early, and later chunks amortize the prompt, which the flow matching runs over for every chunk
+        * the tokens received so far are encoded, with the lookahead tokens of the chunk, and the flow matching runs
+          over the prompt and the mels of the chunk, which start with the last `overlap_tokens` tokens of the previous
+          one. Their noise and `mu` come from the flow cache of the previous chunk, so that they come out close to
+          it, and the two are crossfaded
+        * HiFT runs over the mels of the chunk following the last frames of the previous one, whose source excitation
+          it reuses, and the audio of these frames is crossfaded with the end of the previous chunk, which is held
+          back for it
+
+    NOTE: mels only match those of `S3Token2Wav.inference` up to the crossfades, as the flow matching attends to the
+    prompt and the chunk only. The flow runs over the prompt for every chunk, so streaming costs more than converting
+    the whole utterance at once.
+    """
+
+    def __init__(
+        self,
+        s3gen: 'S3Token2Wav',
+        ref_dict: dict,
+        *,
+        chunk_tokens: int = 25,
+        chunk_growth: float = 2.0,
+        max_chunk_tokens: int = 200,
+        overlap_tokens: int = 10,
+        mel_cache_len: int = 8,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_rate: Optional[float] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+    ):
+        if not 0 < overlap_tokens < chunk_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) must be positive and below chunk_tokens ({chunk_tokens})")
+        from .s3gen import collate_ref_dicts  # circular import
+
+        self.s3gen = s3gen
+        self.flow = s3gen.flow
+        self.ref_dict = collate_ref_dicts([ref_dict], s3gen.device)
+        self.flow_params = dict(
+            n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, guidance_interval=guidance_interval,
+        )
+        self.chunk_tokens = chunk_tokens
+        self.chunk_growth = chunk_growth
+        self.max_chunk_tokens = max_chunk_tokens
+
+        device = s3gen.device
+        self.mel_overlap_len = overlap_tokens * self.flow.token_mel_ratio
+        self.mel_window = torch.from_numpy(np.hamming(2 * self.mel_overlap_len)).float().to(device)
+        self.mel_cache_len = mel_cache_len
+        self.samples_per_frame = int(s3gen.mel2wav.f0_upsamp.scale_factor)  # samples per mel frame
+        self.source_cache_len = mel_cache_len * self.samples_per_frame
+        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len)).float().to(device)
+
+        self.tokens = torch.zeros(0, dtype=torch.long, device=device)
+        self.n_tokens_done = 0  # tokens whose mels are generated
+        self.n_frames = 0  # mels generated, including the overlap held back
+        self.flow_cache: Optional[Tensor] = None
+        self.mel_overlap: Optional[Tensor] = None
+        self.hift_cache: Optional[dict] = None
+        self.finished = False
+
+    def push(self, tokens: Tensor):
+        "Appends speech tokens, without invalid tokens."
+        if self.finished:
+            raise RuntimeError("stream is finished")
+        self.tokens = torch.cat([self.tokens, tokens.view(-1).to(self.tokens.device)])
+
+    @torch.inference_mode()
+    def synthesize(self, finalize=False) -> Iterator[Tensor]:
+        """
+        Yields the (1, L) audio of every chunk of the tokens pushed so far; with `finalize`, of all the remaining
+        tokens too, which ends the stream.
+        """
+        lookahead = self.flow.pre_lookahead_len
+        while len(self.tokens) >= self.n_tokens_done + self.chunk_tokens + lookahead:
+            end = self.n_tokens_done + self.chunk_tokens
+            wav = self._chunk(self.tokens[:end + lookahead], finalize=False)
+            self.n_tokens_done = end
+            self.chunk_tokens = min(int(self.chunk_tokens * self.chunk_growth), self.max_chunk_tokens)
+            yield wav
+        if finalize and not self.finished:
+            self.finished = True
+            if len(self.tokens) > self.n_tokens_done or self.hift_cache is not None:
+                yield self._chunk(self.tokens, finalize=True)
+
+    def _chunk(self, tokens: Tensor, finalize: bool) -> Tensor:
+        mel_start = max(0, self.n_frames - self.mel_overlap_len)
+        mels, flow_cache = self.flow.inference_chunk(
+            token=tokens[None],
+            token_len=torch.tensor([len(tokens)], device=tokens.device),
+            finalize=finalize,
+            mel_start=mel_start,
+            flow_cache=self.flow_cache,
+            **self.ref_dict,
+            **self.flow_params,
+        )
+        self.n_frames = mel_start + mels.size(2)
+
+        # crossfade the overlap with the end of the previous chunk, and hold back the end of this one
+        if self.mel_overlap is not None:
+            mels = fade_in_out(mels, self.mel_overlap, self.mel_window)
+        if not finalize:
+            self.flow_cache = flow_cache[:, :, -self.mel_overlap_len:]
+            self.mel_overlap = mels[:, :, -self.mel_overlap_len:]
+            mels = mels[:, :, :-self.mel_overlap_len]
+        return self._vocode(mels, finalize)
+
+    def _vocode(self, mels: Tensor, finalize: bool) -> Tensor:
+        if self.hift_cache is not None:
+            mels = torch.cat([self.hift_cache["mel"], mels], dim=2)
+            cache_source = self.hift_cache["source"]
+        else:
+            cache_source = torch.zeros(1, 1, 0, device=mels.device)
+        speech, source = self.s3gen.hift_inference(mels, cache_source)
+
+        if self.hift_cache is not None:
+            speech = fade_in_out(speech, self.hift_cache["speech"], self.speech_window)
+        else:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip, as in `S3Token2Wav.inference`
+            n_fade = min(speech.size(1), len(self.s3gen.trim_fade))
+            speech[:, :n_fade] *= self.s3gen.trim_fade[:n_fade]
+        if not finalize:
+            self.hift_cache = dict(
+                mel=mels[:, :, -self.mel_cache_len:],
+                source=source[:, :, -self.source_cache_len:],
+                speech=speech[:, -self.source_cache_len:],
+            )
+            speech = speech[:, :-self.source_cache_len]
+        return speech
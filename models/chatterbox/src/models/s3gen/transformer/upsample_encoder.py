@@ -276,8 +276,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               decoding_chunk_size,
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
-        # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # lookahead + conformer encoder. The padding of shorter items is zeroed, as the lookahead of their last tokens
+        # would otherwise see it instead of the zeros past the end of a single sequence
+        xs = self.pre_lookahead_layer(xs * mask_pad.transpose(1, 2))
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
@@ -125,6 +125,20 @@ class S3Tokenizer(S3TokenizerV2):
             speech_token_lens.long().detach(),
         )
 
+    @torch.no_grad()
+    def quantize_log_mels(self, mels: List[torch.Tensor], max_len: int=None) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        `forward` from precomputed (128, T) log-mel spectrograms, eg by `ReferenceFrontend`, as a padded batch.
+        """
+        if max_len is not None:
+            mels = [mel[..., :max_len * 4] for mel in mels]
+        mels, mel_lens = padding([mel.to(self.device) for mel in mels])
+        speech_tokens, speech_token_lens = self.quantize(mels, mel_lens.to(self.device))
+        return (
+            speech_tokens.long().detach(),
+            speech_token_lens.long().detach(),
+        )
+
     def log_mel_spectrogram(
         self,
         audio: torch.Tensor,
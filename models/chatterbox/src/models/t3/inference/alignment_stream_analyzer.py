@@ -30,7 +30,7 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0, query_offset=0, batch_idx=0):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
@@ -38,31 +38,62 @@ class AlignmentStreamAnalyzer:
         position, repetition, etc.
 
         NOTE: currently requires no queues.
+        NOTE: `query_offset` is the position of the first query of the prefill, ie the length of a cached prefix that
+        isn't recomputed (see `T3PrefixCache`).
+        NOTE: `batch_idx` is the batch row of the analyzed sequence. It can be updated when the batch is compacted, eg
+        by `T3BatchDecodeEngine`, or set to None to ignore forwards that don't include the sequence (see `T3Scheduler`).
+        NOTE: the alignment stays on the device of the attention weights, in a preallocated buffer, with running
+        reductions instead of full-history ones; each step transfers a handful of scalars to the host, once.
+        NOTE: the hooks stay installed until `close`, which must be called when generation ends. The analyzer can
+        then be reused for another generation with `reset`.
         """
         # self.queue = queue
-        self.text_tokens_slice = (i, j) = text_tokens_slice
+        self.tfmr = tfmr
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
+        self.hook_handles = []
+        self.spied_layers = []  # attention modules hooked by this analyzer
+        self.reset(text_tokens_slice, query_offset=query_offset, batch_idx=batch_idx)
+
+    def reset(self, text_tokens_slice, query_offset=0, batch_idx=0):
+        "Clears the alignment state for a new generation, and installs the attention hooks if they were removed."
+        self.text_tokens_slice = text_tokens_slice
+        self.query_offset = query_offset
+        self.batch_idx = batch_idx
+        # alignment frames, in a buffer that grows by doubling; allocated on the attention device by the first step
+        self._alignment = None
+        self.n_frames = 0
         # self.alignment_bin = torch.zeros(0, j-i)
         self.curr_frame_pos = 0
         self.text_position = 0
+        # text position of every frame, eg to time the words of the text (see `ChatterboxMultilingualTTS.generate`)
+        self.positions = []
+        self.last_result = None
+        # consecutive frames since the start without a discontinuity, see `T3CFGPolicy`
+        self.stable_steps = 0
 
         self.started = False
         self.started_at = None
 
         self.complete = False
         self.completed_at = None
-        
+
+        # Running reductions over the alignment, kept on its device instead of reducing the whole history every step:
+        # max over the first text tokens, per-token activations of the last 3 text tokens since completion, and the
+        # sum of the per-frame maxima over the earlier tokens since completion.
+        self._first_tokens_max = None
+        self._tail_sums = None
+        self._repetition_sum = None
+
         # Track generated tokens for repetition detection
         self.generated_tokens = []
 
         # Using `output_attentions=True` is incompatible with optimized attention kernels, so
         # using it for all layers slows things down too much. We can apply it to just one layer
         # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attns = []
-        for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
-            self.last_aligned_attns += [None]
-            self._add_attention_spy(tfmr, i, layer_idx, head_idx)
+        self.last_aligned_attns = [None] * len(LLAMA_ALIGNED_HEADS)
+        if not self.hook_handles:
+            for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
+                self._add_attention_spy(self.tfmr, i, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
@@ -74,43 +105,99 @@ class AlignmentStreamAnalyzer:
             NOTE:
             - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
             - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+            - only the text columns are kept, on the device: the copy releases the full attention weights.
             """
+            if self.batch_idx is None:
+                return
             if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
+                step_attention = output[1]  # (B, n_heads, T0, Ti)
+                i, j = self.text_tokens_slice
+                self.last_aligned_attns[buffer_idx] = step_attention[self.batch_idx, head_idx, :, i:j].clone()  # (T0, S)
 
         target_layer = tfmr.layers[layer_idx].self_attn
         # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        self.hook_handles.append(target_layer.register_forward_hook(attention_forward_hook))
+        target_layer._attention_spies = getattr(target_layer, "_attention_spies", 0) + 1
+        self.spied_layers.append(target_layer)
+
+        # Force `output_attentions=True` for this layer only, so the remaining layers stay on SDPA.
+        # NOTE: the flag is patched at most once per layer, and stays patched: the hooks come and go with `reset` /
+        # `close`, as analyzers are reused across generations. Without hooks, the layer runs as before: the eager
+        # attention doesn't apply the causal mask that HF leaves to SDPA when no mask is given (eg `T3.forward`).
+        if not getattr(target_layer, "_outputs_attentions", False):
+            original_forward = target_layer.forward
 
-    def step(self, logits, next_token=None):
+            def patched_forward(self, *args, **kwargs):
+                if self._attention_spies > 0:
+                    kwargs['output_attentions'] = True
+                return original_forward(*args, **kwargs)
+
+            target_layer.forward = MethodType(patched_forward, target_layer)
+            target_layer._outputs_attentions = True
+
+    def close(self):
+        "Removes the attention hooks; the analyzer must not be stepped afterwards, until `reset`."
+        for handle in self.hook_handles:
+            handle.remove()
+        for layer in self.spied_layers:
+            layer._attention_spies -= 1
+        self.hook_handles = []
+        self.spied_layers = []
+
+    def step(self, logits, next_token=None, query_idx=None):
         """
         Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        The result is kept as `last_result`, and its position appended to `positions`.
+
+        NOTE: `query_idx` selects one query of the last forward when it decoded several frames at once, eg the
+        verification pass of `T3SpeculativeDecodeEngine`; frames must still be stepped in order.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
+        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, S)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            A_chunk = aligned_attn[j - self.query_offset:] # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            if query_idx is not None:
+                aligned_attn = aligned_attn[query_idx:query_idx + 1]
+            A_chunk = aligned_attn # (1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
         A_chunk[:, self.curr_frame_pos + 1:] = 0
 
+        A_chunk = A_chunk.float()
+        self._append(A_chunk)
+        T, S = self.n_frames, j - i
 
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+        # Update the running reductions. The long tail and repetition checks look at the frames after `completed_at`,
+        # ie those appended once generation was already complete.
+        first_tokens_max = A_chunk[:, :4].max()
+        if self._first_tokens_max is None:
+            self._first_tokens_max = first_tokens_max
+        else:
+            self._first_tokens_max = torch.maximum(self._first_tokens_max, first_tokens_max)
+        if self.complete:
+            self._tail_sums += A_chunk[:, -3:].sum(dim=0)
+            if S > 5:
+                self._repetition_sum += A_chunk[:, :-5].max(dim=1).values.sum()
 
-        A = self.alignment
-        T, S = A.shape
+        # A single transfer of the scalars that the host decisions need
+        stats = [
+            A_chunk[-1].argmax(),
+            self._alignment[max(T - 2, 0):T, -2:].max(),
+            self._first_tokens_max,
+            self._tail_sums.max(),
+            self._repetition_sum,
+        ]
+        if isinstance(next_token, torch.Tensor):
+            stats.append(next_token.view(-1)[0])
+        stats = torch.stack([x.float() for x in stats]).tolist()  # float32 is exact for ids and positions
+        cur_text_posn, last_frames_max, first_tokens_max, tail_max, repetition_sum = stats[:5]
+        cur_text_posn = int(cur_text_posn)
 
         # update position
-        cur_text_posn = A_chunk[-1].argmax()
         discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
         if not discontinuity:
             self.text_position = cur_text_posn
@@ -118,10 +205,11 @@ class AlignmentStreamAnalyzer:
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
+        false_start = (not self.started) and (last_frames_max > 0.1 or first_tokens_max < 0.5)
         self.started = not false_start
         if self.started and self.started_at is None:
             self.started_at = T
+        self.stable_steps = self.stable_steps + 1 if self.started and not discontinuity else 0
 
         # Is generation likely complete?
         self.complete = self.complete or self.text_position >= S - 3
@@ -129,22 +217,16 @@ class AlignmentStreamAnalyzer:
             self.completed_at = T
 
         # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
-
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        long_tail = self.complete and (tail_max >= 5) # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
+        # NOTE: with 5 text tokens or less, there are no previous tokens to check.
+        alignment_repetition = self.complete and (repetition_sum > 5)
+
         # Track generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
-            if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
-            else:
-                token_id = next_token
+            token_id = int(stats[5]) if isinstance(next_token, torch.Tensor) else next_token
             self.generated_tokens.append(token_id)
             
             # Keep only last 8 tokens to prevent memory issues
@@ -174,5 +256,37 @@ class AlignmentStreamAnalyzer:
             logits = -(2**15) * torch.ones_like(logits)
             logits[..., self.eos_idx] = 2**15
 
+        self.positions.append(self.text_position)
+        self.last_result = AlignmentAnalysisResult(
+            false_start=false_start,
+            long_tail=long_tail,
+            repetition=alignment_repetition,
+            discontinuity=discontinuity,
+            complete=self.complete,
+            position=self.text_position,
+        )
+
         self.curr_frame_pos += 1
         return logits
+
+    @property
+    def alignment(self):
+        "(T, S) alignment frames so far"
+        if self._alignment is None:
+            i, j = self.text_tokens_slice
+            return torch.zeros(0, j - i)
+        return self._alignment[:self.n_frames]
+
+    def _append(self, A_chunk):
+        "Writes alignment frames at the cursor, growing the buffer if needed."
+        n = A_chunk.size(0)
+        if self._alignment is None:
+            self._alignment = A_chunk.new_zeros(max(256, 2 * n), A_chunk.size(1))
+            self._tail_sums = A_chunk.new_zeros(min(3, A_chunk.size(1)))
+            self._repetition_sum = A_chunk.new_zeros(())
+        elif self.n_frames + n > self._alignment.size(0):
+            grown = self._alignment.new_zeros(2 * (self.n_frames + n), self._alignment.size(1))
+            grown[:self.n_frames] = self.alignment
+            self._alignment = grown
+        self._alignment[self.n_frames:self.n_frames + n] = A_chunk
+        self.n_frames += n
@@ -0,0 +1,237 @@
+import logging
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from transformers import StaticCache
+
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+class T3BatchDecodeEngine:
+    """
+    Decodes several independent T3 sequences in one batch, with a single transformer forward per step for all of them:
+        * prompts of different lengths are left-padded to the longest one. Per-row position ids and 4D attention
+          masks make every row see exactly what it would see unbatched.
+        * with CFG, rows `0..N-1` hold the conditional sequences and rows `N..2N-1` the unconditional ones
+        * EOS and alignment are tracked per sequence. Finished sequences are retired every `eos_check_interval`
+          steps by compacting the batch (KV cache, masks, positions, sampler state), so the remaining steps get cheaper.
+
+    See `T3DecodeEngine` for the single-sequence version.
+    """
+
+    def __init__(
+        self,
+        t3: 'T3',
+        backend: 'T3HuggingfaceBackend',
+        *,
+        prompt_lens: List[int],
+        cfg: bool,
+        max_new_tokens: int,
+        dtype: torch.dtype,
+        analyzers: Optional[List['AlignmentStreamAnalyzer']] = None,
+        eos_check_interval: int = 8,
+    ):
+        self.backend = backend
+        self.n_seqs = len(prompt_lens)
+        self.rows_per_seq = 2 if cfg else 1
+        self.prompt_len = max(prompt_lens)
+        self.max_new_tokens = max_new_tokens
+        self.eos_check_interval = eos_check_interval
+        self.stop_token = t3.hp.stop_speech_token
+        self.hp = t3.hp
+        self.speech_head_weight = t3.speech_head.weight
+        self.speech_emb_table = t3.speech_emb.weight
+        self.speech_pos_table = t3.speech_pos_emb.emb.weight
+        self.analyzers = analyzers if analyzers is not None else [None] * self.n_seqs
+        device = t3.device
+
+        # Active sequences, as indices into the inputs, in batch row order
+        self.seq_ids = list(range(self.n_seqs))
+        batch_size = self.n_seqs * self.rows_per_seq
+        max_cache_len = self.prompt_len + max_new_tokens
+        self.cache = StaticCache(
+            config=t3.cfg,
+            batch_size=batch_size,
+            max_cache_len=max_cache_len,
+            device=device,
+            dtype=dtype,
+        )
+
+        # 4D additive masks: causal over the prompt, without the left padding of each row. Padding queries attend to
+        # themselves only, to avoid fully masked rows.
+        pad = torch.tensor([self.prompt_len - n for n in prompt_lens], device=device).repeat(self.rows_per_seq)
+        min_dtype = torch.finfo(dtype).min
+        cols = torch.arange(max_cache_len, device=device)
+        queries = torch.arange(self.prompt_len, device=device)[:, None]
+        allowed = (cols <= queries) & (cols >= pad[:, None, None]) | (cols == queries)  # (B, T0, L)
+        self.prompt_mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, min_dtype)
+        self.prompt_mask = self.prompt_mask[:, None]
+        allowed = (cols >= pad[:, None]) & (cols < self.prompt_len)  # (B, L)
+        self.step_mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, min_dtype)
+        self.step_mask = self.step_mask[:, None, None]
+
+        # positions: prompt positions start after the padding of each row
+        self.prompt_position_ids = (queries.T - pad[:, None]).clamp_(min=0)  # (B, T0)
+        self.position_ids = self.prompt_position_ids[:, -1:].clone()  # (B, 1)
+        self.cache_position = torch.full((1,), self.prompt_len - 1, dtype=torch.long, device=device)
+
+        # token ids, starting with the BOS token, and the input embeddings of the next step
+        self.tokens = torch.full(
+            (self.n_seqs, max_new_tokens + 1), t3.hp.start_speech_token, dtype=torch.long, device=device,
+        )
+        self.step_embeds = torch.empty(batch_size, 1, t3.dim, dtype=dtype, device=device)
+        self.eos_found = torch.zeros(self.n_seqs, dtype=torch.bool, device=device)
+
+    @property
+    def n_active(self):
+        return len(self.seq_ids)
+
+    def prefill(self, inputs_embeds: Tensor):
+        return self.backend(
+            inputs_embeds=inputs_embeds,
+            past_key_values=self.cache,
+            attention_mask=self.prompt_mask,
+            position_ids=self.prompt_position_ids,
+            cache_position=torch.arange(self.prompt_len, device=inputs_embeds.device),
+            use_cache=True,
+            return_dict=True,
+            compute_logits=False,
+        )
+
+    def decode_step(self, i: int):
+        "Forward pass with the `i`-th generated token of every active sequence."
+        n = self.n_active
+        tokens = self.tokens[:, i + 1]
+        embeds = self.step_embeds[:n, 0]  # (n, dim)
+        torch.index_select(self.speech_emb_table, 0, tokens, out=embeds)
+        embeds.add_(self.speech_pos_table[i + 1])
+        if self.rows_per_seq > 1:
+            self.step_embeds[n:].copy_(self.step_embeds[:n])  # CFG
+
+        self.cache_position.add_(1)
+        self.position_ids.add_(1)
+        self.step_mask[..., self.prompt_len + i] = 0
+        return self.backend(
+            inputs_embeds=self.step_embeds,
+            past_key_values=self.cache,
+            attention_mask=self.step_mask,
+            position_ids=self.position_ids,
+            cache_position=self.cache_position,
+            return_dict=True,
+            compute_logits=False,
+        )
+
+    def retire(self, finished: List[int], sampler: T3Sampler):
+        "Removes the sequences at the given batch rows, compacting every per-row buffer."
+        n = self.n_active
+        keep = [r for r in range(n) if r not in finished]
+        for r in finished:
+            if self.analyzers[r] is not None:
+                self.analyzers[r].close()
+        self.seq_ids = [self.seq_ids[r] for r in keep]
+        self.analyzers = [self.analyzers[r] for r in keep]
+        for r, analyzer in enumerate(self.analyzers):
+            if analyzer is not None:
+                analyzer.batch_idx = r
+        if not keep:
+            return
+
+        seqs = torch.tensor(keep, device=self.tokens.device)
+        rows = torch.cat([seqs + k * n for k in range(self.rows_per_seq)])
+        for name in ("key_cache", "value_cache"):
+            layers = getattr(self.cache, name)
+            for layer_idx in range(len(layers)):
+                layers[layer_idx] = layers[layer_idx].index_select(0, rows)
+                # `StaticCache` also registers the layers as buffers, which would keep the old memory alive
+                if hasattr(self.cache, f"{name}_{layer_idx}"):
+                    setattr(self.cache, f"{name}_{layer_idx}", layers[layer_idx])
+        self.step_mask = self.step_mask.index_select(0, rows)
+        self.position_ids = self.position_ids.index_select(0, rows)
+        self.step_embeds = self.step_embeds[:len(rows)]
+        self.tokens = self.tokens.index_select(0, seqs)
+        self.eos_found = self.eos_found.index_select(0, seqs)
+        sampler.select(seqs)
+
+    def _trim(self, row: int, n_tokens: int, stop_on_eos: bool) -> Tensor:
+        predicted = self.tokens[row:row + 1, 1:n_tokens + 1]
+        if stop_on_eos:
+            eos_idx = (predicted[0] == self.stop_token).nonzero()
+            if len(eos_idx) > 0:
+                predicted = predicted[:, :eos_idx[0, 0] + 1]
+        return predicted.clone()
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        inputs_embeds: Tensor,
+        *,
+        stop_on_eos=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        top_k=256,
+        generator: Optional[torch.Generator] = None,
+    ) -> List[Tensor]:
+        """
+        Args:
+            inputs_embeds: (B, T0, dim) left-padded conditioning, text and BOS embeddings, in the row layout above
+        Returns:
+            list of (1, n_tokens) generated speech tokens per sequence, including the EOS token if one was sampled
+        """
+        sampler = T3Sampler(
+            self.speech_head_weight,
+            self.hp,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            top_k=top_k,
+            generator=generator,
+            batch_size=self.n_seqs,
+        )
+        sampler.observe(self.tokens[:, :1])  # BOS
+
+        results: List[Optional[Tensor]] = [None] * self.n_seqs
+        output = self.prefill(inputs_embeds)
+        try:
+            for i in range(self.max_new_tokens):
+                # CFG combine and projection to the valid speech vocabulary → (n, V)
+                logits = sampler.logits(output.hidden_states[-1][:, -1, :], cfg_weight)
+
+                # Per-sequence alignment integrity checks
+                for r, analyzer in enumerate(self.analyzers):
+                    if analyzer is not None:
+                        logits[r:r + 1] = analyzer.step(logits[r:r + 1], next_token=self.tokens[r, i])
+
+                next_tokens = sampler.sample(logits)  # (n, 1)
+                self.tokens[:, i + 1:i + 2].copy_(next_tokens)
+                self.eos_found.logical_or_(next_tokens.view(-1) == self.stop_token)
+                n_tokens = i + 1
+
+                # Retire finished sequences lazily, so that the host doesn't sync with the device on every step
+                if n_tokens == self.max_new_tokens:
+                    finished = list(range(self.n_active))
+                elif stop_on_eos and n_tokens % self.eos_check_interval == 0:
+                    finished = self.eos_found.nonzero().view(-1).tolist()
+                else:
+                    finished = []
+                if finished:
+                    for r in finished:
+                        results[self.seq_ids[r]] = self._trim(r, n_tokens, stop_on_eos)
+                    self.retire(finished, sampler)
+                    logger.info(f"{len(finished)} sequence(s) finished at step {n_tokens}, {self.n_active} left")
+                if self.n_active == 0:
+                    break
+
+                output = self.decode_step(i)
+        finally:
+            for analyzer in self.analyzers:
+                if analyzer is not None:
+                    analyzer.close()
+        return results
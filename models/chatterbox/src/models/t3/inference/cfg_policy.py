@@ -0,0 +1,26 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class T3CFGPolicy:
+    """
+    Guidance truncation: when to stop running the unconditional CFG row of a generation. Guidance matters most at the
+    start of an utterance, while the alignment with the text settles; dropping the row afterwards halves the compute of
+    the remaining tokens, which are then sampled from the conditional row only.
+
+    Guidance stops after `max_guided_tokens` tokens, or once the alignment analyzer has seen a stable text position
+    for `stable_alignment_steps` consecutive tokens, whichever comes first. Without either, guidance is kept to the end.
+
+    NOTE: the alignment criterion needs an `AlignmentStreamAnalyzer`, ie a multilingual model.
+    """
+    max_guided_tokens: Optional[int] = None
+    stable_alignment_steps: Optional[int] = None
+
+    def keep_guidance(self, n_tokens: int, analyzer: Optional['AlignmentStreamAnalyzer'] = None) -> bool:
+        "Whether the next token should still be guided, after `n_tokens` generated tokens."
+        if self.max_guided_tokens is not None and n_tokens >= self.max_guided_tokens:
+            return False
+        if self.stable_alignment_steps is not None and analyzer is not None:
+            return analyzer.stable_steps < self.stable_alignment_steps
+        return True
@@ -0,0 +1,239 @@
+import logging
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from .cfg_policy import T3CFGPolicy
+from .sampler import T3Sampler
+from .prefix_cache import T3Prefix
+
+
+logger = logging.getLogger(__name__)
+
+
+class T3DecodeEngine:
+    """
+    Runs the T3 autoregressive decode loop on buffers that are allocated once per generation:
+        * generated token ids are written into a preallocated buffer with a cursor (no `torch.cat`)
+        * the next input embedding is gathered from the speech embedding and position tables into a fixed buffer,
+          and duplicated in place for the CFG row
+        * the KV cache, attention mask and cache position are static and updated in place
+        * EOS is accumulated in an on-device flag which is only read back every `eos_check_interval` steps, so the
+          host doesn't wait on the device after every token. Tokens sampled past the EOS are discarded.
+
+    NOTE: batch row 0 is the conditional sequence; row 1, if present, is the unconditional (CFG) one. A `T3CFGPolicy`
+    can drop row 1 part way through, after which only row 0 of the static cache is used.
+    """
+
+    def __init__(
+        self,
+        t3: 'T3',
+        backend: 'T3HuggingfaceBackend',
+        *,
+        batch_size: int,
+        prompt_len: int,
+        max_new_tokens: int,
+        dtype: torch.dtype,
+        eos_check_interval: int = 8,
+    ):
+        self.backend = backend
+        self.analyzer = backend.alignment_stream_analyzer
+        self.batch_size = batch_size
+        self.prompt_len = prompt_len
+        self.max_new_tokens = max_new_tokens
+        self.eos_check_interval = eos_check_interval
+        self.stop_token = t3.hp.stop_speech_token
+        self.hp = t3.hp
+        self.speech_head_weight = t3.speech_head.weight
+        device = t3.device
+
+        # embedding tables, gathered from with `index_select` / slicing instead of calling the modules
+        self.speech_emb_table = t3.speech_emb.weight
+        self.speech_pos_table = t3.speech_pos_emb.emb.weight
+
+        # static kv_cache, and 4D additive masks over it: causal over the prompt, then unmasked one position per step
+        self.cache = t3.get_static_cache(batch_size, prompt_len + max_new_tokens, dtype=dtype)
+        max_cache_len = self.cache.key_cache[0].size(2)
+        min_dtype = torch.finfo(dtype).min
+        prompt_mask = torch.full((prompt_len, max_cache_len), min_dtype, dtype=dtype, device=device)
+        self.prompt_mask = prompt_mask.triu_(1)[None, None].expand(batch_size, 1, -1, -1)
+        self.step_mask = torch.full((batch_size, 1, 1, max_cache_len), min_dtype, dtype=dtype, device=device)
+        self.step_mask[..., :prompt_len] = 0
+        self.cache_position = torch.full((1,), prompt_len - 1, dtype=torch.long, device=device)
+
+        # token ids, starting with the BOS token, and the input embedding of the next step
+        self.tokens = torch.full((1, max_new_tokens + 1), t3.hp.start_speech_token, dtype=torch.long, device=device)
+        self.step_embeds = torch.empty(batch_size, 1, t3.dim, dtype=dtype, device=device)
+        self.eos_found = torch.zeros(1, dtype=torch.bool, device=device)
+        self._is_eos = torch.zeros(1, dtype=torch.bool, device=device)
+        self._full_cache = None  # cache layers, while `drop_uncond_row` uses views of them
+
+    def prefill(self, inputs_embeds: Tensor, prefix: Optional[T3Prefix] = None):
+        """
+        Runs the prompt through the model. With a cached `prefix`, its KV states are copied into the cache and only the
+        remaining `inputs_embeds` (text and BOS) are computed.
+        """
+        start = 0
+        if prefix is not None:
+            start = prefix.length
+            for layer_idx in range(len(self.cache.key_cache)):
+                self.cache.key_cache[layer_idx][:, :, :start].copy_(prefix.key_states[layer_idx])
+                self.cache.value_cache[layer_idx][:, :, :start].copy_(prefix.value_states[layer_idx])
+        assert start + inputs_embeds.size(1) == self.prompt_len
+
+        return self.backend(
+            inputs_embeds=inputs_embeds,
+            past_key_values=self.cache,
+            attention_mask=self.prompt_mask[:, :, start:],
+            cache_position=torch.arange(start, self.prompt_len, device=inputs_embeds.device),
+            use_cache=True,
+            return_dict=True,
+            compute_logits=False,
+        )
+
+    def capture_prefix(self, length: int) -> T3Prefix:
+        """
+        Copies the KV states of the first `length` prompt positions out of the cache. Decoding never writes to the
+        prompt positions, so this is valid until the next prefill.
+        """
+        return T3Prefix(
+            key_states=[k[:1, :, :length].clone() for k in self.cache.key_cache],
+            value_states=[v[:1, :, :length].clone() for v in self.cache.value_cache],
+        )
+
+    def drop_uncond_row(self):
+        "Stops CFG: the remaining steps only run the conditional row, on views of row 0 of the static cache."
+        self._full_cache = (list(self.cache.key_cache), list(self.cache.value_cache))
+        for layers in (self.cache.key_cache, self.cache.value_cache):
+            for layer_idx in range(len(layers)):
+                layers[layer_idx] = layers[layer_idx][:1]
+        self.batch_size = 1
+        self.step_embeds = self.step_embeds[:1]
+        self.step_mask = self.step_mask[:1]
+
+    def restore_cache(self):
+        "Undoes `drop_uncond_row` on the static cache, which is shared with later generations."
+        if self._full_cache is not None:
+            self.cache.key_cache[:], self.cache.value_cache[:] = self._full_cache
+            self._full_cache = None
+
+    def update_guidance(self, n_tokens: int, cfg_policy: Optional[T3CFGPolicy]):
+        "Drops the unconditional row once `cfg_policy` says so."
+        if self.batch_size > 1 and cfg_policy is not None and not cfg_policy.keep_guidance(n_tokens, self.analyzer):
+            logger.info(f"CFG stopped after {n_tokens} tokens")
+            self.drop_uncond_row()
+
+    def write_step_embeds(self, i: int):
+        """
+        Writes the input embedding of the `i`-th generated token (speech position `i + 1`, after BOS) into
+        `step_embeds`, for every batch row.
+        """
+        token = self.tokens[0, i + 1:i + 2]
+        row = self.step_embeds[0]  # (1, dim)
+        torch.index_select(self.speech_emb_table, 0, token, out=row)
+        row.add_(self.speech_pos_table[i + 1])
+        if self.batch_size > 1:
+            self.step_embeds[1:].copy_(self.step_embeds[:1])  # CFG
+
+    def record_token(self, i: int, next_token: Tensor):
+        "Stores the `i`-th generated token, and accumulates the EOS flag on-device."
+        self.tokens[:, i + 1:i + 2].copy_(next_token)
+        torch.eq(next_token.view(-1), self.stop_token, out=self._is_eos)
+        self.eos_found.logical_or_(self._is_eos)
+
+    def decode_step(self, i: int):
+        "Forward pass with only the `i`-th generated token, written in place into the static kv_cache."
+        self.write_step_embeds(i)
+        self.cache_position.add_(1)
+        self.step_mask[..., self.prompt_len + i] = 0
+        # Only the alignment layers produce attention weights (see `AlignmentStreamAnalyzer`).
+        return self.backend(
+            inputs_embeds=self.step_embeds,
+            past_key_values=self.cache,
+            attention_mask=self.step_mask,
+            cache_position=self.cache_position,
+            return_dict=True,
+            compute_logits=False,
+        )
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        inputs_embeds: Tensor,
+        *,
+        prefix: Optional[T3Prefix] = None,
+        stop_on_eos=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        top_k=256,
+        generator: Optional[torch.Generator] = None,
+        cfg_policy: Optional[T3CFGPolicy] = None,
+    ):
+        """
+        Args:
+            inputs_embeds: (B, T, dim) conditioning, text and BOS embeddings; without the conditioning if `prefix` is
+                given
+            prefix: cached KV states of the conditioning, see `prefill`
+            top_k: number of candidates that min-p / top-p first look at (see `T3Sampler`)
+            generator: optional RNG for sampling, eg seeded per request
+            cfg_policy: when to stop CFG, see `T3CFGPolicy`
+        Returns:
+            (1, n_tokens) generated speech tokens, including the EOS token if one was sampled
+        """
+        sampler = T3Sampler(
+            self.speech_head_weight,
+            self.hp,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            top_k=top_k,
+            generator=generator,
+        )
+        sampler.observe(self.tokens[0, :1])  # BOS
+
+        output = self.prefill(inputs_embeds, prefix)
+        try:
+            predicted = self._generate(output, sampler, stop_on_eos, cfg_weight, cfg_policy)
+        finally:
+            self.restore_cache()
+        return predicted
+
+    def _generate(self, output, sampler: T3Sampler, stop_on_eos: bool, cfg_weight: float,
+                  cfg_policy: Optional[T3CFGPolicy]):
+        n_tokens = 0
+        for i in range(self.max_new_tokens):
+            # CFG combine and projection to the valid speech vocabulary → (1, V)
+            logits = sampler.logits(output.hidden_states[-1][:, -1, :], cfg_weight)
+
+            # Apply alignment stream analyzer integrity checks, passing the last token for repetition tracking
+            if self.analyzer is not None:
+                logits = self.analyzer.step(logits, next_token=self.tokens[0, i])  # (1, V)
+
+            # Repetition penalty, temperature, min_p / top_p filtering and sampling
+            next_token = sampler.sample(logits)  # shape: (1, 1)
+
+            self.record_token(i, next_token)
+            n_tokens = i + 1
+
+            # Check for EOS lazily, so that the host doesn't sync with the device on every step
+            if stop_on_eos and (n_tokens % self.eos_check_interval == 0) and self.eos_found.item():
+                break
+            if n_tokens == self.max_new_tokens:
+                break
+
+            self.update_guidance(n_tokens, cfg_policy)
+            output = self.decode_step(i)
+
+        predicted = self.tokens[:, 1:n_tokens + 1]
+        if stop_on_eos:
+            # discard the tokens sampled after the first EOS
+            eos_idx = (predicted[0] == self.stop_token).nonzero()
+            if len(eos_idx) > 0:
+                predicted = predicted[:, :eos_idx[0, 0] + 1]
+                logger.info(f"✅ EOS token detected! Stopping generation at step {predicted.size(1)}")
+        return predicted
@@ -0,0 +1,172 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional
+
+import torch
+from torch import Tensor
+from transformers import LlamaConfig
+from transformers.cache_utils import Cache
+
+
+@dataclass
+class T3PagedCacheStats:
+    block_size: int
+    capacity_blocks: int
+    used_blocks: int
+    peak_used_blocks: int
+    n_sequences: int
+    evictions: int
+    bytes_per_block: int
+
+    @property
+    def free_blocks(self):
+        return self.capacity_blocks - self.used_blocks
+
+    @property
+    def capacity_bytes(self):
+        return self.capacity_blocks * self.bytes_per_block
+
+    @property
+    def used_bytes(self):
+        return self.used_blocks * self.bytes_per_block
+
+
+class BlockAllocator:
+    "Hands out fixed-size block ids from a free list."
+
+    def __init__(self, n_blocks: int):
+        self.n_blocks = n_blocks
+        self.free_list = deque(range(n_blocks))
+        self.peak_used = 0
+
+    @property
+    def n_free(self):
+        return len(self.free_list)
+
+    @property
+    def n_used(self):
+        return self.n_blocks - len(self.free_list)
+
+    def allocate(self) -> Optional[int]:
+        "Returns a free block id, or None if the pool is exhausted."
+        if not self.free_list:
+            return None
+        block = self.free_list.popleft()
+        self.peak_used = max(self.peak_used, self.n_used)
+        return block
+
+    def free(self, blocks: List[int]):
+        self.free_list.extend(blocks)
+
+
+class T3PagedKVCache(Cache):
+    """
+    KV cache where every sequence stores its positions in fixed-size blocks taken from a pool shared by all
+    sequences, so that memory grows with the actual length of each sequence and is reused as soon as it finishes,
+    without fragmentation or copies.
+        * each sequence has a block table: its i-th entry is the pool block holding positions
+          `[i * block_size, (i + 1) * block_size)`
+        * new key / value states are scattered into the blocks of their sequence, and attention reads the blocks back
+          through the block tables. The read is a gather followed by the regular (SDPA / eager) attention, which works
+          on CPU; a fused paged-attention kernel could skip the gather.
+
+    Before each forward, `select` picks the sequences of the batch (in row order), the positions written in each of
+    them, and how many positions attention reads. Positions that a sequence hasn't written must be masked out.
+    """
+
+    def __init__(self, config: LlamaConfig, n_blocks: int, block_size: int = 16, device=None, dtype=torch.float32):
+        super().__init__()
+        head_dim = getattr(config, "head_dim", config.hidden_size // config.num_attention_heads)
+        shape = (n_blocks, config.num_key_value_heads, block_size, head_dim)
+        self.block_size = block_size
+        self.device = device
+        self.key_pool = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self.value_pool = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self.allocator = BlockAllocator(n_blocks)
+        self.block_tables: Dict[Hashable, List[int]] = {}
+        self.evictions = 0
+
+        self._tables: Optional[Tensor] = None  # (B, n_blocks_read)
+        self._write_blocks: Optional[Tensor] = None  # (B, seq_len)
+        self._write_offsets: Optional[Tensor] = None  # (B, seq_len)
+        self._read_len = 0
+
+    @property
+    def bytes_per_block(self) -> int:
+        pools = self.key_pool + self.value_pool
+        return sum(p[0].numel() * p.element_size() for p in pools)
+
+    def stats(self) -> T3PagedCacheStats:
+        return T3PagedCacheStats(
+            block_size=self.block_size,
+            capacity_blocks=self.allocator.n_blocks,
+            used_blocks=self.allocator.n_used,
+            peak_used_blocks=self.allocator.peak_used,
+            n_sequences=len(self.block_tables),
+            evictions=self.evictions,
+            bytes_per_block=self.bytes_per_block,
+        )
+
+    def blocks_needed(self, length: int) -> int:
+        return -(-length // self.block_size)
+
+    def reserve(self, seq_id: Hashable, length: int) -> bool:
+        """
+        Makes sure that the sequence has blocks for its first `length` positions, adding it if it's new. Returns False,
+        keeping the blocks already reserved, if the pool runs out.
+        """
+        table = self.block_tables.setdefault(seq_id, [])
+        while len(table) < self.blocks_needed(length):
+            block = self.allocator.allocate()
+            if block is None:
+                return False
+            table.append(block)
+        return True
+
+    def free(self, seq_id: Hashable, evicted=False):
+        "Returns the blocks of a sequence to the pool, eg when it finishes or is evicted to make room for others."
+        self.allocator.free(self.block_tables.pop(seq_id, []))
+        if evicted:
+            self.evictions += 1
+
+    def select(self, seq_ids: List[Hashable], write_positions: Tensor, read_len: int):
+        """
+        Args:
+            seq_ids: sequences of the next forward, one per batch row; blocks must be reserved up to `read_len`
+            write_positions: (B, seq_len) positions of the new key / value states in each sequence
+            read_len: number of positions returned to attention, ie the longest sequence after the write
+        """
+        n_read = self.blocks_needed(read_len)
+        tables = [self.block_tables[seq_id][:n_read] for seq_id in seq_ids]
+        tables = torch.tensor([t + [0] * (n_read - len(t)) for t in tables], device=self.device)  # padding is masked
+        self._tables = tables
+        self._write_blocks = tables.gather(1, write_positions // self.block_size)
+        self._write_offsets = write_positions % self.block_size
+        self._read_len = read_len
+
+    def update(
+        self,
+        key_states: Tensor,
+        value_states: Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        B, H, _, D = key_states.shape
+        key_pool, value_pool = self.key_pool[layer_idx], self.value_pool[layer_idx]
+        key_pool[self._write_blocks, :, self._write_offsets] = key_states.transpose(1, 2)
+        value_pool[self._write_blocks, :, self._write_offsets] = value_states.transpose(1, 2)
+
+        def read(pool):
+            blocks = pool[self._tables]  # (B, n_read, H, block_size, D)
+            return blocks.transpose(1, 2).reshape(B, H, -1, D)[:, :, :self._read_len]
+
+        return read(key_pool), read(value_pool)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._read_len
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return None
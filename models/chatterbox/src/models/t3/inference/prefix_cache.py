@@ -0,0 +1,96 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3Prefix:
+    """
+    KV states of every transformer layer over the conditioning prefix (speaker embedding, perceiver tokens and emotion
+    token), for a single batch row. The prefix comes first in the sequence, so its KV states don't depend on the text
+    and can be shared by every generation with the same conditioning, and by both CFG rows.
+    """
+    key_states: List[Tensor]  # n_layers x (1, n_kv_heads, length, head_dim)
+    value_states: List[Tensor]
+
+    @property
+    def length(self) -> int:
+        return self.key_states[0].size(2)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.key_states + self.value_states)
+
+
+def prefix_key(t3_cond: T3Cond, dtype: torch.dtype) -> str:
+    """
+    Content hash of everything the conditioning prefix depends on: the voice (speaker embedding and prompt speech
+    tokens) and the exaggeration.
+    """
+    h = hashlib.sha1(str(dtype).encode())
+    prompt = t3_cond.cond_prompt_speech_tokens
+    if prompt is None:
+        prompt = t3_cond.cond_prompt_speech_emb
+    for t in (t3_cond.speaker_emb, prompt, t3_cond.emotion_adv):
+        if t is None:
+            h.update(b"none")
+        elif torch.is_tensor(t):
+            t = t.detach().cpu().contiguous()
+            h.update(f"{t.dtype}{tuple(t.shape)}".encode())
+            h.update(t.view(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            h.update(repr(float(t)).encode())
+    return h.hexdigest()
+
+
+class T3PrefixCache:
+    """
+    Bounded LRU of `T3Prefix`es, eg one per (voice, exaggeration) pair spoken in an audiobook. Entries are evicted
+    least-recently-used first once their total size exceeds `max_bytes` (~8 MB per fp32 prefix for the 500M model).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, T3Prefix]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[T3Prefix]:
+        prefix = self.entries.get(key)
+        if prefix is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return prefix
+
+    def put(self, key: str, prefix: T3Prefix):
+        if prefix.nbytes > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.entries[key] = prefix
+        self.nbytes += prefix.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            logger.debug(f"evicted T3 prefix, {len(self.entries)} left ({self.nbytes / 2**20:.1f} MB)")
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
@@ -0,0 +1,140 @@
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+class T3Sampler:
+    """
+    Fused replacement for the HF logits-processor chain used by T3 decoding (`RepetitionPenaltyLogitsProcessor`,
+    temperature, `MinPLogitsWarper`, `TopPLogitsWarper` and multinomial sampling), which runs entirely on-device:
+        * logits are only computed for the valid speech vocabulary: ids below `start_speech_token` and the
+          `stop_speech_token`. The slice of `speech_head` keeps token ids unchanged, with the start token masked out.
+        * CFG is applied to the hidden states before the (linear, bias-free) head, so only one row is projected.
+        * repetition counts are updated incrementally instead of gathering over the whole history every step.
+        * min-p and top-p only look at the `top_k` most likely tokens, instead of sorting the whole vocabulary. This
+          matches the full-vocabulary result whenever min-p already prunes within the top-k, which is the common case.
+          Otherwise (without min-p, or when the last candidate survives it, eg at high temperatures) the whole
+          vocabulary is sorted.
+        * sampling uses an optional per-request `torch.Generator`, leaving the global RNG state untouched.
+
+    Samples `batch_size` sequences at once; with CFG, the hidden states hold the conditional rows of every sequence
+    followed by the unconditional rows, in the same order.
+    """
+
+    def __init__(
+        self,
+        speech_head_weight: Tensor,
+        hp,
+        *,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        top_k=256,
+        generator: Optional[torch.Generator] = None,
+        batch_size=1,
+    ):
+        self.n_vocab = hp.stop_speech_token + 1
+        self.weight = speech_head_weight[:self.n_vocab]  # (V, dim) view, ids are unchanged
+        self.start_token = hp.start_speech_token
+        self.temperature = temperature
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = float(repetition_penalty)
+        self.top_k = min(top_k, self.n_vocab)
+        self.generator = generator
+
+        device = speech_head_weight.device
+        self.counts = torch.zeros(batch_size, self.n_vocab, dtype=torch.long, device=device)
+        self._ones = torch.ones(1, 1, dtype=torch.long, device=device)
+
+    @property
+    def batch_size(self):
+        return self.counts.size(0)
+
+    def observe(self, tokens: Tensor):
+        "Adds token ids to the repetition counts, given as (batch_size,) or (batch_size, n) tensors."
+        tokens = tokens.reshape(self.batch_size, -1)
+        self.counts.scatter_add_(1, tokens, self._ones.expand_as(tokens))
+
+    def select(self, rows: Tensor):
+        "Keeps the state of the given sequences only, eg when finished sequences are retired from a batch."
+        self.counts = self.counts.index_select(0, rows)
+
+    def logits(self, hidden_states: Tensor, cfg_weight: float = 0.0) -> Tensor:
+        """
+        Args:
+            hidden_states: (B, dim) last hidden states; B is `batch_size`, or twice that with CFG
+        Returns:
+            (batch_size, V) logits over the valid speech vocabulary
+        """
+        n = self.batch_size
+        h = hidden_states[:n]
+        if hidden_states.size(0) > n:
+            h = h + cfg_weight * (h - hidden_states[n:2 * n])
+        logits = F.linear(h, self.weight)
+        logits[:, self.start_token] = float("-inf")
+        return logits
+
+    def _min_p_candidates(self, logits: Tensor, k: int):
+        "The `k` most likely tokens, in descending order, and their probabilities after min-p (not renormalized)."
+        top_logits, top_ids = torch.topk(logits, k, dim=-1)
+        probs = torch.softmax(top_logits, dim=-1)
+
+        # min-p: drop tokens less likely than `min_p` times the most likely one (always kept)
+        if self.min_p > 0.0:
+            probs = probs.masked_fill(probs < self.min_p * probs[:, :1], 0.0)
+        return probs, top_ids
+
+    def _filter(self, logits: Tensor):
+        """
+        Repetition penalty, temperature, min-p and top-p; returns the (batch_size, k) probabilities and ids of the
+        candidates, with k either `top_k` or the whole vocabulary.
+        """
+        # repetition penalty, on every token generated so far
+        if self.repetition_penalty != 1.0:
+            penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+            logits = torch.where(self.counts > 0, penalized, logits)
+
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+
+        # partial sort: top-k candidates, in descending order. If min-p keeps the last of them, some of the tokens it
+        # keeps may be missing, so the whole vocabulary is sorted instead.
+        k = self.top_k if self.min_p > 0.0 else self.n_vocab
+        probs, top_ids = self._min_p_candidates(logits, k)
+        if k < self.n_vocab and bool((probs[:, -1] > 0).any()):
+            probs, top_ids = self._min_p_candidates(logits, self.n_vocab)
+        if self.min_p > 0.0:
+            probs = probs / probs.sum(dim=-1, keepdim=True)
+
+        # top-p: keep the smallest prefix whose mass reaches `top_p` (always keeping the most likely token)
+        if self.top_p < 1.0:
+            mass_before = probs.cumsum(dim=-1) - probs
+            probs = probs.masked_fill(mass_before >= self.top_p, 0.0)
+        return probs, top_ids
+
+    def distribution(self, logits: Tensor) -> Tensor:
+        """
+        Returns the (batch_size, V) distribution that `sample` draws from, given the current repetition counts. Used
+        by speculative decoding to compare the draft and target distributions.
+        """
+        probs, top_ids = self._filter(logits)
+        probs = probs / probs.sum(dim=-1, keepdim=True)  # top-p doesn't renormalize, multinomial doesn't need it
+        return torch.zeros_like(logits).scatter_(1, top_ids, probs)
+
+    def sample(self, logits: Tensor) -> Tensor:
+        """
+        Applies repetition penalty, temperature, min-p and top-p to (batch_size, V) logits, samples the next tokens and
+        adds them to the repetition counts.
+
+        Returns:
+            (batch_size, 1) token ids
+        """
+        probs, top_ids = self._filter(logits)
+        idx = torch.multinomial(probs, num_samples=1, generator=self.generator)  # (batch_size, 1)
+        next_token = top_ids.gather(-1, idx)
+        self.observe(next_token)
+        return next_token
@@ -0,0 +1,446 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from itertools import count
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .cfg_policy import T3CFGPolicy
+from .paged_cache import T3PagedCacheStats, T3PagedKVCache
+from .sampler import T3Sampler
+from .t3_hf_backend import T3HuggingfaceBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+_request_ids = count()
+
+
+@dataclass(eq=False)
+class T3Request:
+    """
+    A text to decode with `T3Scheduler`, with its own sampling parameters. `future` resolves to the (1, num_tokens)
+    speech tokens, as returned by `T3.inference`; `text_positions` is then set as with its `return_text_positions`.
+    """
+    t3_cond: T3Cond
+    text_tokens: Tensor  # (T,), including the start / stop text tokens
+    max_new_tokens: int = 1000
+    temperature: float = 0.8
+    top_p: float = 0.95
+    min_p: float = 0.05
+    repetition_penalty: float = 1.2
+    cfg_weight: float = 0.5
+    generator: Optional[torch.Generator] = None
+    cfg_policy: Optional[T3CFGPolicy] = None
+    request_id: int = field(default_factory=lambda: next(_request_ids))
+    future: Future = field(default_factory=Future, repr=False)
+    text_positions: Optional[List[int]] = field(default=None, repr=False)
+
+    # decoding state, owned by the scheduler
+    prompt_embeds: Optional[Tensor] = field(default=None, repr=False)
+    len_cond: int = field(default=0, repr=False)
+    length: int = field(default=0, repr=False)
+    guided: bool = field(default=True, repr=False)
+    tokens: List[int] = field(default_factory=list, repr=False)
+    hidden: Optional[Tensor] = field(default=None, repr=False)
+    sampler: Optional[T3Sampler] = field(default=None, repr=False)
+    analyzer: Optional[AlignmentStreamAnalyzer] = field(default=None, repr=False)
+    cancel_requested: bool = field(default=False, repr=False)
+
+    @property
+    def n_rows(self):
+        return 2 if self.cfg_weight > 0.0 and self.guided else 1
+
+    @property
+    def seq_ids(self):
+        "KV cache sequences of the request's rows"
+        return [(self.request_id, k) for k in range(self.n_rows)]
+
+    def cancel(self):
+        "Cancels the request: a queued request is dropped, a running one leaves the batch at the next step."
+        self.cancel_requested = True
+        self.future.cancel()
+
+    def result(self, timeout=None) -> Tensor:
+        return self.future.result(timeout)
+
+
+@dataclass
+class T3SchedulerMetrics:
+    queue_depth: int
+    active_requests: int
+    active_rows: int
+    tokens_per_sec: float
+    total_tokens: int
+    completed_requests: int
+    cancelled_requests: int
+    preempted_requests: int
+    kv_cache: T3PagedCacheStats
+
+
+class T3Scheduler:
+    """
+    Continuous (iteration-level) batching of T3 decoding: requests join the running batch at step boundaries and
+    leave it as soon as they finish, so that short lines don't wait for long ones and the batch stays full.
+        * every request decodes one sequence (two with CFG: conditional, then unconditional) with its own length,
+          positions, sampler and `AlignmentStreamAnalyzer`. A `T3CFGPolicy` can drop the unconditional sequence part
+          way through, freeing its KV cache blocks.
+        * KV states live in a `T3PagedKVCache` shared by all requests: blocks are taken as sequences grow, and returned
+          as soon as they finish. If the pool runs out, the most recently admitted request is preempted: its blocks
+          are freed, and it restarts from its prompt once there is room again.
+        * a joining request is prefilled on its own; then one forward per step decodes every active request
+
+    Requests are decoded on a background thread; `submit` is thread-safe.
+
+    NOTE: `kv_tokens` sets the size of the pool in positions (~240 KB per position in fp32 for the 500M model). A
+    preempted request resumes sampling with its generator where it left off, so seeded results can differ.
+    """
+
+    def __init__(
+        self,
+        t3: 'T3',
+        *,
+        max_rows: int = 8,
+        kv_tokens: int = 8192,
+        block_size: int = 16,
+        dtype: Optional[torch.dtype] = None,
+        metrics_window: float = 10.0,
+    ):
+        self.t3 = t3
+        self.hp = t3.hp
+        self.max_rows = max_rows
+        self.dtype = dtype or t3.speech_emb.weight.dtype
+        self.cache = T3PagedKVCache(
+            t3.cfg, n_blocks=kv_tokens // block_size, block_size=block_size, device=t3.device, dtype=self.dtype,
+        )
+        self.backend = T3HuggingfaceBackend(
+            config=t3.cfg,
+            llama=t3.tfmr,
+            speech_enc=t3.speech_emb,
+            speech_head=t3.speech_head,
+        )
+
+        self.queue: deque = deque()
+        self.active: List[T3Request] = []
+        self._lock = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self.metrics_window = metrics_window
+        self._token_times: deque = deque()  # (timestamp, n_tokens) per step
+        self.total_tokens = 0
+        self.completed_requests = 0
+        self.cancelled_requests = 0
+        self.preempted_requests = 0
+
+    @property
+    def n_active_rows(self):
+        return sum(req.n_rows for req in self.active)
+
+    def submit(self, t3_cond: T3Cond, text_tokens: Tensor, **kwargs) -> T3Request:
+        "Queues a request (see `T3Request` for the sampling parameters) and returns it."
+        req = T3Request(t3_cond=t3_cond, text_tokens=text_tokens.view(-1), **kwargs)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("scheduler is shut down")
+            self.queue.append(req)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="T3Scheduler", daemon=True)
+                self._thread.start()
+            self._lock.notify()
+        return req
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def metrics(self) -> T3SchedulerMetrics:
+        with self._lock:
+            now = time.perf_counter()
+            while self._token_times and now - self._token_times[0][0] > self.metrics_window:
+                self._token_times.popleft()
+            n_tokens = sum(n for _, n in self._token_times)
+            elapsed = now - self._token_times[0][0] if self._token_times else 0.0
+            kv_cache = self.cache.stats()
+            return T3SchedulerMetrics(
+                queue_depth=len(self.queue),
+                active_requests=len(self.active),
+                active_rows=self.n_active_rows,
+                tokens_per_sec=n_tokens / elapsed if elapsed > 0 else 0.0,
+                total_tokens=self.total_tokens,
+                completed_requests=self.completed_requests,
+                cancelled_requests=self.cancelled_requests,
+                preempted_requests=self.preempted_requests,
+                kv_cache=kv_cache,
+            )
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped and not self.queue and not self.active:
+                    self._lock.wait()
+                if self._stopped:
+                    break
+            try:
+                with torch.inference_mode():
+                    self.step()
+            except Exception as e:
+                logger.exception("T3 scheduler step failed")
+                with self._lock:
+                    failed, self.active = self.active, []
+                for req in failed:
+                    self._release(req)
+                    req.future.set_exception(e)
+
+        for req in self.active + list(self.queue):
+            self._release(req)
+            if not req.future.done():
+                req.future.set_exception(CancelledError())
+
+    def step(self):
+        "Admits queued requests, samples one token for every active request, retires finished ones and decodes."
+        self._admit()
+        if not self.active:
+            return
+
+        # Sample the next token of every request, from the last hidden states of its rows
+        next_tokens = []
+        for req in self.active:
+            logits = req.sampler.logits(req.hidden, req.cfg_weight)
+            if req.analyzer is not None:
+                last_token = req.tokens[-1] if req.tokens else self.hp.start_speech_token
+                logits = req.analyzer.step(logits, next_token=last_token)
+            next_tokens.append(req.sampler.sample(logits))
+        next_tokens = torch.cat(next_tokens)  # (n_requests, 1)
+
+        finished = []
+        for req, token in zip(self.active, next_tokens.view(-1).tolist()):  # single host sync
+            req.tokens.append(token)
+            if token == self.hp.stop_speech_token or len(req.tokens) >= req.max_new_tokens or req.cancel_requested:
+                finished.append(req)
+            elif req.n_rows > 1 and req.cfg_policy is not None:
+                if not req.cfg_policy.keep_guidance(len(req.tokens), req.analyzer):
+                    self._stop_guidance(req)
+        with self._lock:
+            self._token_times.append((time.perf_counter(), len(next_tokens)))
+            self.total_tokens += len(next_tokens)
+
+        self._retire(finished)
+        self._reserve_step()
+        if self.active:
+            self._decode()
+
+    def _admit(self):
+        while True:
+            with self._lock:
+                if not self.queue or self.n_active_rows + self.queue[0].n_rows > self.max_rows:
+                    return
+                req = self.queue[0]
+
+            # NOTE: preempted requests are already running
+            if not req.future.running() and not req.future.set_running_or_notify_cancel():
+                self._dequeue(req)
+                self.cancelled_requests += 1
+                continue
+            if req.cancel_requested:
+                self._dequeue(req)
+                self._finish(req)
+                continue
+
+            try:
+                if req.prompt_embeds is None:
+                    req.prompt_embeds, req.len_cond = self.t3.prepare_prompt_embeds(
+                        t3_cond=req.t3_cond,
+                        text_tokens=req.text_tokens,
+                        cfg_weight=req.cfg_weight,
+                    )
+                # room for the prompt and the first generated token of every row
+                prompt_len = req.prompt_embeds.size(1)
+                n_blocks = req.n_rows * self.cache.blocks_needed(prompt_len + 1)
+                if n_blocks > self.cache.allocator.n_blocks:
+                    raise ValueError(f"prompt of {prompt_len} tokens doesn't fit the KV cache")
+                if n_blocks > self.cache.allocator.n_free:
+                    return
+                self._dequeue(req)
+                self._prefill(req)
+            except Exception as e:
+                self._dequeue(req)
+                self._release(req)
+                req.future.set_exception(e)
+                continue
+            with self._lock:
+                self.active.append(req)
+
+    def _dequeue(self, req: T3Request):
+        with self._lock:
+            if self.queue and self.queue[0] is req:
+                self.queue.popleft()
+
+    def _prefill(self, req: T3Request):
+        t3 = self.t3
+        embeds = req.prompt_embeds.to(self.dtype)
+        prompt_len = embeds.size(1)
+
+        req.tokens = []
+        req.sampler = T3Sampler(
+            t3.speech_head.weight,
+            self.hp,
+            temperature=req.temperature,
+            top_p=req.top_p,
+            min_p=req.min_p,
+            repetition_penalty=req.repetition_penalty,
+            generator=req.generator,
+        )
+        req.sampler.observe(torch.tensor([self.hp.start_speech_token], device=t3.device))  # BOS
+
+        if self.hp.is_multilingual:
+            text_len = req.text_tokens.size(0)
+            req.analyzer = AlignmentStreamAnalyzer(
+                t3.tfmr,
+                None,
+                text_tokens_slice=(req.len_cond, req.len_cond + text_len),
+                alignment_layer_idx=9,
+                eos_idx=self.hp.stop_speech_token,
+                batch_idx=0,
+            )
+
+        # Only this request's analyzer listens to its prefill
+        for other in self.active:
+            if other.analyzer is not None:
+                other.analyzer.batch_idx = None
+
+        for seq_id in req.seq_ids:
+            assert self.cache.reserve(seq_id, prompt_len)
+        positions = torch.arange(prompt_len, device=t3.device)
+        self.cache.select(req.seq_ids, positions.expand(req.n_rows, -1), prompt_len)
+        mask = torch.full((prompt_len, prompt_len), torch.finfo(self.dtype).min, dtype=self.dtype, device=t3.device)
+        mask = mask.triu_(1)[None, None].expand(req.n_rows, 1, -1, -1)
+        output = self.backend(
+            inputs_embeds=embeds,
+            past_key_values=self.cache,
+            attention_mask=mask,
+            position_ids=positions.expand(req.n_rows, -1),
+            cache_position=positions,
+            use_cache=True,
+            return_dict=True,
+            compute_logits=False,
+        )
+        req.hidden = output.hidden_states[-1][:, -1]  # (n_rows, dim)
+        req.length = prompt_len
+
+    def _reserve_step(self):
+        "Reserves a position for the next token of every row, preempting the newest requests if the pool runs out."
+        i = 0
+        while i < len(self.active):
+            req = self.active[i]
+            if all(self.cache.reserve(seq_id, req.length + 1) for seq_id in req.seq_ids):
+                i += 1
+            elif len(self.active) == 1:
+                # can't grow even on its own: stop here
+                logger.warning(f"request {req.request_id}: KV cache full, stopping at {len(req.tokens)} tokens")
+                self._retire([req])
+            else:
+                self._preempt(self.active[-1])
+
+    def _preempt(self, req: T3Request):
+        logger.info(f"KV cache full, preempting request {req.request_id}")
+        with self._lock:
+            self.active.remove(req)
+            self.queue.appendleft(req)
+            self.preempted_requests += 1
+        for seq_id in req.seq_ids:
+            self.cache.free(seq_id, evicted=True)
+        self._close(req)
+        req.guided = True
+
+    def _stop_guidance(self, req: T3Request):
+        "Drops the unconditional row of a request, and its KV cache blocks."
+        self.cache.free(req.seq_ids[1])
+        req.guided = False
+        req.hidden = req.hidden[:1]
+
+    def _decode(self):
+        "One forward over every active request, with their latest tokens."
+        t3 = self.t3
+        device = t3.device
+        seq_ids, row_tokens, row_speech_pos, row_lengths = [], [], [], []
+        for req in self.active:
+            if req.analyzer is not None:
+                req.analyzer.batch_idx = len(seq_ids)
+            seq_ids += req.seq_ids
+            row_tokens += [req.tokens[-1]] * req.n_rows
+            row_speech_pos += [len(req.tokens)] * req.n_rows
+            row_lengths += [req.length] * req.n_rows
+        n_rows = len(seq_ids)
+
+        tokens = torch.tensor(row_tokens, device=device)
+        speech_pos = torch.tensor(row_speech_pos, device=device)
+        embeds = t3.speech_emb.weight[tokens] + t3.speech_pos_emb.emb.weight[speech_pos]  # (n_rows, dim)
+
+        positions = torch.tensor(row_lengths, device=device)[:, None]  # (n_rows, 1)
+        read_len = max(row_lengths) + 1
+        self.cache.select(seq_ids, positions, read_len)
+        cols = torch.arange(read_len, device=device)
+        mask = torch.zeros(n_rows, 1, 1, read_len, dtype=self.dtype, device=device)
+        mask.masked_fill_((cols > positions)[:, None, None], torch.finfo(self.dtype).min)
+
+        output = self.backend(
+            inputs_embeds=embeds[:, None].to(self.dtype),
+            past_key_values=self.cache,
+            attention_mask=mask,
+            position_ids=positions,
+            cache_position=positions[0],
+            return_dict=True,
+            compute_logits=False,
+        )
+        hidden = output.hidden_states[-1][:, -1]  # (n_rows, dim)
+        row = 0
+        for req in self.active:
+            req.hidden = hidden[row:row + req.n_rows]
+            req.length += 1
+            row += req.n_rows
+
+    def _retire(self, finished: List[T3Request]):
+        if not finished:
+            return
+        with self._lock:
+            self.active = [req for req in self.active if req not in finished]
+        for req in finished:
+            self._finish(req)
+
+    def _finish(self, req: T3Request):
+        if req.analyzer is not None:
+            req.text_positions = req.analyzer.positions[:len(req.tokens)]
+        self._release(req)
+        if req.cancel_requested:
+            self.cancelled_requests += 1
+            req.future.set_exception(CancelledError())
+        else:
+            self.completed_requests += 1
+            req.future.set_result(torch.tensor([req.tokens], dtype=torch.long, device=self.t3.device))
+
+    def _close(self, req: T3Request):
+        "Drops the decoding state of a request, keeping its prompt embeddings."
+        if req.analyzer is not None:
+            req.analyzer.close()
+            req.analyzer = None
+        req.hidden = None
+        req.sampler = None
+
+    def _release(self, req: T3Request):
+        "Drops all the state of a request, including its KV cache blocks."
+        for seq_id in req.seq_ids:
+            self.cache.free(seq_id)
+        self._close(req)
+        req.prompt_embeds = None
@@ -0,0 +1,193 @@
+import logging
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+
+from .cfg_policy import T3CFGPolicy
+from .decode_engine import T3DecodeEngine
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+def speculative_sample(probs: Tensor, draft_probs: Tensor, draft_token: int,
+                       generator: Optional[torch.Generator] = None) -> Tuple[int, bool]:
+    """
+    Speculative sampling of one position: `draft_token`, drawn from the (1, V) `draft_probs`, is accepted with
+    probability `min(1, p / q)`; otherwise a replacement is sampled from `max(0, p - q)`. Either way, the returned
+    token follows the (1, V) `probs`. Returns the token and whether the draft was accepted.
+    """
+    ratio = probs[0, draft_token] / draft_probs[0, draft_token]
+    if bool(torch.rand(1, generator=generator, device=probs.device) < ratio):
+        return draft_token, True
+    # the residual is only empty if p == q, up to rounding
+    residual = (probs - draft_probs).clamp_(min=0)
+    if residual.sum() > 0:
+        probs = residual
+    return int(torch.multinomial(probs, num_samples=1, generator=generator)), False
+
+
+class T3SpeculativeDecodeEngine(T3DecodeEngine):
+    """
+    Self-speculative T3 decoding: the first `draft_layers` layers of the same transformer, followed by its final norm
+    and `speech_head`, draft up to `n_draft_tokens` tokens one at a time. The full model then scores all of them in a
+    single forward, and speculative sampling accepts a prefix of the drafts:
+        * draft token `d` is accepted with probability `min(1, p(d) / q(d))`, where `q` and `p` are the draft and full
+          model distributions, after CFG, repetition penalty, temperature, min-p / top-p and the alignment checks
+        * at the first rejection, the replacement token is sampled from `max(0, p - q)`, normalized. If every draft is
+          accepted, one more token is sampled from the last `p`.
+      Generated tokens follow the distribution of `T3DecodeEngine`, but not its samples for a given seed.
+        * the draft layers write into the static KV cache of the full model: for accepted tokens they compute the same
+          key / value states as the full forward, which overwrites the drafted positions anyway
+        * with CFG, both rows are drafted and verified. The alignment analyzer only sees the verification forward, and
+          is stepped once per generated token, in order, so its state never includes rejected drafts.
+
+    NOTE: acceptance is decided on the host, so unlike `T3DecodeEngine` this syncs with the device for every token.
+    The gain comes from replacing up to `n_draft_tokens + 1` full forwards by one.
+    """
+
+    def __init__(self, t3: 'T3', backend: 'T3HuggingfaceBackend', *, draft_layers: int, n_draft_tokens: int = 4,
+                 **kwargs):
+        super().__init__(t3, backend, **kwargs)
+        assert 0 < draft_layers < len(t3.tfmr.layers)
+        self.tfmr = t3.tfmr
+        self.draft_layers = draft_layers
+        self.n_draft_tokens = n_draft_tokens
+        self.cache_cols = torch.arange(self.cache.key_cache[0].size(2), device=t3.device)
+        self.min_dtype = torch.finfo(self.step_embeds.dtype).min
+
+        self.n_drafted = 0
+        self.n_accepted = 0
+        self.n_verify_steps = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.n_accepted / self.n_drafted if self.n_drafted else 0.0
+
+    def _mask(self, cache_position: Tensor) -> Tensor:
+        "(B, 1, S, L) additive mask, causal up to each of the S query positions."
+        mask = torch.zeros(len(cache_position), len(self.cache_cols), dtype=self.step_embeds.dtype,
+                           device=cache_position.device)
+        mask.masked_fill_(self.cache_cols > cache_position[:, None], self.min_dtype)
+        return mask[None, None].expand(self.batch_size, -1, -1, -1)
+
+    def _embed(self, start: int, n: int) -> Tensor:
+        "(B, n, dim) input embeddings of generated tokens `start..start+n-1` (0 is BOS), for every batch row."
+        tokens = self.tokens[0, start:start + n]
+        embeds = self.speech_emb_table[tokens] + self.speech_pos_table[start:start + n]
+        return embeds[None].expand(self.batch_size, -1, -1)
+
+    def draft_forward(self, inputs_embeds: Tensor, cache_position: Tensor) -> Tensor:
+        "Runs the first `draft_layers` layers (writing their KV cache), and returns the normed last hidden states."
+        position_ids = cache_position[None].expand(self.batch_size, -1)
+        position_embeddings = self.tfmr.rotary_emb(inputs_embeds, position_ids)
+        mask = self._mask(cache_position)
+        hidden_states = inputs_embeds
+        for layer in self.tfmr.layers[:self.draft_layers]:
+            hidden_states = layer(
+                hidden_states,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_value=self.cache,
+                use_cache=True,
+                cache_position=cache_position,
+                position_embeddings=position_embeddings,
+            )[0]
+        return self.tfmr.norm(hidden_states[:, -1])  # (B, dim)
+
+    def draft(self, n_tokens: int, n_draft: int, sampler: T3Sampler, cfg_weight: float):
+        """
+        Drafts `n_draft` tokens after the `n_tokens` generated so far, writing them into `tokens`. Returns the list of
+        (1, V) draft distributions.
+        """
+        counts = sampler.counts.clone()
+        draft_probs = []
+        for j in range(n_draft):
+            i = n_tokens + j  # the input token, 0 being BOS
+            cache_position = torch.full((1,), self.prompt_len - 1 + i, device=self.tokens.device)
+            hidden_states = self.draft_forward(self._embed(i, 1), cache_position)
+            probs = sampler.distribution(sampler.logits(hidden_states, cfg_weight))
+            token = torch.multinomial(probs, num_samples=1, generator=sampler.generator)  # (1, 1)
+            sampler.observe(token)
+            self.tokens[:, i + 1:i + 2].copy_(token)
+            draft_probs.append(probs)
+        sampler.counts = counts
+        return draft_probs
+
+    def verify(self, n_tokens: int, n_draft: int) -> Tensor:
+        "Full forward over the last generated token and the drafts; returns the (B, n_draft + 1, dim) hidden states."
+        start = self.prompt_len - 1 + n_tokens
+        cache_position = torch.arange(start, start + n_draft + 1, device=self.tokens.device)
+        output = self.backend(
+            inputs_embeds=self._embed(n_tokens, n_draft + 1),
+            past_key_values=self.cache,
+            attention_mask=self._mask(cache_position),
+            cache_position=cache_position,
+            return_dict=True,
+            compute_logits=False,
+        )
+        return output.hidden_states[-1]
+
+    def _generate(self, output, sampler: T3Sampler, stop_on_eos: bool, cfg_weight: float,
+                  cfg_policy: Optional[T3CFGPolicy]):
+        generator = sampler.generator
+        device = self.tokens.device
+
+        # The first token is sampled from the prefill, as usual
+        logits = sampler.logits(output.hidden_states[-1][:, -1, :], cfg_weight)
+        if self.analyzer is not None:
+            logits = self.analyzer.step(logits, next_token=self.hp.start_speech_token)
+        token = sampler.sample(logits)
+        self.record_token(0, token)
+        n_tokens = 1
+        done = stop_on_eos and token.item() == self.stop_token
+
+        while not done and n_tokens < self.max_new_tokens:
+            self.update_guidance(n_tokens, cfg_policy)
+
+            # leave room for the token sampled after the drafts
+            n_draft = min(self.n_draft_tokens, self.max_new_tokens - n_tokens - 1)
+
+            # Draft with the truncated model. The analyzer ignores these forwards.
+            if self.analyzer is not None:
+                self.analyzer.batch_idx = None
+            draft_probs = self.draft(n_tokens, n_draft, sampler, cfg_weight)
+            if self.analyzer is not None:
+                self.analyzer.batch_idx = 0
+            drafts = self.tokens[0, n_tokens + 1:n_tokens + 1 + n_draft].tolist()
+
+            hidden_states = self.verify(n_tokens, n_draft)
+            self.n_verify_steps += 1
+            self.n_drafted += n_draft
+
+            for j in range(n_draft + 1):
+                logits = sampler.logits(hidden_states[:, j], cfg_weight)
+                if self.analyzer is not None:
+                    prev_token = int(self.tokens[0, n_tokens])
+                    logits = self.analyzer.step(logits, next_token=prev_token, query_idx=j)
+                probs = sampler.distribution(logits)  # (1, V)
+
+                if j < n_draft:
+                    token, accepted = speculative_sample(probs, draft_probs[j], drafts[j], generator)
+                    self.n_accepted += accepted
+                else:
+                    token, accepted = int(torch.multinomial(probs, num_samples=1, generator=generator)), False
+
+                sampler.observe(torch.tensor([token], device=device))
+                self.tokens[0, n_tokens + 1] = token
+                n_tokens += 1
+                if (stop_on_eos and token == self.stop_token) or n_tokens == self.max_new_tokens:
+                    done = True
+                if done or not accepted:
+                    break
+
+        logger.info(
+            f"speculative decoding: {n_tokens} tokens in {self.n_verify_steps + 1} full forwards, "
+            f"{self.acceptance_rate:.0%} of {self.n_drafted} drafts accepted"
+        )
+        predicted = self.tokens[:, 1:n_tokens + 1]
+        if stop_on_eos and predicted[0, -1] == self.stop_token:
+            logger.info(f"✅ EOS token detected! Stopping generation at step {predicted.size(1)}")
+        return predicted
@@ -74,35 +74,51 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.LongTensor]=None,
+        cache_position: Optional[torch.LongTensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
+        num_logits_to_keep: int=0,
+        compute_logits=True,
     ):
         """
         This is a method used by huggingface's generate() method.
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
-        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given
+        without `cache_position`, S should be 1.
+        :param attention_mask: optional 2D (B, L) or 4D (B, 1, S, L) mask; with a `StaticCache`, L is the cache length.
+        :param cache_position: (S,) positions of the inputs in the cache, required to write into a `StaticCache`.
+        :param output_hidden_states: return the hidden states of every layer. Otherwise only the (normed) output of
+        the final layer is returned, as a 1-tuple, which is all that decoding needs.
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions to logits (0 keeps all).
+        :param compute_logits: if False, `logits` is None and the caller projects the returned hidden states itself
+        (eg `T3Sampler`, which only needs the valid speech vocabulary).
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        if cache_position is None:
+            # positions are inferred from the cache contents, which only works for single-token steps
+            is_large_input = inputs_embeds.size(1) != 1
+            has_cache = past_key_values is not None and len(past_key_values) > 0
+            assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim)
 
-        logits = self.speech_head(hidden_states)
+        logits = self.speech_head(hidden_states[:, -num_logits_to_keep:, :]) if compute_logits else None
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
@@ -111,6 +127,6 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         return CausalLMOutputWithCrossAttentions(
             logits=logits,
             past_key_values=tfmr_out.past_key_values,
-            hidden_states=tfmr_out.hidden_states,
+            hidden_states=tfmr_out.hidden_states if output_hidden_states else (hidden_states,),
             attentions=tfmr_out.attentions,
         )
@@ -1,16 +1,15 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
+import threading
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
 
-from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import TopPLogitsWarper, RepetitionPenaltyLogitsProcessor, MinPLogitsWarper
+from transformers import LlamaModel, LlamaConfig, StaticCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -19,6 +18,11 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.decode_engine import T3DecodeEngine
+from .inference.speculative_decode_engine import T3SpeculativeDecodeEngine
+from .inference.batch_decode_engine import T3BatchDecodeEngine
+from .inference.prefix_cache import T3PrefixCache, prefix_key
+from .inference.cfg_policy import T3CFGPolicy
 from ..utils import AttrDict
 
 
@@ -69,10 +73,40 @@ class T3(nn.Module):
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
         self.compiled = False
 
+        # KV states of the conditioning prefix, per (voice, exaggeration)
+        self.prefix_cache = T3PrefixCache()
+        self.alignment_stream_analyzer: Optional[AlignmentStreamAnalyzer] = None  # reused by `inference`
+        # `inference` reuses the static cache and analyzer above, and `inference_batch` hooks the transformer layers,
+        # so generations are serialized. Use `T3Scheduler` to decode concurrent requests together.
+        self._inference_lock = threading.Lock()
+
     @property
     def device(self):
         return self.speech_head.weight.device
 
+    def get_static_cache(self, batch_size: int, max_cache_len: int, dtype: torch.dtype) -> StaticCache:
+        """
+        Returns a `StaticCache` with room for at least `max_cache_len` positions. The cache of the previous generation
+        is reused when it is large enough, so long generations don't reallocate their KV memory.
+
+        NOTE: the cache is not zeroed; stale entries are excluded by the attention mask built in `inference`.
+        """
+        cache = getattr(self, "_static_cache", None)
+        if cache is not None:
+            k = cache.key_cache[0]
+            if k.size(0) == batch_size and k.size(2) >= max_cache_len and k.dtype == dtype and k.device == self.device:
+                return cache
+
+        self._static_cache = None  # release the old buffers before allocating
+        self._static_cache = StaticCache(
+            config=self.cfg,
+            batch_size=batch_size,
+            max_cache_len=max_cache_len,
+            device=self.device,
+            dtype=dtype,
+        )
+        return self._static_cache
+
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
@@ -82,16 +116,14 @@ class T3(nn.Module):
                 self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
-    def prepare_input_embeds(
+    def prepare_text_speech_embeds(
         self,
         *,
-        t3_cond: T3Cond,
         text_tokens: torch.LongTensor,
         speech_tokens: torch.LongTensor,
         cfg_weight: float = 0.0,
     ):
-        # prepare input embeddings (skip backbone tranformer embeddings)
-        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        "Embeds the text and speech tokens, ie everything after the conditioning. (B, len_text + len_speech, dim)"
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0:
             text_emb[1].zero_()  # CFG uncond
@@ -100,18 +132,54 @@ class T3(nn.Module):
         if self.hp.input_pos_emb == "learned":
             text_emb = text_emb + self.text_pos_emb(text_tokens)
             speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        return torch.cat((text_emb, speech_emb), dim=1)
+
+    def prepare_input_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        speech_tokens: torch.LongTensor,
+        cfg_weight: float = 0.0,
+    ):
+        # prepare input embeddings (skip backbone tranformer embeddings)
+        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        text_speech_emb = self.prepare_text_speech_embeds(
+            text_tokens=text_tokens,
+            speech_tokens=speech_tokens,
+            cfg_weight=cfg_weight,
+        )
         len_cond = cond_emb.size(1)
 
-        if cond_emb.size(0) != text_emb.size(0):
-             cond_emb = cond_emb.expand(text_emb.size(0), -1, -1)
+        if cond_emb.size(0) != text_speech_emb.size(0):
+             cond_emb = cond_emb.expand(text_speech_emb.size(0), -1, -1)
 
         # concat
-        embeds = torch.stack([
-            torch.cat((ce, te, se))
-            for ce, te, se in zip(cond_emb, text_emb, speech_emb)
-        ])  # (B, length, dim)
+        embeds = torch.cat((cond_emb, text_speech_emb), dim=1)  # (B, length, dim)
         return embeds, len_cond
 
+    def prepare_prompt_embeds(self, *, t3_cond: T3Cond, text_tokens: Tensor, cfg_weight: float = 0.0):
+        """
+        Embeds the full decoding prompt of a single text: conditioning, text, and the two BOS tokens that `inference`
+        feeds in.
+
+        Args:
+            text_tokens: (T,) text tokens, including the start / stop text tokens
+        Returns:
+            (2 or 1, T0, dim) embeddings, with the CFG unconditional row second if `cfg_weight > 0`; and len_cond
+        """
+        n_rows = 2 if cfg_weight > 0.0 else 1
+        text_tokens = text_tokens.to(dtype=torch.long, device=self.device)[None].expand(n_rows, -1)
+        bos_token = torch.full((n_rows, 1), self.hp.start_speech_token, dtype=torch.long, device=self.device)
+        embeds, len_cond = self.prepare_input_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            speech_tokens=bos_token,
+            cfg_weight=cfg_weight,
+        )
+        bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+        return torch.cat([embeds, bos_embed], dim=1), len_cond
+
     def forward(
         self,
         *,
@@ -227,168 +295,268 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+        generator: Optional[torch.Generator]=None,
+        use_prefix_cache=True,
+        draft_layers=0,
+        n_draft_tokens=4,
+        cfg_policy: Optional[T3CFGPolicy]=None,
+        return_text_positions=False,
     ):
         """
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            generator: optional RNG used for sampling, so that seeding a request doesn't touch the global RNG state.
+            use_prefix_cache: reuse the KV states of the conditioning prefix across generations with the same voice
+                and exaggeration (see `T3PrefixCache`).
+            draft_layers: if > 0, decode speculatively, drafting `n_draft_tokens` at a time with the first
+                `draft_layers` transformer layers (see `T3SpeculativeDecodeEngine`).
+            cfg_policy: when to stop running the unconditional row, see `T3CFGPolicy`.
+            return_text_positions: also return the text position that the alignment analyzer tracked for each
+                generated token, as a list, or None without an analyzer (ie for non-multilingual models).
+
+        NOTE: with `cfg_weight > 0`, `text_tokens` holds the same text twice, for the conditional and unconditional
+        rows. Without CFG, a single row is decoded.
+
+        NOTE: the static KV cache, alignment analyzer and prefix cache are shared by every call, so concurrent calls
+        (eg from several threads) wait for each other; see `T3Scheduler` to decode them in one batch instead.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        if cfg_weight > 0.0:
+            assert text_tokens.size(0) == 2, "CFG needs the text tokens of the conditional and unconditional rows"
+        else:
+            text_tokens = text_tokens[:1]
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
             initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
-            cfg_weight=cfg_weight,
-        )
+        with self._inference_lock:
+            # Prepare custom input embeds. With a cached conditioning prefix, only the text and speech are embedded, and
+            # the prefix KV states are copied into the cache instead of being recomputed.
+            prefix = key = None
+            if use_prefix_cache:
+                key = prefix_key(t3_cond, self.speech_emb.weight.dtype)
+                prefix = self.prefix_cache.get(key)
+            if prefix is not None:
+                embeds = self.prepare_text_speech_embeds(
+                    text_tokens=text_tokens,
+                    speech_tokens=initial_speech_tokens,
+                    cfg_weight=cfg_weight,
+                )
+                len_cond = prefix.length
+            else:
+                embeds, len_cond = self.prepare_input_embeds(
+                    t3_cond=t3_cond,
+                    text_tokens=text_tokens,
+                    speech_tokens=initial_speech_tokens,
+                    cfg_weight=cfg_weight,
+                )
 
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
+            # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
+            # Note the llama-specific logic. Other tfmr types can be added later.
+
+            self.compiled = False
+
+            # TODO? synchronize the expensive compile function
+            # with self.compile_lock:
+            if not self.compiled:
+                # Default to None for English models, only create for multilingual
+                alignment_stream_analyzer = None
+                if self.hp.is_multilingual:
+                    # The analyzer is reused across generations; its hooks are removed when generation ends (see below)
+                    text_tokens_slice = (len_cond, len_cond + text_tokens.size(-1))
+                    query_offset = len_cond if prefix is not None else 0
+                    alignment_stream_analyzer = self.alignment_stream_analyzer
+                    if alignment_stream_analyzer is None:
+                        alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                            self.tfmr,
+                            None,
+                            text_tokens_slice=text_tokens_slice,
+                            query_offset=query_offset,
+                            alignment_layer_idx=9, # TODO: hparam or something?
+                            eos_idx=self.hp.stop_speech_token,
+                        )
+                        self.alignment_stream_analyzer = alignment_stream_analyzer
+                    else:
+                        alignment_stream_analyzer.reset(text_tokens_slice, query_offset=query_offset)
+                    assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
+
+                patched_model = T3HuggingfaceBackend(
+                    config=self.cfg,
+                    llama=self.tfmr,
+                    speech_enc=self.speech_emb,
+                    speech_head=self.speech_head,
+                    alignment_stream_analyzer=alignment_stream_analyzer,
+                )
+                self.patched_model = patched_model
+                self.compiled = True
+
+            # # Run normal generate method, which calls our custom extended methods
+            # return self.patched_model.generate(
+            #     inputs=initial_speech_tokens,
+            #     decoder_cond=embeds,
+            #     bos_token_id=self.hp.start_speech_token,
+            #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
+            #     pad_token_id=self.hp.stop_speech_token,
+            #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
+            #     num_return_sequences=num_return_sequences,
+            #     temperature=temperature,
+            #     min_p=min_p,
+            #     length_penalty=length_penalty,
+            #     repetition_penalty=repetition_penalty,
+            #     do_sample=do_sample,
+            #     # cache_implementation=None if not self.compiled else "static",
+            # )
+
+            device = embeds.device
+            max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+
+            bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
+            bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
+            bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
+
+            # batch_size=2 for CFG
+            bos_embed = bos_embed.expand(embeds.size(0), -1, -1)
+
+            # Combine condition and BOS token for the initial input
+            inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
+
+            engine_kwargs = dict(
+                batch_size=inputs_embeds.size(0),
+                prompt_len=(prefix.length if prefix is not None else 0) + inputs_embeds.size(1),
+                max_new_tokens=max_new_tokens,
+                dtype=inputs_embeds.dtype,
+            )
+            if draft_layers > 0:
+                engine = T3SpeculativeDecodeEngine(
+                    self, self.patched_model, draft_layers=draft_layers, n_draft_tokens=n_draft_tokens, **engine_kwargs,
+                )
+            else:
+                engine = T3DecodeEngine(self, self.patched_model, **engine_kwargs)
+            self.decode_engine = engine  # eg for the speculative decoding stats
+            try:
+                predicted_tokens = engine.generate(
+                    inputs_embeds,
+                    prefix=prefix,
+                    stop_on_eos=stop_on_eos,
+                    temperature=temperature,
+                    top_p=top_p,
+                    min_p=min_p,
+                    repetition_penalty=repetition_penalty,
+                    cfg_weight=cfg_weight,
+                    generator=generator,
+                    cfg_policy=cfg_policy,
+                )  # shape: (1, num_tokens)
+            finally:
+                if alignment_stream_analyzer is not None:
+                    alignment_stream_analyzer.close()
+
+            if key is not None and prefix is None:
+                self.prefix_cache.put(key, engine.capture_prefix(len_cond))
+            if return_text_positions:
+                text_positions = None
+                if alignment_stream_analyzer is not None:
+                    text_positions = alignment_stream_analyzer.positions[:predicted_tokens.size(1)]
+                return predicted_tokens, text_positions
+            return predicted_tokens
 
-        self.compiled = False
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_conds: Union[T3Cond, List[T3Cond]],
+        text_tokens: Tensor,
+        text_token_lens: Tensor,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        generator: Optional[torch.Generator]=None,
+    ) -> List[Tensor]:
+        """
+        Generates speech tokens for several independent texts at once, eg the lines of an audiobook, with a single
+        transformer forward per step for all of them (see `T3BatchDecodeEngine`).
 
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
+        Args:
+            t3_conds: conditioning per text, or one shared by all of them
+            text_tokens: (N, T) right-padded text tokens, each sequence including its start / stop text tokens
+            text_token_lens: (N,) unpadded lengths
+        Returns:
+            list of N (1, num_tokens) speech token tensors, as returned by `inference`
 
-            patched_model = T3HuggingfaceBackend(
+        NOTE: waits for any `inference` running in another thread, as they hook the same transformer layers.
+        """
+        _ensure_BOT_EOT(text_tokens, self.hp)
+        text_tokens = text_tokens.to(dtype=torch.long, device=self.device)
+        n_seqs = text_tokens.size(0)
+        if isinstance(t3_conds, T3Cond):
+            t3_conds = [t3_conds] * n_seqs
+        assert len(t3_conds) == n_seqs
+        cfg = cfg_weight > 0.0
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+
+        # Embed every sequence on its own
+        seq_embeds, text_slices = [], []
+        for t3_cond, tokens, n_text in zip(t3_conds, text_tokens, text_token_lens.tolist()):
+            embeds, len_cond = self.prepare_prompt_embeds(
+                t3_cond=t3_cond,
+                text_tokens=tokens[:n_text],
+                cfg_weight=cfg_weight,
+            )
+            seq_embeds.append(embeds)
+            text_slices.append((len_cond, len_cond + n_text))
+
+        # Left-pad, with rows [cond_0, .., cond_N-1, uncond_0, .., uncond_N-1]
+        prompt_lens = [e.size(1) for e in seq_embeds]
+        prompt_len = max(prompt_lens)
+        inputs_embeds = seq_embeds[0].new_zeros(n_seqs * (2 if cfg else 1), prompt_len, self.dim)
+        for n, embeds in enumerate(seq_embeds):
+            for k in range(embeds.size(0)):
+                inputs_embeds[k * n_seqs + n, prompt_len - embeds.size(1):] = embeds[k]
+
+        with self._inference_lock:
+            analyzers = [None] * n_seqs
+            if self.hp.is_multilingual:
+                analyzers = [
+                    AlignmentStreamAnalyzer(
+                        self.tfmr,
+                        None,
+                        text_tokens_slice=(i + prompt_len - n, j + prompt_len - n),
+                        alignment_layer_idx=9,
+                        eos_idx=self.hp.stop_speech_token,
+                        batch_idx=row,
+                    )
+                    for row, ((i, j), n) in enumerate(zip(text_slices, prompt_lens))
+                ]
+
+            backend = T3HuggingfaceBackend(
                 config=self.cfg,
                 llama=self.tfmr,
                 speech_enc=self.speech_emb,
                 speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
             )
-            self.patched_model = patched_model
-            self.compiled = True
-
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     min_p=min_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input
-        inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]                
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
-                break
-
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
+            engine = T3BatchDecodeEngine(
+                self,
+                backend,
+                prompt_lens=prompt_lens,
+                cfg=cfg,
+                max_new_tokens=max_new_tokens,
+                dtype=inputs_embeds.dtype,
+                analyzers=analyzers,
+            )
+            return engine.generate(
+                inputs_embeds,
+                stop_on_eos=stop_on_eos,
+                temperature=temperature,
+                top_p=top_p,
+                min_p=min_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+                generator=generator,
             )
-            # Update the kv_cache.
-            past = output.past_key_values
-
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
@@ -1,5 +1,6 @@
 import logging
 import json
+import re
 
 import torch
 from pathlib import Path
@@ -311,3 +312,32 @@ class MTLTokenizer:
         txt = self.tokenizer.decode(seq, skip_special_tokens=False)
         txt = txt.replace(' ', '').replace(SPACE, ' ').replace(EOT, '').replace(UNK, '')
         return txt
+
+    def word_spans(self, seq, words=None):
+        """
+        Groups encoded text tokens into words, which are separated by SPACE tokens. Special tokens, eg start / stop and
+        the language token, don't belong to any word. Returns a list of `(word, start, end)`, where `seq[start:end]`
+        are the tokens of the word.
+
+        The words are decoded from their tokens, ie lowercased and normalized, unless `words` is given with as many
+        entries, eg the whitespace-split input text.
+        NOTE: languages written without spaces (Chinese, Japanese) yield one word per space-separated segment.
+        """
+        if isinstance(seq, torch.Tensor):
+            seq = seq.view(-1).tolist()
+
+        spans = []
+        start = None
+        for idx, token_id in enumerate(seq + [None]):
+            token = self.tokenizer.id_to_token(token_id) if token_id is not None else None
+            boundary = token is None or re.fullmatch(r"\[[^\[\]]+\]", token) is not None
+            if boundary and start is not None:
+                spans.append((self.decode(seq[start:idx]).strip(), start, idx))
+                start = None
+            elif not boundary and start is None:
+                start = idx
+
+        spans = [span for span in spans if span[0]]
+        if words is not None and len(words) == len(spans):
+            spans = [(word, start, end) for word, (_, start, end) in zip(words, spans)]
+        return spans
@@ -3,6 +3,7 @@ from functools import lru_cache
 from scipy import signal
 import numpy as np
 import librosa
+import torch
 
 
 @lru_cache()
@@ -76,3 +77,44 @@ def _normalize(s, hp, headroom_db=15):
     min_level_db = 20 * np.log10(hp.stft_magnitude_min)
     s = (s - min_level_db) / (-min_level_db + headroom_db)
     return s
+
+
+@lru_cache()
+def mel_basis_torch(hp, device) -> torch.Tensor:
+    "`mel_basis` as a tensor on `device`, built once per device."
+    return torch.from_numpy(mel_basis(hp)).to(device)
+
+
+@lru_cache()
+def stft_window(hp, device) -> torch.Tensor:
+    "Hann window of `win_size` samples, centered in `n_fft` like librosa pads it."
+    window = torch.hann_window(hp.win_size, device=device)
+    if hp.win_size < hp.n_fft:
+        window = torch.nn.functional.pad(window, ((hp.n_fft - hp.win_size) // 2, (hp.n_fft - hp.win_size + 1) // 2))
+    return window
+
+
+def melspectrogram_torch(wav: torch.Tensor, hp, pad=True) -> torch.Tensor:
+    """
+    `melspectrogram` with torch ops, on the device of `wav`; returns (..., M, T) float32 for a (..., L) `wav`.
+    """
+    wav = wav.float()
+    if hp.preemphasis > 0:
+        wav = torch.cat([wav[..., :1], wav[..., 1:] - hp.preemphasis * wav[..., :-1]], dim=-1).clamp(-1, 1)
+
+    batch_shape = wav.shape[:-1]
+    spec_magnitudes = torch.stft(
+        wav.reshape(-1, wav.size(-1)), hp.n_fft, hp.hop_size, window=stft_window(hp, wav.device),
+        center=pad, pad_mode="reflect", return_complex=True,
+    ).abs()
+    spec_magnitudes = spec_magnitudes.reshape(*batch_shape, *spec_magnitudes.shape[1:])
+    if hp.mel_power != 1.0:
+        spec_magnitudes = spec_magnitudes ** hp.mel_power
+
+    mel = mel_basis_torch(hp, wav.device) @ spec_magnitudes
+    if hp.mel_type == "db":
+        mel = 20 * torch.log10(mel.clamp(min=hp.stft_magnitude_min))
+    if hp.normalized_mels:
+        min_level_db = 20 * np.log10(hp.stft_magnitude_min)
+        mel = (mel - min_level_db) / (-min_level_db + 15)
+    return mel
@@ -1,5 +1,6 @@
 # Adapted from https://github.com/CorentinJ/Real-Time-Voice-Cloning
 # MIT License
+from collections import defaultdict
 from typing import List, Union, Optional
 
 import numpy as np
@@ -10,7 +11,7 @@ import torch.nn.functional as F
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import melspectrogram_torch
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -33,20 +34,18 @@ def pack(arrays, seq_len: int=None, pad_value=0):
     if isinstance(arrays[0], list):
         arrays = [np.array(array) for array in arrays]
 
-    # Convert to tensor and handle device
-    device = None
+    # Convert to tensors, on the device of the first one
     if isinstance(arrays[0], torch.Tensor):
         tensors = arrays
-        device = tensors[0].device
     else:
         tensors = [torch.as_tensor(array) for array in arrays]
 
-    # Fill the packed tensor with the array data
-    packed_shape = (len(tensors), seq_len, *tensors[0].shape[1:])
-    packed_tensor = torch.full(packed_shape, pad_value, dtype=tensors[0].dtype, device=device)
-
-    for i, tensor in enumerate(tensors):
-        packed_tensor[i, :tensor.size(0)] = tensor
+    # Pad to the longest in a single op, then to `seq_len`
+    packed_tensor = nn.utils.rnn.pad_sequence(tensors, batch_first=True, padding_value=pad_value)
+    if packed_tensor.size(1) < seq_len:
+        pad_shape = (len(tensors), seq_len - packed_tensor.size(1), *tensors[0].shape[1:])
+        pad = packed_tensor.new_full(pad_shape, pad_value)
+        packed_tensor = torch.cat([packed_tensor, pad], dim=1)
 
     return packed_tensor
 
@@ -175,28 +174,26 @@ class VoiceEncoder(nn.Module):
         # Possibly pad the mels to reach the target lengths
         len_diff = max(target_lens) - mels.size(1)
         if len_diff > 0:
-            pad = torch.full((mels.size(0), len_diff, self.hp.num_mels), 0, dtype=torch.float32)
-            mels = torch.cat((mels, pad.to(mels.device)), dim=1)
+            mels = F.pad(mels, (0, 0, 0, len_diff))
 
-        # Group all partials together so that we can batch them easily
-        partials = [
-            mel[i * frame_step: i * frame_step + self.hp.ve_partial_frames]
-            for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
-        ]
-        assert all(partials[0].shape == partial.shape for partial in partials)
-        partials = torch.stack(partials)
+        # Group all partials together so that we can batch them easily: the windows of every mel are views of it, of
+        # which the first `n_partial` ones are kept, in utterance order
+        windows = mels.unfold(1, self.hp.ve_partial_frames, frame_step).transpose(2, 3)  # (B, W, P, M)
+        n_partials = torch.tensor(n_partials, device=mels.device)
+        is_partial = torch.arange(windows.size(1), device=mels.device) < n_partials[:, None]
+        partials = windows[is_partial]
 
         # Forward the partials
         n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
-        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
+        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0)
 
         # Reduce the partial embeds into full embeds and L2-normalize them
-        slices = np.concatenate(([0], np.cumsum(n_partials)))
-        raw_embeds = [torch.mean(partial_embeds[start:end], dim=0) for start, end in zip(slices[:-1], slices[1:])]
-        raw_embeds = torch.stack(raw_embeds)
+        utt_idxs = torch.repeat_interleave(torch.arange(len(n_partials), device=mels.device), n_partials)
+        raw_embeds = partial_embeds.new_zeros(len(n_partials), partial_embeds.size(1))
+        raw_embeds = raw_embeds.index_add_(0, utt_idxs, partial_embeds) / n_partials[:, None]
         embeds = raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
 
-        return embeds
+        return embeds.cpu()
 
     @staticmethod
     def utt_to_spk_embed(utt_embeds: np.ndarray):
@@ -269,6 +266,15 @@ class VoiceEncoder(nn.Module):
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
-
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+        # Mels on the device; wavs of the same length share a STFT
+        mels = [None] * len(wavs)
+        by_length = defaultdict(list)
+        for i, wav in enumerate(wavs):
+            by_length[len(wav)].append(i)
+        for idxs in by_length.values():
+            batch = torch.from_numpy(np.stack([wavs[i] for i in idxs])).to(self.device)
+            for i, mel in zip(idxs, melspectrogram_torch(batch, self.hp).transpose(1, 2)):
+                mels[i] = mel
+        mel_lens = [len(mel) for mel in mels]
+
+        return self.embeds_from_mels(pack(mels), mel_lens, as_spk=as_spk, batch_size=batch_size, **kwargs)
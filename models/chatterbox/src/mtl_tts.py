@@ -1,23 +1,38 @@
+from bisect import bisect_left
+from collections import OrderedDict
 from dataclasses import dataclass
+import hashlib
+from itertools import accumulate
+import json
+import logging
 from pathlib import Path
 import os
+import threading
+from typing import Iterator, List, Optional, Tuple
 
-import librosa
 import torch
 # import perth
 import torch.nn.functional as F
-from safetensors.torch import load_file as load_safetensors
+from safetensors import safe_open
+from safetensors.torch import load_file as load_safetensors, save_file as save_safetensors
 from huggingface_hub import snapshot_download
 
 from .models.t3 import T3
+from .models.t3.inference.scheduler import T3Scheduler
+from .models.t3.inference.cfg_policy import T3CFGPolicy
 from .models.t3.modules.t3_config import T3Config
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3tokenizer import S3_SR, S3_TOKEN_RATE, drop_invalid_tokens
+from .models.s3gen import S3GEN_SR, S3Gen, FLOW_PRESETS
+from .models.s3gen.batcher import S3GenBatcher
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
+from .models.voice_encoder.voice_encoder import pack
+from .models.audio_frontend import ReferenceFrontend
 from .models.t3.modules.cond_enc import T3Cond
 
 
+logger = logging.getLogger(__name__)
+
 REPO_ID = "ResembleAI/chatterbox"
 
 # Supported languages for the multilingual model
@@ -90,6 +105,32 @@ def punc_norm(text: str) -> str:
     return text
 
 
+@dataclass
+class WordTimestamp:
+    "A word of the generated text, with its start and end times in seconds."
+    word: str
+    start: float
+    end: float
+
+
+def word_timestamps(word_spans, text_positions: List[int]) -> List[WordTimestamp]:
+    """
+    Times the words of the text from the text position of every speech token, as tracked by the alignment analyzer
+    (see `AlignmentStreamAnalyzer`); speech tokens come at `S3_TOKEN_RATE` per second of audio.
+
+    A word starts with the first token aligned at or past its first text token, and ends where the alignment moves
+    past its last one. The alignment may step back, so the positions are made monotonic first. Words that were never
+    reached, eg if generation stopped early, get empty intervals at the end of the audio.
+    """
+    reached = list(accumulate(text_positions, max))
+    timestamps = []
+    for word, start, end in word_spans:
+        t0 = bisect_left(reached, start)
+        t1 = max(bisect_left(reached, end), t0)
+        timestamps.append(WordTimestamp(word, t0 / S3_TOKEN_RATE, t1 / S3_TOKEN_RATE))
+    return timestamps
+
+
 @dataclass
 class Conditionals:
     """
@@ -129,6 +170,331 @@ class Conditionals:
         kwargs = torch.load(fpath, map_location=map_location, weights_only=True)
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
+    def save_safetensors(self, fpath, metadata: Optional[dict] = None):
+        """
+        Saves the tensors in safetensors format, which `load_safetensors` can memory-map. Non-tensor values (None and
+        scalars) and the string values of `metadata` go into the file header.
+        """
+        tensors, values = {}, {}
+        for section, fields in (("t3", self.t3.__dict__), ("gen", self.gen)):
+            for k, v in fields.items():
+                if torch.is_tensor(v):
+                    tensors[f"{section}.{k}"] = v.detach().cpu().contiguous()
+                else:
+                    values[f"{section}.{k}"] = v
+        header = {"values": json.dumps(values), **(metadata or {})}
+        save_safetensors(tensors, str(fpath), metadata=header)
+
+    @classmethod
+    def load_safetensors(cls, fpath, device="cpu") -> Tuple['Conditionals', dict]:
+        "Loads conditionals saved by `save_safetensors`, and returns them with the metadata of the file."
+        fields = {"t3": {}, "gen": {}}
+        with safe_open(str(fpath), framework="pt", device=str(device)) as f:
+            metadata = f.metadata() or {}
+            for name in f.keys():
+                section, k = name.split(".", 1)
+                fields[section][k] = f.get_tensor(name)
+        for name, v in json.loads(metadata.pop("values", "{}")).items():
+            section, k = name.split(".", 1)
+            fields[section][k] = v
+        return cls(T3Cond(**fields["t3"]), fields["gen"]), metadata
+
+    def with_exaggeration(self, exaggeration: float) -> 'Conditionals':
+        "The same voice with another exaggeration; tensors are shared, not copied."
+        if float(exaggeration) == float(self.t3.emotion_adv[0, 0, 0].item()):
+            return self
+        t3 = self.t3
+        return Conditionals(
+            T3Cond(
+                speaker_emb=t3.speaker_emb,
+                cond_prompt_speech_tokens=t3.cond_prompt_speech_tokens,
+                emotion_adv=exaggeration * torch.ones(1, 1, 1),
+            ).to(device=t3.speaker_emb.device),
+            self.gen,
+        )
+
+
+def conditionals_key(wav_fpath, *params) -> str:
+    """
+    Content hash of a reference audio file and of the parameters its conditionals depend on, so that a renamed or
+    copied file still hits, and an overwritten one misses.
+    """
+    h = hashlib.sha1(repr(params).encode())
+    with open(wav_fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checkpoint_version(ckpt_dir) -> str:
+    """
+    Identifies a checkpoint directory by its name (the commit hash for Hugging Face snapshots) and the names and sizes
+    of its files. The checkpoints are too large to hash their content at every start.
+    """
+    ckpt_dir = Path(ckpt_dir).resolve()
+    h = hashlib.sha1(ckpt_dir.name.encode())
+    for fpath in sorted(ckpt_dir.iterdir()):
+        if fpath.is_file():
+            h.update(f"{fpath.name}:{fpath.stat().st_size}".encode())
+    return h.hexdigest()[:16]
+
+
+class ConditionalsCache:
+    """
+    Bounded LRU of voice `Conditionals`, eg the handful of voices of an audiobook, so that every line doesn't decode
+    and embed its reference audio again. Entries are evicted least-recently-used first beyond `max_entries`.
+    The exaggeration isn't part of the key: entries are shared by all exaggerations of a voice, see `with_exaggeration`.
+
+    NOTE: cached conditionals are shared, and must not be modified in place.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Conditionals]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # `generate` may be called from several threads, see `enable_scheduler`
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[Conditionals]:
+        with self._lock:
+            conds = self.entries.get(key)
+            if conds is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return conds
+
+    def put(self, key: str, conds: Conditionals):
+        with self._lock:
+            self.entries[key] = conds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                logger.debug(f"evicted voice conditionals, {len(self.entries)} left")
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+class VoiceProfileStore:
+    """
+    Precomputed conditionals of the voices of a library directory, persisted in `directory` as one safetensors file
+    per voice, so that a restart doesn't decode and embed every reference audio again.
+
+    A profile is only used if it was computed from the same audio content and parameters (see `conditionals_key`) with
+    the same model checkpoint (`model_version`); otherwise it is recomputed and overwritten.
+    NOTE: only reference files inside `library` get profiles, eg not uploaded or temporary files.
+    """
+
+    def __init__(self, directory, library, model_version: str):
+        self.directory = Path(directory)
+        self.library = Path(library).resolve()
+        self.model_version = model_version
+        self.hits = 0
+        self.misses = 0
+
+    def covers(self, wav_fpath) -> bool:
+        return Path(wav_fpath).resolve().parent == self.library
+
+    def path(self, wav_fpath) -> Path:
+        return self.directory / (Path(wav_fpath).name + ".safetensors")
+
+    def load(self, wav_fpath, key: str, device="cpu") -> Optional[Conditionals]:
+        path = self.path(wav_fpath)
+        if path.exists():
+            try:
+                conds, metadata = Conditionals.load_safetensors(path, device=device)
+                if metadata.get("key") == key and metadata.get("model_version") == self.model_version:
+                    self.hits += 1
+                    return conds
+                logger.info(f"voice profile {path.name} is outdated, recomputing it")
+            except Exception as e:
+                logger.warning(f"could not load voice profile {path}: {e}")
+        self.misses += 1
+        return None
+
+    def save(self, wav_fpath, key: str, conds: Conditionals):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(wav_fpath)
+        # write then rename, so that a concurrent load never sees a partial file
+        tmp_path = path.with_name(path.name + ".tmp")
+        conds.save_safetensors(tmp_path, metadata={"key": key, "model_version": self.model_version})
+        os.replace(tmp_path, path)
+
+
+class VoiceIndex:
+    """
+    Speaker embeddings of the voices of a library, as one (N, E) matrix of L2-normalized voice encoder embeddings, so
+    that comparing voices with the whole library is a single matmul: closest voices (`search`), near duplicates
+    (`near_duplicates`), or distinct voices for the speakers of a script (`assign`).
+
+    The index is persisted to `fpath` and updated incrementally by `refresh`: only the files that were added or
+    modified since, according to their size and modification time, are embedded again. It is discarded if it was
+    computed with another model checkpoint (`model_version`).
+    NOTE: voices are identified by their file name, as in the library directory.
+    """
+
+    def __init__(self, fpath, model_version: str):
+        self.fpath = Path(fpath)
+        self.model_version = model_version
+        self.names: List[str] = []
+        self.stamps: List[str] = []
+        self.embeds = torch.zeros(0, 0)
+        # stamps of the files that couldn't be embedded, which are only retried once modified
+        self.failed = {}
+        # may be refreshed and searched from several threads
+        self._lock = threading.RLock()
+        self._load()
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def stamp(wav_fpath) -> str:
+        stat = os.stat(wav_fpath)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _load(self):
+        if not self.fpath.exists():
+            return
+        try:
+            with safe_open(str(self.fpath), framework="pt", device="cpu") as f:
+                metadata = f.metadata() or {}
+                if metadata.get("model_version") != self.model_version:
+                    logger.info(f"voice index {self.fpath.name} is outdated, recomputing it")
+                    return
+                self.embeds = f.get_tensor("embeds")
+            self.names = json.loads(metadata["names"])
+            self.stamps = json.loads(metadata["stamps"])
+        except Exception as e:
+            logger.warning(f"could not load voice index {self.fpath}: {e}")
+
+    def save(self):
+        self.fpath.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, as `VoiceProfileStore.save`
+        tmp_path = self.fpath.with_name(self.fpath.name + ".tmp")
+        metadata = {
+            "names": json.dumps(self.names),
+            "stamps": json.dumps(self.stamps),
+            "model_version": self.model_version,
+        }
+        save_safetensors({"embeds": self.embeds.contiguous()}, str(tmp_path), metadata=metadata)
+        os.replace(tmp_path, self.fpath)
+
+    def refresh(self, wav_fpaths, embed) -> Tuple[List[str], List[str]]:
+        """
+        Updates the index to the files `wav_fpaths`, embedding those which are new or were modified with `embed`, a
+        function of a list of files returning their (N, E) embeddings, eg `speaker_embeddings`. Files that can't be
+        embedded are left out until they are modified. Returns the names of the embedded files and of the removed ones.
+        """
+        with self._lock:
+            files = {Path(wav_fpath).name: (wav_fpath, self.stamp(wav_fpath)) for wav_fpath in wav_fpaths}
+            keep = [i for i, name in enumerate(self.names) if files.get(name, (None, None))[1] == self.stamps[i]]
+            kept = {self.names[i] for i in keep}
+            removed = [name for name in self.names if name not in files]
+            added = [name for name in files if name not in kept and self.failed.get(name) != files[name][1]]
+            if not added and not removed:
+                return [], []
+
+            new_embeds = None
+            if added:
+                try:
+                    new_embeds = embed([files[name][0] for name in added])
+                except Exception:
+                    # embed the files one by one, to leave out the ones that fail
+                    embedded, new_embeds = [], []
+                    for name in added:
+                        try:
+                            new_embeds.append(embed([files[name][0]]))
+                            embedded.append(name)
+                        except Exception as e:
+                            logger.warning(f"could not embed voice {name}: {e}")
+                            self.failed[name] = files[name][1]
+                    added = embedded
+                    new_embeds = torch.cat(new_embeds) if new_embeds else None
+
+            embeds = [self.embeds[keep]] if keep else []
+            if new_embeds is not None:
+                embeds.append(F.normalize(new_embeds.float().cpu(), dim=1))
+            self.embeds = torch.cat(embeds) if embeds else torch.zeros(0, 0)
+            self.names = [self.names[i] for i in keep] + added
+            self.stamps = [self.stamps[i] for i in keep] + [files[name][1] for name in added]
+            self.save()
+            logger.info(f"voice index: {len(added)} embedded, {len(removed)} removed, {len(self.names)} voices")
+            return added, removed
+
+    def similarities(self, embeds: torch.Tensor) -> torch.Tensor:
+        "(Q, N) cosine similarities of (Q, E) or (E,) embeddings with the voices of the index."
+        embeds = F.normalize(embeds.float().cpu().reshape(-1, embeds.size(-1)), dim=1)
+        with self._lock:
+            return embeds @ self.embeds.T
+
+    def search(self, embeds: torch.Tensor, k=5) -> List[List[Tuple[str, float]]]:
+        "The `k` closest voices to each embedding, as (name, cosine similarity) in decreasing similarity."
+        with self._lock:
+            names = self.names
+            if not names:
+                return [[] for _ in range(embeds.reshape(-1, embeds.size(-1)).size(0))]
+            scores, idxs = self.similarities(embeds).topk(min(k, len(names)), dim=1)
+        return [
+            [(names[i], score) for i, score in zip(row_idxs, row_scores)]
+            for row_idxs, row_scores in zip(idxs.tolist(), scores.tolist())
+        ]
+
+    def near_duplicates(self, threshold=0.95) -> List[Tuple[str, str, float]]:
+        "Pairs of voices with a cosine similarity of at least `threshold`, most similar first."
+        with self._lock:
+            names, embeds = self.names, self.embeds
+        scores = torch.triu(embeds @ embeds.T, diagonal=1)
+        pairs = torch.nonzero(scores >= threshold).tolist()
+        pairs = [(names[i], names[j], scores[i, j].item()) for i, j in pairs]
+        return sorted(pairs, key=lambda pair: -pair[2])
+
+    def assign(self, speakers: List[str], taken: Optional[List[str]] = None) -> dict:
+        """
+        Picks a voice for each speaker, eg the characters of an audiobook: a voice named after the speaker if there is
+        one, otherwise the voice least similar to those already picked and to the `taken` ones (eg the narrator), so
+        that speakers sound as distinct as the library allows. Voices are only reused once all have been picked.
+        """
+        with self._lock:
+            names, embeds = self.names, self.embeds
+        if not names:
+            return {}
+        by_stem = {Path(name).stem.lower(): name for name in names}
+        idx_of = {name: i for i, name in enumerate(names)}
+        picked = [idx_of[name] for name in taken or [] if name in idx_of]
+
+        voices = {}
+        for speaker in speakers:
+            if (name := by_stem.get(speaker.strip().lower())) is not None:
+                voices[speaker] = name
+                picked.append(idx_of[name])
+
+        scores = embeds @ embeds.T
+        for speaker in speakers:
+            if speaker in voices:
+                continue
+            unused = torch.ones(len(names), dtype=torch.bool)
+            unused[picked] = False
+            if not unused.any():
+                unused[:] = True
+            if picked:
+                # distance to the closest picked voice, maximized
+                distance = -scores[:, picked].max(dim=1).values
+            else:
+                # the most distinctive voice of the library
+                distance = -scores.mean(dim=1)
+            i = int(torch.where(unused, distance, float("-inf")).argmax())
+            voices[speaker] = names[i]
+            picked.append(i)
+        return voices
+
 
 class ChatterboxMultilingualTTS:
     ENC_COND_LEN = 6 * S3_SR
@@ -142,6 +508,7 @@ class ChatterboxMultilingualTTS:
         tokenizer: MTLTokenizer,
         device: str,
         conds: Conditionals = None,
+        model_version: Optional[str] = None,
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
@@ -150,6 +517,14 @@ class ChatterboxMultilingualTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.frontend = ReferenceFrontend(s3gen.tokenizer, ve.hp, device, self.ENC_COND_LEN, self.DEC_COND_LEN)
+        self.t3_scheduler: T3Scheduler = None
+        self.s3gen_batcher: Optional[S3GenBatcher] = None
+        self.conds_cache: Optional[ConditionalsCache] = None
+        self.voice_profiles: Optional[VoiceProfileStore] = None
+        self.voice_index: Optional[VoiceIndex] = None
+        # identifies the checkpoint, to invalidate voice profiles computed by another one
+        self.model_version = model_version
         # self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
@@ -188,7 +563,7 @@ class ChatterboxMultilingualTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice).to(device)
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        return cls(t3, s3gen, ve, tokenizer, device, conds=conds, model_version=checkpoint_version(ckpt_dir))
 
     @classmethod
     def from_pretrained(cls, device: torch.device) -> 'ChatterboxMultilingualTTS':
@@ -202,46 +577,162 @@ class ChatterboxMultilingualTTS:
             )
         )
         return cls.from_local(ckpt_dir, device)
-    
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+    def enable_scheduler(self, **kwargs) -> T3Scheduler:
+        """
+        Routes T3 decoding through a continuous batching `T3Scheduler`, so that concurrent `generate` calls (eg from
+        several threads) share decode steps. `kwargs` are passed to `T3Scheduler`.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3Scheduler(self.t3, **kwargs)
+        return self.t3_scheduler
+
+    def enable_s3gen_batching(self, **kwargs) -> S3GenBatcher:
+        """
+        Routes the token-to-wav of `generate` through a `S3GenBatcher`, so that concurrent calls (eg audiobook lines)
+        are vocoded together. `kwargs` are passed to `S3GenBatcher`.
+        """
+        if self.s3gen_batcher is None:
+            self.s3gen_batcher = S3GenBatcher(self.s3gen, **kwargs)
+        return self.s3gen_batcher
+
+    def enable_conds_cache(self, max_entries=32) -> ConditionalsCache:
+        """
+        Caches the conditionals of reference audio files by content (see `ConditionalsCache`), so that generating many
+        texts with the same `audio_prompt_path` prepares the voice only once.
+        """
+        if self.conds_cache is None:
+            self.conds_cache = ConditionalsCache(max_entries)
+        return self.conds_cache
+
+    def enable_voice_profiles(self, directory, library) -> VoiceProfileStore:
+        """
+        Persists the conditionals of the reference files in `library` to `directory` (see `VoiceProfileStore`), so
+        that they are loaded instead of recomputed, eg after a restart.
+        """
+        if self.voice_profiles is None:
+            self.voice_profiles = VoiceProfileStore(directory, library, self.model_version)
+        return self.voice_profiles
+
+    def enable_voice_index(self, fpath) -> VoiceIndex:
+        """
+        Keeps the speaker embeddings of a voice library in a `VoiceIndex` persisted to `fpath`, to search the library
+        for similar voices; see `refresh_voice_index`.
+        """
+        if self.voice_index is None:
+            self.voice_index = VoiceIndex(fpath, self.model_version)
+        return self.voice_index
+
+    def refresh_voice_index(self, wav_fpaths) -> Tuple[List[str], List[str]]:
+        "Updates the voice index to the library files `wav_fpaths`; returns the names of the embedded and removed ones."
+        return self.voice_index.refresh(wav_fpaths, self.speaker_embeddings)
+
+    def load_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        """
+        Conditionals of a reference audio file: from the in-memory cache or the voice profiles when enabled, without
+        decoding the audio, otherwise computed and then cached. Unlike `prepare_conditionals`, `self.conds` is unchanged.
+        """
+        key = None
+        if self.conds_cache is not None or self.voice_profiles is not None:
+            key = conditionals_key(
+                wav_fpath, self.ENC_COND_LEN, self.DEC_COND_LEN, self.t3.hp.speech_cond_prompt_len,
+                self.frontend.load_duration,
+            )
+        if self.conds_cache is not None and (conds := self.conds_cache.get(key)) is not None:
+            return conds.with_exaggeration(exaggeration)
+
+        profiles = self.voice_profiles
+        if profiles is not None and not profiles.covers(wav_fpath):
+            profiles = None
+        conds = profiles.load(wav_fpath, key, device=self.device) if profiles is not None else None
+        if conds is None:
+            conds = self._compute_conditionals(wav_fpath, exaggeration)
+            if profiles is not None:
+                profiles.save(wav_fpath, key, conds)
+
+        if self.conds_cache is not None:
+            self.conds_cache.put(key, conds)
+        return conds.with_exaggeration(exaggeration)
 
-        # Speech cond prompt tokens
-        t3_cond_prompt_tokens = None
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        self.conds = self.load_conditionals(wav_fpath, exaggeration=exaggeration)
+        return self.conds
+
+    def prepare_conditionals_batch(self, wav_fpaths, exaggeration=0.5, num_workers=8) -> List[Conditionals]:
+        """
+        Computes the conditionals of many reference files, eg to onboard a voice library: files are decoded in a thread
+        pool, their features computed by the `ReferenceFrontend`, then the x-vector, S3 tokenizer and voice encoder
+        passes run over the batch (see `S3Gen.embed_refs`). Unlike `prepare_conditionals`, the model state, including
+        `self.conds` and the caches, is unchanged.
+        """
+        if not wav_fpaths:
+            return []
+
+        wavs = self.frontend.load(wav_fpaths, num_workers=num_workers)
+        features = self.frontend(wavs)
+        s3gen_ref_dicts = self.s3gen.embed_refs(features)
+
+        # Speech cond prompt tokens, padded to the longest
+        t3_cond_prompt_tokens = [None] * len(features)
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
-
-        # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-        ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
+            tokens, token_lens = s3_tokzr.quantize_log_mels([f.prompt_log_mel for f in features], max_len=plen)
+            t3_cond_prompt_tokens = [tokens[i:i + 1, :n].to(self.device) for i, n in enumerate(token_lens.tolist())]
 
-        t3_cond = T3Cond(
-            speaker_emb=ve_embed,
-            cond_prompt_speech_tokens=t3_cond_prompt_tokens,
-            emotion_adv=exaggeration * torch.ones(1, 1, 1),
-        ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        # Voice-encoder speaker embeddings, one per reference
+        ve_embeds = self._ve_embeds([f.ve_mel for f in features])
 
-    def generate(
-        self,
-        text,
-        language_id,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-        repetition_penalty=2.0,
-        min_p=0.05,
-        top_p=1.0,
+        conds = []
+        for ve_embed, prompt_tokens, s3gen_ref_dict in zip(ve_embeds, t3_cond_prompt_tokens, s3gen_ref_dicts):
+            t3_cond = T3Cond(
+                speaker_emb=ve_embed[None].to(self.device),
+                cond_prompt_speech_tokens=prompt_tokens,
+                emotion_adv=exaggeration * torch.ones(1, 1, 1),
+            ).to(device=self.device)
+            conds.append(Conditionals(t3_cond, s3gen_ref_dict))
+        return conds
+
+    def _compute_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        return self.prepare_conditionals_batch([wav_fpath], exaggeration=exaggeration)[0]
+
+    def speaker_embeddings(self, wav_fpaths, num_workers=8) -> torch.Tensor:
+        """
+        (N, E) voice encoder embeddings of reference files, the `speaker_emb` of their conditionals, without the S3Gen
+        and S3 tokenizer passes. They are L2-normalized, so that their dot products are cosine similarities.
+        """
+        if not wav_fpaths:
+            return torch.zeros(0, self.ve.hp.speaker_embed_size)
+        wavs = self.frontend.load(wav_fpaths, num_workers=num_workers)
+        return self._ve_embeds(self.frontend.ve_mels(wavs))
+
+    def _ve_embeds(self, ve_mels) -> torch.Tensor:
+        ve_embeds = self.ve.embeds_from_mels(pack(ve_mels), mel_lens=[len(mel) for mel in ve_mels], rate=1.3)
+        return torch.from_numpy(ve_embeds)
+
+    @staticmethod
+    def _flow_params(flow_preset, n_timesteps, solver, flow_cfg_rate, flow_guidance_interval) -> dict:
+        "S3Gen flow matching parameters of `generate`"
+        if flow_preset not in FLOW_PRESETS:
+            raise ValueError(f"Unknown flow preset '{flow_preset}', expected one of {list(FLOW_PRESETS)}")
+        flow_params = dict(FLOW_PRESETS[flow_preset])
+        if n_timesteps is not None:
+            flow_params["n_timesteps"] = n_timesteps
+        if solver is not None:
+            flow_params["solver"] = solver
+        if flow_cfg_rate is not None:
+            flow_params["cfg_rate"] = flow_cfg_rate
+        if flow_guidance_interval is not None:
+            flow_params["guidance_interval"] = flow_guidance_interval
+        return flow_params
+
+    def _speech_tokens(
+        self, text, language_id, audio_prompt_path, exaggeration, cfg_weight, temperature, repetition_penalty, min_p,
+        top_p, generator, cfg_policy,
     ):
+        """
+        Decodes the speech tokens of `generate` with T3. Returns them, the conditionals, and the normalized text with
+        its tokens and the speech positions of the text tokens.
+        """
         # Validate language_id
         if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
             supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
@@ -250,24 +741,19 @@ class ChatterboxMultilingualTTS:
                 f"Supported languages: {supported_langs}"
             )
         
+        # NOTE: `conds` stays local, so that concurrent calls (see `enable_scheduler`) don't race on `self.conds`
         if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            conds = self.load_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
             assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
 
         # Update exaggeration if needed
-        if float(exaggeration) != float(self.conds.t3.emotion_adv[0, 0, 0].item()):
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+        conds = conds.with_exaggeration(exaggeration)
 
         # Norm and tokenize text
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text, language_id=language_id.lower() if language_id else None).to(self.device)
-        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
 
         sot = self.t3.hp.start_text_token
         eot = self.t3.hp.stop_text_token
@@ -275,16 +761,36 @@ class ChatterboxMultilingualTTS:
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
 
         with torch.inference_mode():
-            speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
-                text_tokens=text_tokens,
-                max_new_tokens=1000,  # TODO: use the value in config
-                temperature=temperature,
-                cfg_weight=cfg_weight,
-                repetition_penalty=repetition_penalty,
-                min_p=min_p,
-                top_p=top_p,
-            )
+            if self.t3_scheduler is not None:
+                request = self.t3_scheduler.submit(
+                    conds.t3,
+                    text_tokens[0],
+                    max_new_tokens=1000,  # TODO: use the value in config
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    generator=generator,
+                    cfg_policy=cfg_policy,
+                )
+                speech_tokens = request.result()
+                text_positions = request.text_positions
+            else:
+                speech_tokens, text_positions = self.t3.inference(
+                    t3_cond=conds.t3,
+                    # Need two seqs for CFG
+                    text_tokens=torch.cat([text_tokens, text_tokens], dim=0) if cfg_weight > 0.0 else text_tokens,
+                    max_new_tokens=1000,  # TODO: use the value in config
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    generator=generator,
+                    cfg_policy=cfg_policy,
+                    return_text_positions=True,
+                )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
 
@@ -292,10 +798,91 @@ class ChatterboxMultilingualTTS:
             speech_tokens = drop_invalid_tokens(speech_tokens)
             speech_tokens = speech_tokens.to(self.device)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
+        return speech_tokens, conds, text, text_tokens, text_positions
+
+    def generate(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        generator: Optional[torch.Generator] = None,
+        cfg_policy: Optional[T3CFGPolicy] = None,
+        return_word_timestamps=False,
+        flow_preset="standard",
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
+        flow_cfg_rate: Optional[float] = None,
+        flow_guidance_interval: Optional[Tuple[float, float]] = None,
+    ):
+        """
+        Returns the (1, N) waveform; with `return_word_timestamps`, also the list of `WordTimestamp` of the text, which
+        is empty if the model has no alignment analyzer.
+        `flow_preset` is one of the S3Gen `FLOW_PRESETS`, eg "draft" for previews, whose steps and ODE solver can be
+        overridden with `n_timesteps` and `solver`, and its classifier-free guidance with `flow_cfg_rate` (0 disables
+        it) and `flow_guidance_interval` (see `S3Token2Mel.forward`). `cfg_weight` is the guidance of T3.
+        """
+        flow_params = self._flow_params(flow_preset, n_timesteps, solver, flow_cfg_rate, flow_guidance_interval)
+        speech_tokens, conds, text, text_tokens, text_positions = self._speech_tokens(
+            text, language_id, audio_prompt_path, exaggeration, cfg_weight, temperature, repetition_penalty, min_p,
+            top_p, generator, cfg_policy,
+        )
+
+        with torch.inference_mode():
+            if self.s3gen_batcher is not None:
+                wav = self.s3gen_batcher.submit(speech_tokens, conds.gen, **flow_params).result()
+            else:
+                wav, _ = self.s3gen.inference(
+                    speech_tokens=speech_tokens,
+                    ref_dict=conds.gen,
+                    **flow_params,
+                )
             wav = wav.squeeze(0).detach().cpu().numpy()
             # watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(wav).unsqueeze(0)
+        wav = torch.from_numpy(wav).unsqueeze(0)
+
+        if return_word_timestamps:
+            words = []
+            if text_positions is not None:
+                word_spans = self.tokenizer.word_spans(text_tokens[0], words=text.split())
+                words = word_timestamps(word_spans, text_positions)
+            return wav, words
+        return wav
+
+    def generate_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        generator: Optional[torch.Generator] = None,
+        cfg_policy: Optional[T3CFGPolicy] = None,
+        flow_preset="standard",
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
+        flow_cfg_rate: Optional[float] = None,
+        flow_guidance_interval: Optional[Tuple[float, float]] = None,
+        **stream_kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """
+        `generate`, yielding the (1, N) waveform in pieces as S3Gen converts the speech tokens chunk by chunk, so that
+        playback can start after the first chunk (see `S3GenStreamer`, which `stream_kwargs` are passed to, eg
+        `chunk_tokens`). T3 still decodes all the speech tokens first.
+        """
+        flow_params = self._flow_params(flow_preset, n_timesteps, solver, flow_cfg_rate, flow_guidance_interval)
+        speech_tokens, conds, *_ = self._speech_tokens(
+            text, language_id, audio_prompt_path, exaggeration, cfg_weight, temperature, repetition_penalty, min_p,
+            top_p, generator, cfg_policy,
+        )
+        for wav in self.s3gen.stream(speech_tokens, conds.gen, **flow_params, **stream_kwargs):
+            yield wav.detach().cpu()
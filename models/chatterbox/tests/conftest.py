@@ -0,0 +1,93 @@
+"""
+Shared fixtures. Models are randomly initialized: the tests check the inference machinery, not the speech, so they run
+on CPU without checkpoints.
+"""
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.voice_encoder import VoiceEncoder
+from chatterbox.mtl_tts import ChatterboxMultilingualTTS, Conditionals
+
+
+# The 520M config with narrow heads and MLPs. It keeps the hidden size, which the perceiver resampler hardcodes, and
+# enough layers and heads for the alignment heads (see `LLAMA_ALIGNED_HEADS`).
+LLAMA_CONFIGS["Llama_tiny"] = dict(
+    LLAMA_520M_CONFIG_DICT,
+    intermediate_size=64,
+    num_hidden_layers=14,
+    head_dim=8,
+)
+
+
+def make_t3(seed=0) -> T3:
+    "A multilingual T3 with the tiny config"
+    torch.manual_seed(seed)
+    hp = T3Config.multilingual()
+    hp.llama_config_name = "Llama_tiny"
+    return T3(hp).eval()
+
+
+def make_t3_cond(t3: T3, seed=0, exaggeration=0.5) -> T3Cond:
+    "Conditionals as `ChatterboxMultilingualTTS.prepare_conditionals` builds them, with random contents"
+    g = torch.Generator().manual_seed(seed)
+    return T3Cond(
+        speaker_emb=torch.randn(1, t3.hp.speaker_embed_size, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, t3.hp.start_speech_token, (1, t3.hp.speech_cond_prompt_len), generator=g),
+        emotion_adv=exaggeration * torch.ones(1, 1, 1),
+    )
+
+
+def make_text_tokens(t3: T3, n_tokens: int, seed=0) -> torch.Tensor:
+    "(1, n_tokens + 2) random text tokens, with the start / stop text tokens"
+    g = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(3, 500, (n_tokens,), generator=g)
+    return torch.cat([torch.tensor([t3.hp.start_text_token]), tokens, torch.tensor([t3.hp.stop_text_token])])[None]
+
+
+def make_conditionals(t3: T3, seed=0, exaggeration=0.5) -> Conditionals:
+    "`Conditionals` with random contents, shaped as `S3Gen.embed_ref` returns them for a 10 s reference"
+    g = torch.Generator().manual_seed(seed)
+    gen = dict(
+        prompt_token=torch.randint(0, 6561, (1, 250), generator=g),
+        prompt_token_len=torch.tensor([250]),
+        prompt_feat=torch.randn(1, 500, 80, generator=g),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192, generator=g),
+    )
+    return Conditionals(make_t3_cond(t3, seed, exaggeration), gen)
+
+
+def write_reference(fpath, duration: float, sr: int, seed=0):
+    "Writes a synthetic reference clip: a vibrato tone with some noise"
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    f0 = 120 + 40 * seed
+    wav = 0.3 * np.sin(2 * np.pi * f0 * t * (1 + 0.1 * np.sin(3 * t))) + 0.02 * rng.standard_normal(len(t))
+    sf.write(str(fpath), wav.astype(np.float32), sr)
+    return fpath
+
+
+@pytest.fixture(scope="module")
+def t3():
+    return make_t3()
+
+
+@pytest.fixture(scope="module")
+def t3_cond(t3):
+    return make_t3_cond(t3)
+
+
+@pytest.fixture(scope="session")
+def tts():
+    "The multilingual model with random weights and without text tokenizer; S3Gen takes a few seconds to build"
+    torch.manual_seed(0)
+    return ChatterboxMultilingualTTS(
+        make_t3(), S3Gen().eval(), VoiceEncoder().eval(), None, "cpu", model_version="test",
+    )
@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import LLAMA_ALIGNED_HEADS
+
+from conftest import make_t3, make_t3_cond, make_text_tokens
+
+
+def n_hooks(t3):
+    return [len(t3.tfmr.layers[layer_idx].self_attn._forward_hooks) for layer_idx, _ in LLAMA_ALIGNED_HEADS]
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("return_text_positions", [False, True])
+def test_hooks_are_removed_after_each_generation(t3, t3_cond, return_text_positions):
+    assert sorted(layer_idx for layer_idx, _ in LLAMA_ALIGNED_HEADS) == [9, 12, 13]
+    for i in range(100):
+        text_tokens = make_text_tokens(t3, 4 + i % 8, seed=i).expand(2, -1)
+        out = t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=3,
+            return_text_positions=return_text_positions,
+        )
+        if return_text_positions:
+            tokens, positions = out
+            assert len(positions) == tokens.size(1)
+        assert n_hooks(t3) == [0, 0, 0], f"hooks left after generation {i}"
+
+
+@torch.inference_mode()
+def test_reused_analyzer_matches_a_fresh_one(t3, t3_cond):
+    text_tokens = make_text_tokens(t3, 12, seed=1).expand(2, -1)
+
+    def generate():
+        return t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=40,
+            generator=torch.Generator().manual_seed(0),
+            return_text_positions=True,
+        )
+
+    t3.inference(t3_cond=t3_cond, text_tokens=make_text_tokens(t3, 30).expand(2, -1), max_new_tokens=20)
+    reused = t3.alignment_stream_analyzer
+    assert reused is not None
+    tokens, positions = generate()
+    assert t3.alignment_stream_analyzer is reused
+
+    t3.alignment_stream_analyzer = None
+    fresh_tokens, fresh_positions = generate()
+    assert t3.alignment_stream_analyzer is not reused
+
+    assert torch.equal(tokens, fresh_tokens)
+    assert positions == fresh_positions
+    assert n_hooks(t3) == [0, 0, 0]
+
+
+@torch.inference_mode()
+def test_forward_is_causal_after_generation(t3, t3_cond):
+    "The aligned layers only output attentions while hooked: their eager attention has no mask in `T3.forward`"
+    speech_tokens = torch.randint(0, t3.hp.start_speech_token, (1, 20), generator=torch.Generator().manual_seed(0))
+
+    def speech_logits(model):
+        return model.forward(
+            t3_cond=make_t3_cond(model),
+            text_tokens=make_text_tokens(model, 10),
+            text_token_lens=torch.tensor([12]),
+            speech_tokens=speech_tokens,
+            speech_token_lens=torch.tensor([20]),
+        ).speech_logits
+
+    # the same weights, never used for generation
+    expected = speech_logits(make_t3())
+    t3.inference(t3_cond=t3_cond, text_tokens=make_text_tokens(t3, 8).expand(2, -1), max_new_tokens=5)
+    assert torch.equal(speech_logits(t3), expected)
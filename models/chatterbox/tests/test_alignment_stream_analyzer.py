@@ -0,0 +1,230 @@
+"""
+The incremental `AlignmentStreamAnalyzer.step` (running reductions over a preallocated alignment buffer) against the
+full-history implementation it replaced, kept below as `reference_step`, on seeded synthetic attention.
+"""
+import logging
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer, LLAMA_ALIGNED_HEADS
+
+
+EOS = 99
+N_VOCAB = 100
+N_HEADS = 16
+
+
+def reference_state():
+    return SimpleNamespace(
+        alignment=torch.zeros(0, 0), curr_frame_pos=0, text_position=0, started=False, started_at=None,
+        complete=False, completed_at=None, generated_tokens=[], positions=[],
+    )
+
+
+def reference_step(state, attns, logits, next_token, text_tokens_slice, query_offset=0, query_idx=None):
+    """
+    The previous `AlignmentStreamAnalyzer.step`, which reduced the whole alignment history every step. `attns` are
+    the full (T0, Ti) attention maps of the aligned heads. Returns the logits and the decisions of the step.
+
+    NOTE: with 5 text tokens or less, the previous repetition check reduced an empty tensor and raised; there are no
+    earlier tokens to check then, so it's False, as in the new implementation.
+    """
+    aligned_attn = torch.stack(attns).mean(dim=0)
+    i, j = text_tokens_slice
+    if state.curr_frame_pos == 0:
+        A_chunk = aligned_attn[j - query_offset:, i:j].clone()
+    else:
+        if query_idx is not None:
+            aligned_attn = aligned_attn[query_idx:query_idx + 1]
+        A_chunk = aligned_attn[:, i:j].clone()
+    A_chunk[:, state.curr_frame_pos + 1:] = 0
+
+    if state.alignment.numel() == 0:
+        state.alignment = A_chunk.new_zeros(0, j - i)
+    state.alignment = torch.cat((state.alignment, A_chunk), dim=0)
+    A = state.alignment
+    T, S = A.shape
+
+    cur_text_posn = A_chunk[-1].argmax()
+    discontinuity = not (-4 < cur_text_posn - state.text_position < 7)
+    if not discontinuity:
+        state.text_position = cur_text_posn
+
+    false_start = (not state.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
+    state.started = not false_start
+    if state.started and state.started_at is None:
+        state.started_at = T
+
+    state.complete = state.complete or state.text_position >= S - 3
+    if state.complete and state.completed_at is None:
+        state.completed_at = T
+
+    long_tail = state.complete and (A[state.completed_at:, -3:].sum(dim=0).max() >= 5)
+    repetition = state.complete and S > 5 and (A[state.completed_at:, :-5].max(dim=1).values.sum() > 5)
+
+    if next_token is not None:
+        if isinstance(next_token, torch.Tensor):
+            next_token = next_token.view(-1)[0].item()
+        state.generated_tokens = (state.generated_tokens + [next_token])[-8:]
+    token_repetition = len(state.generated_tokens) >= 3 and len(set(state.generated_tokens[-2:])) == 1
+
+    if cur_text_posn < S - 3 and S > 5:
+        logits[..., EOS] = -2**15
+    forced_eos = bool(long_tail or repetition or token_repetition)
+    if forced_eos:
+        logits = -(2**15) * torch.ones_like(logits)
+        logits[..., EOS] = 2**15
+
+    state.positions.append(int(state.text_position))
+    state.curr_frame_pos += 1
+    decisions = dict(
+        false_start=bool(false_start),
+        long_tail=bool(long_tail),
+        repetition=bool(repetition),
+        discontinuity=bool(discontinuity),
+        complete=state.complete,
+        position=int(state.text_position),
+        started=state.started,
+        forced_eos=forced_eos,
+    )
+    return logits, decisions
+
+
+class FakeAttention(nn.Module):
+    "Returns the attention weights set in `weights`, as `LlamaAttention` does with `output_attentions`"
+    def __init__(self):
+        super().__init__()
+        self.weights = None
+
+    def forward(self, x, output_attentions=False):
+        return x, self.weights, None
+
+
+class FakeTransformer(nn.Module):
+    def __init__(self, n_layers=14):
+        super().__init__()
+        self.layers = nn.ModuleList([nn.Module() for _ in range(n_layers)])
+        for layer in self.layers:
+            layer.self_attn = FakeAttention()
+
+    def forward(self, layer_weights):
+        "Runs the aligned layers with the given (B, H, q, L) attention weights, one per layer"
+        for layer_idx, weights in layer_weights.items():
+            self.layers[layer_idx].self_attn.weights = weights
+            self.layers[layer_idx].self_attn(torch.zeros(1))
+
+
+def synthetic_attention(g, q_rows, length, first_frame, i, S, mode):
+    """
+    (1, H, q_rows, length) attention weights: each frame attends to a text position that advances at `rate` tokens
+    per frame, with noise, and optionally jumps back (repetition) or lingers on the last tokens (long tail).
+    """
+    logits = 2 * torch.randn(1, N_HEADS, q_rows, length, generator=g)
+    for r in range(q_rows):
+        frame = first_frame + r
+        pos = min(int(frame * mode["rate"]), S - 1)
+        if mode["jump"] and frame > mode["jump"]:
+            pos = max(0, pos - S // 2)
+        logits[..., r, i + pos] += mode["peak"]
+        if mode["tail"] and frame > mode["tail"]:
+            logits[..., r, i + S - 2] += mode["peak"]
+    return torch.softmax(logits, dim=-1)
+
+
+def run_trial(seed, tfmr):
+    g = torch.Generator().manual_seed(seed)
+    rng = random.Random(seed)
+    len_cond = rng.randint(3, 40)
+    S = rng.choice([3, 4, 5, 6, 8, 20, 60])
+    query_offset = rng.choice([0, 0, len_cond])  # with a cached conditioning prefix, it isn't in the prefill
+    rate = rng.choice([0.2, 0.4, 1.0])
+    end_frame = int((S - 3) / rate) + 2  # the first frames after completion
+    mode = dict(
+        rate=rate, peak=rng.choice([2.0, 6.0, 12.0]), jump=rng.choice([0, 20, end_frame]), tail=rng.choice([0, 30]),
+    )
+    i, j = len_cond, len_cond + S
+    prompt_len = j + 1  # conditioning, text, BOS
+
+    analyzer = AlignmentStreamAnalyzer(tfmr, None, (i, j), eos_idx=EOS, query_offset=query_offset)
+    state = reference_state()
+    decisions = []
+    token, step, length = 5, 0, prompt_len
+    while step < 120:
+        # a prefill, single frames, and sometimes several frames in one forward, as `T3SpeculativeDecodeEngine` does
+        if step == 0:
+            q_rows = prompt_len - query_offset
+        else:
+            q_rows = rng.choice([1, 1, 1, 3])
+        length = length if step == 0 else length + q_rows
+        layer_weights = {
+            layer_idx: synthetic_attention(g, q_rows, length, step, i, S, mode)
+            for layer_idx, _ in LLAMA_ALIGNED_HEADS
+        }
+        tfmr(layer_weights)
+        attns = [layer_weights[layer_idx][0, head_idx] for layer_idx, head_idx in LLAMA_ALIGNED_HEADS]
+
+        query_idxs = [None] if step == 0 or q_rows == 1 else list(range(q_rows))
+        for query_idx in query_idxs:
+            logits = torch.randn(1, N_VOCAB, generator=g)
+            next_token = torch.tensor([token]) if step % 2 else token
+
+            expected_logits, expected = reference_step(
+                state, attns, logits.clone(), next_token, (i, j), query_offset=query_offset, query_idx=query_idx,
+            )
+            new_logits = analyzer.step(logits.clone(), next_token=next_token, query_idx=query_idx)
+            result = analyzer.last_result
+            actual = dict(
+                false_start=result.false_start,
+                long_tail=result.long_tail,
+                repetition=result.repetition,
+                discontinuity=result.discontinuity,
+                complete=result.complete,
+                position=result.position,
+                started=analyzer.started,
+                forced_eos=bool(new_logits[0, EOS] == 2**15),
+            )
+            assert torch.equal(new_logits, expected_logits), f"seed {seed}, step {step}"
+            assert actual == expected, f"seed {seed}, step {step}"
+            assert (analyzer.started_at, analyzer.completed_at) == (state.started_at, state.completed_at)
+            assert analyzer.positions == state.positions
+            decisions.append((S, expected))
+            step += 1
+
+            token = token if rng.random() < 0.02 else rng.randrange(EOS)
+            if expected["forced_eos"]:
+                break
+        if expected["forced_eos"]:
+            break
+
+    assert torch.allclose(analyzer.alignment, state.alignment)
+    analyzer.close()
+    return decisions
+
+
+@pytest.fixture(autouse=True)
+def quiet_analyzer():
+    "The analyzer logs a warning for every repetition and forced EOS"
+    logger = logging.getLogger("chatterbox.models.t3.inference.alignment_stream_analyzer")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    yield
+    logger.setLevel(level)
+
+
+def test_matches_reference_implementation():
+    tfmr = FakeTransformer()
+    seen = Counter()
+    for seed in range(200):
+        for S, decisions in run_trial(seed, tfmr):
+            seen["short text" if S <= 5 else "long text"] += 1
+            seen.update(name for name in ("false_start", "long_tail", "repetition", "forced_eos") if decisions[name])
+            seen.update(["complete"] if decisions["complete"] else [])
+
+    # every decision was exercised, on short texts too
+    for name in ("short text", "long text", "false_start", "long_tail", "repetition", "forced_eos", "complete"):
+        assert seen[name] > 0, name
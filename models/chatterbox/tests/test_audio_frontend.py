@@ -0,0 +1,118 @@
+"""
+`ReferenceFrontend` features against the path it replaced, kept below as `reference_features`: librosa decoding and
+resampling, and the spectrograms of S3Gen, of the S3 tokenizer and of the voice encoder computed separately.
+"""
+import librosa
+import numpy as np
+import pytest
+import torch
+
+from chatterbox.models.audio_frontend import ReferenceFrontend, prefix_power_spectrograms, trim_silence
+from chatterbox.models.s3gen.const import S3GEN_SR
+from chatterbox.models.s3gen.s3gen import get_resampler
+from chatterbox.models.s3gen.utils.mel import mel_spectrogram
+from chatterbox.models.s3gen.xvector import extract_feature
+from chatterbox.models.s3tokenizer import S3_SR, S3Tokenizer
+from chatterbox.models.voice_encoder import VoiceEncConfig
+from chatterbox.models.voice_encoder.melspec import melspectrogram
+
+from conftest import write_reference
+
+
+ENC_COND_LEN = 6 * S3_SR
+DEC_COND_LEN = 10 * S3GEN_SR
+
+
+@pytest.fixture(scope="module")
+def frontend():
+    return ReferenceFrontend(S3Tokenizer("speech_tokenizer_v2_25hz"), VoiceEncConfig(), "cpu", ENC_COND_LEN, DEC_COND_LEN)
+
+
+def reference_features(wav_fpath, s3_tokenizer, ve_hp) -> dict:
+    "The features as `prepare_conditionals`, `S3Gen.embed_ref` and `VoiceEncoder.embeds_from_wavs` computed them"
+    wav_24 = librosa.load(wav_fpath, sr=S3GEN_SR)[0]
+    wav_16 = librosa.resample(wav_24, orig_sr=S3GEN_SR, target_sr=S3_SR)
+    ref_wav_24 = torch.from_numpy(wav_24[:DEC_COND_LEN])[None]
+    ref_wav_16 = get_resampler(S3GEN_SR, S3_SR, "cpu")(ref_wav_24)
+    return dict(
+        wav_24=wav_24,
+        wav_16=torch.from_numpy(wav_16),
+        prompt_feat=mel_spectrogram(ref_wav_24).transpose(1, 2),
+        ref_wav_16=ref_wav_16,
+        xvector_fbank=extract_feature([ref_wav_16[0]])[0],
+        ref_log_mel=s3_tokenizer.log_mel_spectrogram(ref_wav_16[0]),
+        prompt_log_mel=s3_tokenizer.log_mel_spectrogram(torch.from_numpy(wav_16[:ENC_COND_LEN])),
+        ve_mel=torch.from_numpy(melspectrogram(librosa.effects.trim(wav_16, top_db=20)[0], ve_hp).T),
+    )
+
+
+# Clips up to 10 s, which are decoded whole: see `test_partial_decode` for longer ones
+@pytest.mark.parametrize("duration,sr", [(8, 24000), (4.3, 44100), (2.05, 16000), (10, 22050)])
+def test_matches_reference_features(frontend, tmp_path, duration, sr):
+    fpath = write_reference(tmp_path / "ref.wav", duration, sr, seed=int(duration))
+    expected = reference_features(fpath, frontend.s3_tokenizer, frontend.ve_hp)
+    wav_24 = frontend.load([fpath])[0]
+    features = frontend([wav_24])[0]
+
+    # the 24 kHz signal, and everything computed from the 10 s crop with the torchaudio resampler, is unchanged
+    assert np.array_equal(wav_24, expected["wav_24"])
+    assert torch.equal(features.prompt_feat, expected["prompt_feat"])
+    assert torch.equal(features.ref_wav_16, expected["ref_wav_16"])
+    assert torch.equal(extract_feature([features.ref_wav_16[0]])[0], expected["xvector_fbank"])
+    assert torch.equal(features.ref_log_mel, expected["ref_log_mel"])
+
+    # The T3 prompt and the voice encoder used the librosa resampler, they now use the torchaudio one. The two differ
+    # by ~1e-2 on these 0.3 amplitude clips, mostly in how they roll off below the 8 kHz Nyquist frequency.
+    wav_16 = get_resampler(S3GEN_SR, S3_SR, "cpu")(torch.from_numpy(wav_24)[None])[0]
+    assert torch.allclose(wav_16, expected["wav_16"], atol=2e-2)
+
+    # In the log-mels, this is within 1e-2 up to 6 kHz. The bins above have little energy and, near the floor of the
+    # log-mel (8 below its maximum), the same absolute difference is a large relative one: up to 0.6 there.
+    filters = frontend.s3_tokenizer._mel_filters
+    high = filters.argmax(dim=1) * S3_SR / frontend.s3_tokenizer.n_fft > 6000
+    log_mel, expected_log_mel = features.prompt_log_mel, expected["prompt_log_mel"]
+    assert torch.allclose(log_mel[~high], expected_log_mel[~high], atol=1e-2)
+    assert torch.allclose(log_mel[high], expected_log_mel[high], atol=0.7)
+    assert (log_mel - expected_log_mel).abs().mean() < 1e-2
+
+    # The voice encoder mel is in amplitude, up to ~15 here; its 40 bins stop at 8 kHz too
+    assert features.ve_mel.shape == expected["ve_mel"].shape  # trimmed at the same frames
+    assert torch.allclose(features.ve_mel, expected["ve_mel"], rtol=1e-2, atol=2e-2)
+
+
+def test_prefix_power_spectrograms():
+    wav = torch.randn(2, 50000, generator=torch.Generator().manual_seed(0))
+    window = torch.hann_window(400)
+    lengths = [50000, 31111, 401]
+    for length, power in zip(lengths, prefix_power_spectrograms(wav, lengths, 400, 160, window)):
+        expected = torch.stft(wav[:, :length], 400, 160, window=window, pad_mode="reflect", return_complex=True)
+        assert torch.allclose(power, expected.abs() ** 2, rtol=1e-5, atol=1e-5)
+
+
+def test_trim_silence():
+    rng = np.random.default_rng(0)
+    wav = np.concatenate([np.zeros(8000), rng.standard_normal(20000), 1e-4 * rng.standard_normal(9000)])
+    wav = wav.astype(np.float32)
+    start, end = librosa.effects.trim(wav, top_db=20)[1]
+    assert torch.equal(trim_silence(torch.from_numpy(wav), top_db=20), torch.from_numpy(wav[start:end]))
+    # silence is kept whole, as librosa does
+    assert len(trim_silence(torch.zeros(1000))) == len(librosa.effects.trim(np.zeros(1000), top_db=20)[0])
+
+
+@pytest.mark.parametrize("fmt,sr", [("wav", 44100), ("flac", 44100), ("wav", 24000), ("flac", 16000)])
+def test_partial_decode(frontend, tmp_path, fmt, sr):
+    "Only `load_duration` seconds of a long clip are decoded, and the features of the decoder reference are unchanged"
+    fpath = write_reference(tmp_path / f"ref.{fmt}", 30, sr)
+    partial = frontend.load([fpath])[0]
+    full = librosa.load(fpath, sr=S3GEN_SR)[0]
+    assert abs(len(partial) - frontend.load_duration * S3GEN_SR) <= 1
+
+    # the end of the partial decode differs, where the resampler sees no following samples, but not the decoder
+    # reference which stops `LOAD_MARGIN` before
+    assert np.array_equal(partial[:DEC_COND_LEN], full[:DEC_COND_LEN])
+    features, expected = frontend([partial])[0], frontend([full])[0]
+    for name in ("prompt_feat", "ref_wav_16", "ref_log_mel", "prompt_log_mel"):
+        assert torch.equal(getattr(features, name), getattr(expected, name)), name
+
+    # the voice encoder only sees the loaded span
+    assert len(features.ve_mel) < len(expected.ve_mel)
@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from conftest import write_reference
+
+
+@pytest.fixture(scope="module")
+def references(tmp_path_factory):
+    "Clips of mixed lengths and sample rates; the 12 s ones are cut to the same length, and share an x-vector batch"
+    directory = tmp_path_factory.mktemp("references")
+    clips = [(12, 24000), (4.3, 44100), (2.05, 16000), (12, 16000)]
+    return [write_reference(directory / f"ref{i}.wav", duration, sr, seed=i) for i, (duration, sr) in enumerate(clips)]
+
+
+@torch.inference_mode()
+def test_batch_matches_single_references(tts, references):
+    conds = tts.conds
+    batch = tts.prepare_conditionals_batch(references, exaggeration=0.7)
+    assert tts.conds is conds  # the model state is unchanged
+
+    assert len(batch) == len(references)
+    for fpath, batched in zip(references, batch):
+        single = tts._compute_conditionals(fpath, exaggeration=0.7)
+        # the voice encoder batches padded utterances, with float differences
+        assert torch.allclose(batched.t3.speaker_emb, single.t3.speaker_emb, atol=1e-6)
+        assert torch.equal(batched.t3.cond_prompt_speech_tokens, single.t3.cond_prompt_speech_tokens)
+        assert torch.equal(batched.t3.emotion_adv, single.t3.emotion_adv)
+        assert batched.gen.keys() == single.gen.keys()
+        for k, v in single.gen.items():
+            if v is None:
+                assert batched.gen[k] is None, k
+            else:
+                assert torch.equal(batched.gen[k], v), k
+
+
+def test_empty_batch(tts):
+    assert tts.prepare_conditionals_batch([]) == []
@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import LLAMA_ALIGNED_HEADS
+
+from conftest import make_t3, make_t3_cond, make_text_tokens
+
+
+GREEDY = dict(temperature=1e-4, top_p=0.95, min_p=0.05, repetition_penalty=1.2)
+
+
+@pytest.fixture(scope="module")
+def confident_t3():
+    """
+    A model whose logits have large gaps, so that near-greedy sampling is deterministic, and with a larger EOS head so
+    that some sequences finish early and are retired from the batch
+    """
+    t3 = make_t3(seed=1)
+    with torch.no_grad():
+        t3.speech_head.weight.mul_(100)
+        t3.speech_head.weight[t3.hp.stop_speech_token].mul_(3)
+    return t3
+
+
+def right_padded(texts):
+    lens = torch.tensor([t.size(0) for t in texts])
+    tokens = torch.zeros(len(texts), int(lens.max()), dtype=torch.long)
+    for n, t in enumerate(texts):
+        tokens[n, :t.size(0)] = t
+    return tokens, lens
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("cfg_weight", [0.5, 0.0])
+def test_matches_per_text_inference(confident_t3, cfg_weight):
+    t3 = confident_t3
+    texts = [make_text_tokens(t3, n, seed)[0] for seed, n in enumerate([30, 8, 16, 4, 24])]
+    t3_conds = [make_t3_cond(t3, seed=seed % 2, exaggeration=0.5 + 0.1 * seed) for seed in range(len(texts))]
+    expected = [
+        t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text[None].expand(2, -1),
+            max_new_tokens=64,
+            cfg_weight=cfg_weight,
+            use_prefix_cache=False,
+            **GREEDY,
+        )
+        for t3_cond, text in zip(t3_conds, texts)
+    ]
+    # sequences finish at different steps, before and at `max_new_tokens`
+    assert len({e.size(1) for e in expected}) > 2 and max(e.size(1) for e in expected) == 64
+
+    text_tokens, text_token_lens = right_padded(texts)
+    results = t3.inference_batch(
+        t3_conds=t3_conds,
+        text_tokens=text_tokens,
+        text_token_lens=text_token_lens,
+        max_new_tokens=64,
+        cfg_weight=cfg_weight,
+        generator=torch.Generator().manual_seed(0),
+        **GREEDY,
+    )
+    assert len(results) == len(texts)
+    for n, (tokens, expected_tokens) in enumerate(zip(results, expected)):
+        assert torch.equal(tokens, expected_tokens), f"text {n}"
+
+    for layer_idx, _ in LLAMA_ALIGNED_HEADS:
+        assert len(t3.tfmr.layers[layer_idx].self_attn._forward_hooks) == 0
+
+
+@torch.inference_mode()
+def test_shared_conditioning(confident_t3):
+    t3 = confident_t3
+    t3_cond = make_t3_cond(t3, seed=2)
+    texts = [make_text_tokens(t3, n, seed)[0] for seed, n in enumerate([6, 12])]
+    text_tokens, text_token_lens = right_padded(texts)
+    results = t3.inference_batch(
+        t3_conds=t3_cond, text_tokens=text_tokens, text_token_lens=text_token_lens, max_new_tokens=30, **GREEDY,
+    )
+    for tokens, text in zip(results, texts):
+        expected = t3.inference(
+            t3_cond=t3_cond, text_tokens=text[None].expand(2, -1), max_new_tokens=30, use_prefix_cache=False, **GREEDY,
+        )
+        assert torch.equal(tokens, expected)
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.cfg_policy import T3CFGPolicy
+from chatterbox.models.t3.inference.scheduler import T3Scheduler
+
+from conftest import make_text_tokens
+
+
+def test_keep_guidance():
+    assert T3CFGPolicy().keep_guidance(1000, SimpleNamespace(stable_steps=1000))
+
+    policy = T3CFGPolicy(max_guided_tokens=10)
+    assert policy.keep_guidance(9) and not policy.keep_guidance(10)
+
+    policy = T3CFGPolicy(stable_alignment_steps=4)
+    assert policy.keep_guidance(50)  # no analyzer
+    assert policy.keep_guidance(50, SimpleNamespace(stable_steps=3))
+    assert not policy.keep_guidance(50, SimpleNamespace(stable_steps=4))
+
+    policy = T3CFGPolicy(max_guided_tokens=10, stable_alignment_steps=4)
+    assert not policy.keep_guidance(10, SimpleNamespace(stable_steps=0))
+
+
+@pytest.fixture(scope="module")
+def text_tokens(t3):
+    return make_text_tokens(t3, 16).expand(2, -1)
+
+
+def generate(t3, t3_cond, text_tokens, seed=0, **kwargs):
+    return t3.inference(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=40,
+        use_prefix_cache=False,
+        generator=torch.Generator().manual_seed(seed),
+        **kwargs,
+    )
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("draft_layers", [0, 6])
+def test_truncated_guidance(t3, t3_cond, text_tokens, draft_layers):
+    full = generate(t3, t3_cond, text_tokens, draft_layers=draft_layers)
+    truncated = generate(
+        t3, t3_cond, text_tokens, draft_layers=draft_layers, cfg_policy=T3CFGPolicy(max_guided_tokens=10),
+    )
+    if draft_layers == 0:
+        # the same random draws: tokens only differ once guidance stops
+        assert torch.equal(truncated[:, :10], full[:, :10])
+        assert not torch.equal(truncated, full)
+    assert truncated.size(1) > 10
+
+    # the decode engine restores the CFG rows of the static cache for later generations
+    assert torch.equal(generate(t3, t3_cond, text_tokens, draft_layers=draft_layers), full)
+
+
+@torch.inference_mode()
+def test_no_cfg_decodes_a_single_row(t3, t3_cond, text_tokens):
+    tokens = generate(t3, t3_cond, text_tokens[:1], cfg_weight=0.0)
+    assert t3.decode_engine.batch_size == 1
+    assert torch.equal(generate(t3, t3_cond, text_tokens, cfg_weight=0.0), tokens)
+
+
+@torch.inference_mode()
+def test_scheduler_drops_the_unconditional_row(t3, t3_cond, text_tokens):
+    policy = T3CFGPolicy(max_guided_tokens=10)
+    expected = generate(t3, t3_cond, text_tokens, cfg_policy=policy)
+
+    scheduler = T3Scheduler(t3, max_rows=2)
+    try:
+        req = scheduler.submit(
+            t3_cond, text_tokens[0], max_new_tokens=40, cfg_policy=policy, generator=torch.Generator().manual_seed(0),
+        )
+        tokens = req.result(timeout=300)
+        metrics = scheduler.metrics()
+    finally:
+        scheduler.shutdown()
+    assert torch.equal(tokens, expected)
+    assert not req.guided
+    assert metrics.kv_cache.used_blocks == 0
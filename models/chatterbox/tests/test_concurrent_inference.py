@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from conftest import make_text_tokens
+
+
+def test_threads_match_sequential_inference(t3, t3_cond):
+    "Concurrent calls share the static cache, analyzer and prefix cache, so they must run one at a time"
+    jobs = [(make_text_tokens(t3, n, seed).expand(2, -1), seed) for seed, n in enumerate([12, 30, 20, 8, 25, 16])]
+
+    def generate(job):
+        text_tokens, seed = job
+        return t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=30,
+            cfg_weight=0.5 if seed % 2 else 0.0,
+            generator=torch.Generator().manual_seed(seed),
+            return_text_positions=True,
+        )
+
+    expected = [generate(job) for job in jobs]
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(generate, jobs * 2))
+
+    for (tokens, positions), (expected_tokens, expected_positions) in zip(results, expected * 2):
+        assert torch.equal(tokens, expected_tokens)
+        assert positions == expected_positions
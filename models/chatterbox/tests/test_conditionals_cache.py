@@ -0,0 +1,58 @@
+import pytest
+
+from chatterbox.mtl_tts import ConditionalsCache, conditionals_key
+
+from conftest import make_conditionals
+
+
+def test_lru_eviction(t3):
+    cache = ConditionalsCache(max_entries=2)
+    a, b, c = (make_conditionals(t3, seed) for seed in range(3))
+    assert cache.get("a") is None
+
+    cache.put("a", a)
+    cache.put("b", b)
+    assert cache.get("a") is a  # "b" is now the least recently used
+    cache.put("c", c)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is a and cache.get("c") is c
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # putting an entry again refreshes it
+    cache.put("a", a)
+    cache.put("b", b)
+    assert list(cache.entries) == ["a", "b"]
+
+    cache.clear()
+    assert len(cache) == 0 and cache.get("a") is None
+
+
+def test_with_exaggeration_shares_tensors(t3):
+    conds = make_conditionals(t3, exaggeration=0.5)
+    assert conds.with_exaggeration(0.5) is conds
+
+    other = conds.with_exaggeration(0.8)
+    assert other.t3.emotion_adv.item() == pytest.approx(0.8)
+    assert conds.t3.emotion_adv.item() == 0.5  # the cached conditionals are unchanged
+    assert other.t3.speaker_emb is conds.t3.speaker_emb
+    assert other.t3.cond_prompt_speech_tokens is conds.t3.cond_prompt_speech_tokens
+    assert other.gen is conds.gen
+
+
+def test_conditionals_key_is_content_based(tmp_path):
+    wav = tmp_path / "voice.wav"
+    wav.write_bytes(b"RIFF" + bytes(range(256)) * 10000)
+    key = conditionals_key(wav, 96000, 240000)
+
+    # a renamed or copied file hits
+    copy = tmp_path / "copy.wav"
+    copy.write_bytes(wav.read_bytes())
+    assert conditionals_key(copy, 96000, 240000) == key
+
+    # other parameters miss
+    assert conditionals_key(wav, 96000, 120000) != key
+
+    # an overwritten file misses, even with the same size
+    wav.write_bytes(b"RIFF" + bytes(range(255, -1, -1)) * 10000)
+    assert conditionals_key(wav, 96000, 240000) != key
@@ -0,0 +1,120 @@
+"""
+`T3DecodeEngine` (preallocated buffers, a static cache reused across generations, lazy EOS checks) against the decode
+loop it replaced, kept below as `reference_decode`: a `DynamicCache`, logits of the full head and the HF processors.
+"""
+import pytest
+import torch
+from transformers import DynamicCache
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from chatterbox.models.t3.inference.t3_hf_backend import T3HuggingfaceBackend
+
+from conftest import make_t3, make_text_tokens
+
+
+GREEDY = dict(temperature=1e-4, top_p=0.95, min_p=0.05, repetition_penalty=1.2)
+
+
+@pytest.fixture(scope="module")
+def confident_t3():
+    """
+    A model whose logits have large gaps, so that near-greedy sampling is deterministic, and with a larger EOS head so
+    that some generations stop before `max_new_tokens`
+    """
+    t3 = make_t3(seed=1)
+    with torch.no_grad():
+        t3.speech_head.weight.mul_(100)
+        t3.speech_head.weight[t3.hp.stop_speech_token].mul_(3)
+    return t3
+
+
+def reference_decode(t3, t3_cond, text_tokens, max_new_tokens, cfg_weight, temperature, top_p, min_p,
+                     repetition_penalty):
+    """
+    The previous decode loop of `T3.inference`. Ids outside the valid speech vocabulary (the start token, and ids
+    past the stop token) are masked out, as `T3Sampler` only samples valid ones.
+    """
+    hp = t3.hp
+    n_rows = 2 if cfg_weight > 0.0 else 1
+    text_tokens = text_tokens[:n_rows]
+    bos_token = torch.full((n_rows, 1), hp.start_speech_token)
+    embeds, len_cond = t3.prepare_input_embeds(
+        t3_cond=t3_cond, text_tokens=text_tokens, speech_tokens=bos_token, cfg_weight=cfg_weight,
+    )
+    bos_embed = t3.speech_emb(bos_token) + t3.speech_pos_emb.get_fixed_embedding(0)
+    inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
+
+    analyzer = AlignmentStreamAnalyzer(
+        t3.tfmr, None, text_tokens_slice=(len_cond, len_cond + text_tokens.size(1)), eos_idx=hp.stop_speech_token,
+    )
+    backend = T3HuggingfaceBackend(config=t3.cfg, llama=t3.tfmr, speech_enc=t3.speech_emb, speech_head=t3.speech_head)
+    processors = [RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)]
+    warpers = [MinPLogitsWarper(min_p=min_p), TopPLogitsWarper(top_p=top_p)]
+
+    generated_ids = bos_token[:1]
+    past = DynamicCache()
+    # `output_attentions` for every layer, as the previous loop did: without it, HF leaves the causal mask to SDPA,
+    # which the eager alignment layers (see `AlignmentStreamAnalyzer`) don't apply
+    output = backend(inputs_embeds=inputs_embeds, past_key_values=past, use_cache=True, output_attentions=True)
+    try:
+        for i in range(max_new_tokens):
+            logits = output.logits[:, -1, :]
+            if n_rows == 2:
+                logits = logits[:1] + cfg_weight * (logits[:1] - logits[1:])
+            logits[:, hp.start_speech_token] = float("-inf")
+            logits[:, hp.stop_speech_token + 1:] = float("-inf")
+            logits = analyzer.step(logits, next_token=generated_ids[0, -1].item())
+            for processor in processors:
+                logits = processor(generated_ids, logits)
+            logits = logits / temperature
+            for warper in warpers:
+                logits = warper(generated_ids, logits)
+            next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+            if next_token.item() == hp.stop_speech_token:
+                break
+
+            embed = t3.speech_emb(next_token) + t3.speech_pos_emb.get_fixed_embedding(i + 1)
+            output = backend(
+                inputs_embeds=embed.expand(n_rows, -1, -1), past_key_values=past, use_cache=True, output_attentions=True,
+            )
+    finally:
+        analyzer.close()
+    return generated_ids[:, 1:], analyzer.positions
+
+
+@torch.inference_mode()
+def test_matches_reference_decode(confident_t3, t3_cond):
+    t3 = confident_t3
+    eos_check_interval = 8
+    # (text length, seed, cfg_weight, number of tokens until EOS, or None if it reaches `max_new_tokens`). The prompts
+    # get shorter, so the static cache is reused with stale entries past the prompt, which only the mask hides.
+    cases = [(24, 5, 0.5, None), (8, 2, 0.5, 18), (4, 4, 0.5, 13), (30, 1, 0.0, 62)]
+    cache = None
+    for n_text, seed, cfg_weight, n_eos in cases:
+        text_tokens = make_text_tokens(t3, n_text, seed).expand(2, -1)
+        expected, expected_positions = reference_decode(t3, t3_cond, text_tokens, 80, cfg_weight, **GREEDY)
+        tokens, positions = t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=80,
+            cfg_weight=cfg_weight,
+            use_prefix_cache=False,
+            generator=torch.Generator().manual_seed(seed),
+            return_text_positions=True,
+            **GREEDY,
+        )
+        assert torch.equal(tokens, expected), f"text {n_text}"
+        assert positions == expected_positions
+
+        # EOS lands between lazy checks; the tokens sampled after it, until the next check, are discarded
+        if n_eos is None:
+            assert tokens.size(1) == 80 and (tokens != t3.hp.stop_speech_token).all()
+        else:
+            assert tokens.size(1) == n_eos and n_eos % eos_check_interval != 0
+            assert tokens[0, -1] == t3.hp.stop_speech_token
+
+        if cfg_weight > 0.0:
+            assert cache is None or t3._static_cache is cache
+            cache = t3._static_cache
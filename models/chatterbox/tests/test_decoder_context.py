@@ -0,0 +1,131 @@
+"""
+`ConditionalDecoder.forward` with the step-invariant inputs prepared once (`prepare`, `DecoderContext`) against the
+forward it replaced, kept below as `reference_forward`, which computed them at every call.
+"""
+from unittest.mock import patch
+
+import pytest
+import torch
+from einops import pack, rearrange, repeat
+
+from chatterbox.models.s3gen.decoder import ConditionalDecoder, mask_to_bias
+from chatterbox.models.s3gen.flow_matching import ConditionalCFM
+from chatterbox.models.s3gen.configs import CFM_PARAMS
+from chatterbox.models.s3gen.utils.mask import add_optional_chunk_mask
+
+
+def reference_forward(decoder, x, mask, mu, t, spks=None, cond=None):
+    "The previous `ConditionalDecoder.forward`"
+    def attention_bias(x, mask):
+        attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, decoder.static_chunk_size, -1)
+        return mask_to_bias(attn_mask == 1, x.dtype)
+
+    def transformer(x, transformer_blocks, mask):
+        x = rearrange(x, "b c t -> b t c").contiguous()
+        attn_mask = attention_bias(x, mask)
+        for transformer_block in transformer_blocks:
+            x = transformer_block(hidden_states=x, attention_mask=attn_mask, timestep=t)
+        return rearrange(x, "b t c -> b c t").contiguous()
+
+    t = decoder.time_mlp(decoder.time_embeddings(t).to(t.dtype))
+    x = pack([x, mu], "b * t")[0]
+    if spks is not None:
+        x = pack([x, repeat(spks, "b c -> b c t", t=x.shape[-1])], "b * t")[0]
+    if cond is not None:
+        x = pack([x, cond], "b * t")[0]
+
+    hiddens = []
+    masks = [mask]
+    for resnet, transformer_blocks, downsample in decoder.down_blocks:
+        mask_down = masks[-1]
+        x = transformer(resnet(x, mask_down, t), transformer_blocks, mask_down)
+        hiddens.append(x)
+        x = downsample(x * mask_down)
+        masks.append(mask_down[:, :, ::2])
+    masks = masks[:-1]
+    mask_mid = masks[-1]
+
+    for resnet, transformer_blocks in decoder.mid_blocks:
+        x = transformer(resnet(x, mask_mid, t), transformer_blocks, mask_mid)
+
+    for resnet, transformer_blocks, upsample in decoder.up_blocks:
+        mask_up = masks.pop()
+        skip = hiddens.pop()
+        x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+        x = transformer(resnet(x, mask_up, t), transformer_blocks, mask_up)
+        x = upsample(x * mask_up)
+    x = decoder.final_block(x, mask_up)
+    return decoder.final_proj(x * mask_up) * mask
+
+
+def make_decoder(causal, channels):
+    "The S3Gen decoder, with less blocks"
+    torch.manual_seed(0)
+    return ConditionalDecoder(
+        in_channels=320, out_channels=80, causal=causal, channels=channels, attention_head_dim=64, n_blocks=1,
+        num_mid_blocks=2, num_heads=8,
+    ).eval()
+
+
+def make_inputs(n_items=3, n_frames=37, seed=0):
+    "Inputs of a CFG batch, with padded items"
+    g = torch.Generator().manual_seed(seed)
+    mask = torch.ones(n_items, 1, n_frames)
+    for i in range(1, n_items):
+        mask[i, :, n_frames - 13 * i:] = 0
+    return dict(
+        x=torch.randn(n_items, 80, n_frames, generator=g),
+        mask=mask,
+        mu=torch.randn(n_items, 80, n_frames, generator=g),
+        t=torch.rand(n_items, generator=g),
+        spks=torch.randn(n_items, 80, generator=g),
+        cond=torch.randn(n_items, 80, n_frames, generator=g),
+    )
+
+
+# the S3Gen decoder has a single resolution; two exercise the masks of the downsampled ones
+@torch.inference_mode()
+@pytest.mark.parametrize("causal,channels", [(True, [256]), (False, [256]), (True, [128, 128])])
+def test_forward_matches_reference(causal, channels):
+    decoder = make_decoder(causal, channels)
+    inputs = make_inputs()
+    expected = reference_forward(decoder, **inputs)
+
+    assert torch.equal(decoder(**inputs), expected)
+    context = decoder.prepare(inputs["mask"], inputs["mu"], inputs["spks"], inputs["cond"])
+    assert torch.equal(decoder(**inputs, context=context), expected)
+
+    # the context of the first items is the one of the first items of the inputs
+    head = {k: v[:2] for k, v in inputs.items()}
+    assert torch.equal(decoder(**head, context=context.head(2)), reference_forward(decoder, **head))
+
+
+class ReferenceDecoder(torch.nn.Module):
+    "The decoder with its previous forward, and no `prepare`"
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        return reference_forward(self.decoder, x, mask, mu, t, spks, cond)
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("guidance_interval", [None, (0.0, 0.5)])
+def test_solve_prepares_the_context_once(guidance_interval):
+    decoder = make_decoder(True, [256])
+    inputs = make_inputs(n_items=2)
+    t_span = torch.linspace(0, 1, 5)
+
+    def solve(estimator):
+        cfm = ConditionalCFM(240, CFM_PARAMS, n_spks=1, spk_emb_dim=80, estimator=estimator)
+        return cfm.solve(
+            "euler", inputs["x"], t_span, inputs["mu"], inputs["mask"], inputs["spks"], inputs["cond"],
+            guidance_interval=guidance_interval,
+        )
+
+    with patch.object(decoder, "prepare", wraps=decoder.prepare) as prepare:
+        x = solve(decoder)
+    prepare.assert_called_once()
+    # guided and unguided steps, which use the context of the conditional rows
+    assert torch.equal(x, solve(ReferenceDecoder(decoder)))
@@ -0,0 +1,155 @@
+"""
+The ODE solvers of the S3Gen flow matching, on a toy velocity field whose conditional and unconditional velocities
+differ, so that guidance shows in the results.
+"""
+import math
+
+import pytest
+import torch
+
+from chatterbox.models.s3gen import FLOW_PRESETS
+from chatterbox.models.s3gen.configs import CFM_PARAMS
+from chatterbox.models.s3gen.flow_matching import SOLVERS, ConditionalCFM
+from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+
+
+class ToyEstimator(torch.nn.Module):
+    "A smooth velocity field, which records the batch size of its passes"
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        self.batch_sizes.append(x.size(0))
+        t = t.view(-1, 1, 1)
+        return (-x * torch.cos(3 * t) + torch.sin(3 * t) + 0.5 * mu + 0.1 * cond + 0.1 * spks[..., None]) * mask
+
+
+@pytest.fixture
+def cfm():
+    return ConditionalCFM(240, CFM_PARAMS, n_spks=1, spk_emb_dim=80, estimator=ToyEstimator())
+
+
+@pytest.fixture
+def inputs():
+    g = torch.Generator().manual_seed(0)
+    n_items, n_frames = 2, 7
+    return dict(
+        x=torch.randn(n_items, 80, n_frames, generator=g, dtype=torch.float64),
+        mu=torch.randn(n_items, 80, n_frames, generator=g, dtype=torch.float64),
+        mask=torch.ones(n_items, 1, n_frames, dtype=torch.float64),
+        spks=torch.randn(n_items, 80, generator=g, dtype=torch.float64),
+        cond=torch.randn(n_items, 80, n_frames, generator=g, dtype=torch.float64),
+    )
+
+
+def t_span(n_timesteps, dtype=torch.float64):
+    "The cosine schedule of `ConditionalCFM.forward`"
+    return 1 - torch.cos(torch.linspace(0, 1, n_timesteps + 1, dtype=dtype) * 0.5 * torch.pi)
+
+
+def solve(cfm, solver, n_timesteps, inputs, **guidance):
+    inputs = dict(inputs, x=inputs["x"].clone())
+    return cfm.solve(solver, t_span=t_span(n_timesteps), **inputs, **guidance).double()
+
+
+def reference_euler(cfm, x, t_span, mu, mask, spks, cond):
+    "The previous `solve_euler`, which always ran the conditional and unconditional passes"
+    cfg_rate = cfm.inference_cfg_rate
+    t, dt = t_span[0:1], t_span[1] - t_span[0]
+    n = x.size(0)
+    zeros = torch.zeros_like
+    for step in range(1, len(t_span)):
+        dphi_dt = cfm.forward_estimator(
+            torch.cat([x, x]), torch.cat([mask, mask]), torch.cat([mu, zeros(mu)]), t.repeat(2 * n),
+            torch.cat([spks, zeros(spks)]), torch.cat([cond, zeros(cond)]),
+        )
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [n, n], dim=0)
+        x = x + dt * ((1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt)
+        t = t + dt
+        if step < len(t_span) - 1:
+            dt = t_span[step + 1] - t
+    return x.float()
+
+
+def test_euler_is_unchanged(cfm, inputs):
+    expected = reference_euler(cfm, t_span=t_span(10, torch.float32), **{k: v.float() for k, v in inputs.items()})
+    x = cfm.solve("euler", t_span=t_span(10, torch.float32), **{k: v.float() for k, v in inputs.items()})
+    assert torch.equal(x, expected)
+
+
+def test_unknown_solver(cfm, inputs):
+    with pytest.raises(ValueError, match="Unknown ODE solver"):
+        solve(cfm, "rk4", 4, inputs)
+
+
+@pytest.mark.parametrize("solver,passes_per_step", [("euler", 1), ("heun", 2), ("midpoint", 2), ("dpm", 1)])
+def test_estimator_passes(cfm, inputs, solver, passes_per_step):
+    solve(cfm, solver, 6, inputs)
+    assert cfm.estimator.batch_sizes == [4] * 6 * passes_per_step  # guided: conditional and unconditional rows
+
+
+@pytest.mark.parametrize("solver,order,n_timesteps", [
+    ("euler", 1, 32),
+    ("heun", 2, 32),
+    ("midpoint", 2, 32),
+    # the first and last steps are first order, with large steps in log-SNR: the order is reached later
+    ("dpm", 1.6, 128),
+])
+def test_convergence_order(cfm, inputs, solver, order, n_timesteps):
+    expected = solve(cfm, "heun", 4096, inputs)
+    error = (solve(cfm, solver, n_timesteps, inputs) - expected).abs().max()
+    finer_error = (solve(cfm, solver, 2 * n_timesteps, inputs) - expected).abs().max()
+    assert math.log2(error / finer_error) > order - 0.1
+
+
+def test_dpm_first_steps_are_first_order(cfm, inputs):
+    # the log-SNR is infinite at t = 0, so that the second step has no correction: 3 steps are Euler steps
+    assert torch.allclose(solve(cfm, "dpm", 3, inputs), solve(cfm, "euler", 3, inputs), atol=1e-6)
+    assert not torch.allclose(solve(cfm, "dpm", 4, inputs), solve(cfm, "euler", 4, inputs), atol=1e-3)
+    # many steps of the cosine schedule are close to t = 0, where a clamped log-SNR gave zero steps
+    assert solve(cfm, "dpm", 512, inputs).isfinite().all()
+
+
+def test_presets():
+    assert FLOW_PRESETS["standard"] == dict(n_timesteps=10, solver="euler")  # the previous behaviour
+    for preset in FLOW_PRESETS.values():
+        assert preset["solver"] in SOLVERS
+
+    flow_params = ChatterboxMultilingualTTS._flow_params
+    assert flow_params("draft", None, None, None, None) == FLOW_PRESETS["draft"]
+    assert flow_params("draft", 6, "heun", 0.0, (0.2, 1.0)) == dict(
+        n_timesteps=6, solver="heun", cfg_rate=0.0, guidance_interval=(0.2, 1.0),
+    )
+    with pytest.raises(ValueError, match="Unknown flow preset"):
+        flow_params("fast", None, None, None, None)
+
+
+def test_no_guidance(cfm, inputs):
+    unguided = solve(cfm, "heun", 6, inputs, cfg_rate=0.0)
+    assert cfm.estimator.batch_sizes == [2] * 12  # only the conditional rows
+    # an interval without steps is the same
+    assert torch.equal(solve(cfm, "heun", 6, inputs, guidance_interval=(2.0, 3.0)), unguided)
+    assert not torch.allclose(solve(cfm, "heun", 6, inputs), unguided)
+
+
+@pytest.mark.parametrize("solver", ["euler", "heun"])
+def test_guidance_interval(cfm, inputs, solver):
+    times = t_span(10)
+    x = solve(cfm, solver, 10, inputs, guidance_interval=(0.0, 0.5))
+    # the steps which start in the interval are guided, with all their estimator passes
+    passes = 1 if solver == "euler" else 2
+    assert cfm.estimator.batch_sizes == [4 if t <= 0.5 else 2 for t in times[:-1].tolist() for _ in range(passes)]
+    assert 0 < cfm.estimator.batch_sizes.count(4) < 10 * passes
+
+    if solver == "euler":
+        # Euler steps with the conditional velocity, and guided ones in the interval
+        expected, cfg_rate = inputs["x"], cfm.inference_cfg_rate
+        unconditional = dict(inputs, mu=torch.zeros_like(inputs["mu"]), spks=torch.zeros_like(inputs["spks"]),
+                             cond=torch.zeros_like(inputs["cond"]))
+        for t, s in zip(times[:-1], times[1:]):
+            def v(inputs):
+                return cfm.estimator(expected, inputs["mask"], inputs["mu"], t[None], inputs["spks"], inputs["cond"])
+            velocity = (1 + cfg_rate) * v(inputs) - cfg_rate * v(unconditional) if t <= 0.5 else v(inputs)
+            expected = expected + (s - t) * velocity
+        assert torch.allclose(x, expected.float().double(), atol=1e-6)
@@ -0,0 +1,105 @@
+import torch
+from transformers import LlamaConfig
+
+from chatterbox.models.t3.inference.paged_cache import T3PagedKVCache
+from chatterbox.models.t3.inference.scheduler import T3Scheduler
+from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS
+
+from conftest import make_text_tokens
+
+
+def make_cache(n_blocks, block_size=4):
+    config = LlamaConfig(**dict(LLAMA_CONFIGS["Llama_tiny"], num_hidden_layers=2, num_key_value_heads=2))
+    return T3PagedKVCache(config, n_blocks=n_blocks, block_size=block_size)
+
+
+def test_reads_back_what_each_sequence_wrote():
+    cache = make_cache(n_blocks=16)
+    g = torch.Generator().manual_seed(0)
+    lengths = {"a": 9, "b": 3}
+    written = {}
+
+    # prefill each sequence on its own
+    for seq_id, length in lengths.items():
+        assert cache.reserve(seq_id, length)
+        k, v = torch.randn(2, 1, 2, length, 8, generator=g)
+        cache.select([seq_id], torch.arange(length)[None], length)
+        cache.update(k, v, layer_idx=1)
+        written[seq_id] = (k[0], v[0])
+
+    # then one position each, in a single batch
+    for seq_id, length in lengths.items():
+        assert cache.reserve(seq_id, length + 1)
+    k, v = torch.randn(2, 2, 2, 1, 8, generator=g)
+    positions = torch.tensor([[lengths["a"]], [lengths["b"]]])
+    cache.select(["a", "b"], positions, max(lengths.values()) + 1)
+    keys, values = cache.update(k, v, layer_idx=1)
+    assert keys.shape == (2, 2, lengths["a"] + 1, 8)
+
+    for row, (seq_id, length) in enumerate(lengths.items()):
+        expected_k = torch.cat([written[seq_id][0], k[row]], dim=1)
+        expected_v = torch.cat([written[seq_id][1], v[row]], dim=1)
+        assert torch.equal(keys[row, :, :length + 1], expected_k)
+        assert torch.equal(values[row, :, :length + 1], expected_v)
+    assert cache.get_seq_length() == lengths["a"] + 1
+
+
+def test_block_accounting():
+    cache = make_cache(n_blocks=6, block_size=4)
+    assert cache.reserve("a", 9)  # 3 blocks
+    assert cache.reserve("b", 4)  # 1 block
+    assert cache.stats().used_blocks == 4
+
+    # out of blocks: the blocks taken so far are kept
+    assert not cache.reserve("b", 16)
+    stats = cache.stats()
+    assert stats.used_blocks == stats.capacity_blocks == 6 and len(cache.block_tables["b"]) == 3
+
+    cache.free("a", evicted=True)
+    cache.free("b")
+    stats = cache.stats()
+    assert stats.used_blocks == 0 and stats.peak_used_blocks == 6 and stats.evictions == 1
+    assert stats.n_sequences == 0
+    assert sorted(cache.allocator.free_list) == list(range(6))
+
+
+@torch.inference_mode()
+def test_scheduler_preempts_when_the_pool_runs_out(t3, t3_cond):
+    texts = [make_text_tokens(t3, n, seed)[0] for seed, n in enumerate([20, 16, 24])]
+    kwargs = dict(max_new_tokens=60, repetition_penalty=2.0)
+    expected = [
+        t3.inference(
+            t3_cond=t3_cond,
+            text_tokens=tokens[None].expand(2, -1),
+            use_prefix_cache=False,
+            generator=torch.Generator().manual_seed(i),
+            **kwargs,
+        )
+        for i, tokens in enumerate(texts)
+    ]
+
+    # room for the prompts of all three requests, not for their speech
+    scheduler = T3Scheduler(t3, max_rows=6, kv_tokens=640, block_size=16)
+    preempted = set()
+    preempt = scheduler._preempt
+    scheduler._preempt = lambda req: preempted.add(req.request_id) or preempt(req)
+    try:
+        reqs = [
+            scheduler.submit(t3_cond, tokens, generator=torch.Generator().manual_seed(i), **kwargs)
+            for i, tokens in enumerate(texts)
+        ]
+        results = [req.result(timeout=300) for req in reqs]
+        metrics = scheduler.metrics()
+    finally:
+        scheduler.shutdown()
+
+    assert metrics.preempted_requests > 0 and metrics.kv_cache.evictions > 0
+    assert metrics.completed_requests == len(texts)
+    assert metrics.kv_cache.used_blocks == 0
+    assert metrics.kv_cache.peak_used_blocks <= metrics.kv_cache.capacity_blocks
+    # a preempted request restarts from its prompt, with its generator where it left off; the others are unaffected
+    assert 0 < len(preempted) < len(reqs)
+    for req, result, tokens in zip(reqs, results, expected):
+        assert 0 < result.size(1) <= kwargs["max_new_tokens"]
+        if req.request_id not in preempted:
+            assert torch.equal(result, tokens)
@@ -0,0 +1,98 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.prefix_cache import T3Prefix, T3PrefixCache, prefix_key
+
+from conftest import make_t3_cond, make_text_tokens
+
+
+def generate(t3, t3_cond, text_tokens, cfg_weight, use_prefix_cache, seed=0):
+    return t3.inference(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=40,
+        cfg_weight=cfg_weight,
+        use_prefix_cache=use_prefix_cache,
+        generator=torch.Generator().manual_seed(seed),
+        return_text_positions=True,
+    )
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("capture_cfg,reuse_cfg", [(0.5, 0.5), (0.5, 0.0), (0.0, 0.5), (0.0, 0.0)])
+def test_cache_hit_matches_full_prefill(t3, capture_cfg, reuse_cfg):
+    t3_cond = make_t3_cond(t3, seed=3)
+    text_tokens = make_text_tokens(t3, 20, seed=1).expand(2, -1)
+    expected_tokens, expected_positions = generate(t3, t3_cond, text_tokens, reuse_cfg, use_prefix_cache=False)
+
+    # the prefix is captured from the row 0 of a generation of another text, with or without CFG
+    t3.prefix_cache.clear()
+    generate(t3, t3_cond, make_text_tokens(t3, 12, seed=2).expand(2, -1), capture_cfg, use_prefix_cache=True)
+    assert len(t3.prefix_cache) == 1
+    prefix = next(iter(t3.prefix_cache.entries.values()))
+    assert prefix.key_states[0].size(0) == 1
+    assert prefix.length == t3.prepare_conditioning(t3_cond).size(1)
+
+    # then copied into the static cache, and only the text and BOS tokens are prefilled
+    hits = t3.prefix_cache.hits
+    tokens, positions = generate(t3, t3_cond, text_tokens, reuse_cfg, use_prefix_cache=True)
+    assert t3.prefix_cache.hits == hits + 1
+    assert torch.equal(tokens, expected_tokens)
+    assert positions == expected_positions
+
+
+@torch.inference_mode()
+def test_prefix_depends_on_the_voice(t3):
+    cache = t3.prefix_cache
+    cache.clear()
+    hits, misses = cache.hits, cache.misses
+    text_tokens = make_text_tokens(t3, 12).expand(2, -1)
+    for exaggeration in (0.5, 0.7, 0.5):
+        generate(t3, make_t3_cond(t3, seed=4, exaggeration=exaggeration), text_tokens, 0.5, use_prefix_cache=True)
+    assert (len(cache), cache.hits - hits, cache.misses - misses) == (2, 1, 2)
+
+
+def make_prefix(length, n_layers=2, fill=0.0):
+    "A `T3Prefix` of n_layers x 2 x (1, 2, length, 4) fp32 tensors, ie 64 bytes per layer and position"
+    return T3Prefix(
+        key_states=[torch.full((1, 2, length, 4), fill) for _ in range(n_layers)],
+        value_states=[torch.full((1, 2, length, 4), fill) for _ in range(n_layers)],
+    )
+
+
+def test_byte_lru_eviction():
+    assert make_prefix(10).nbytes == 2 * 2 * 2 * 10 * 4 * 4
+    size = make_prefix(10).nbytes
+    cache = T3PrefixCache(max_bytes=int(2.5 * size))
+
+    cache.put("a", make_prefix(10))
+    cache.put("b", make_prefix(10))
+    assert cache.get("a") is not None  # "b" is now the least recently used
+    cache.put("c", make_prefix(10))
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.nbytes == 2 * size
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # replacing an entry updates the size; larger prefixes evict several entries
+    cache.put("a", make_prefix(5, fill=1.0))
+    assert cache.nbytes == size + size // 2
+    assert cache.get("a").key_states[0][0, 0, 0, 0] == 1.0
+    cache.put("d", make_prefix(25))
+    assert list(cache.entries) == ["d"] and cache.nbytes == int(2.5 * size)
+
+    # a prefix larger than the whole cache isn't stored
+    cache.put("e", make_prefix(30))
+    assert list(cache.entries) == ["d"] and cache.nbytes == int(2.5 * size)
+
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_prefix_key(t3):
+    t3_cond = make_t3_cond(t3, seed=5)
+    key = prefix_key(t3_cond, torch.float32)
+    assert prefix_key(make_t3_cond(t3, seed=5), torch.float32) == key
+    assert prefix_key(make_t3_cond(t3, seed=5, exaggeration=0.6), torch.float32) != key
+    assert prefix_key(make_t3_cond(t3, seed=6), torch.float32) != key
+    assert prefix_key(t3_cond, torch.float16) != key
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from chatterbox.models.s3gen.batcher import S3GenBatcher
+from chatterbox.models.s3gen.s3gen import MEL_FLOOR, collate_ref_dicts
+from chatterbox.models.s3gen.utils.mel import mel_spectrogram
+
+
+@pytest.fixture(scope="module")
+def s3gen(tts):
+    return tts.s3gen
+
+
+@pytest.fixture(scope="module")
+def ref_dicts(s3gen):
+    "Ref dicts of tones of different lengths"
+    ref_dicts = []
+    for duration, f0 in [(1.2, 150), (0.8, 220), (1.6, 110)]:
+        t = torch.arange(int(duration * 24000)) / 24000
+        ref_dicts.append(s3gen.embed_ref((0.3 * torch.sin(2 * torch.pi * f0 * t))[None], 24000))
+    return ref_dicts
+
+
+@pytest.fixture(scope="module")
+def speech_tokens():
+    g = torch.Generator().manual_seed(0)
+    return [torch.randint(0, 6561, (n,), generator=g) for n in (20, 11, 27)]
+
+
+def test_collate_ref_dicts(ref_dicts):
+    # values may be numpy arrays
+    numpy_dict = {k: v.detach().numpy() if torch.is_tensor(v) else v for k, v in ref_dicts[1].items()}
+    collated = collate_ref_dicts([ref_dicts[0], numpy_dict, ref_dicts[2]], "cpu")
+    token_lens = [d["prompt_token"].size(1) for d in ref_dicts]
+    feat_lens = [d["prompt_feat"].size(1) for d in ref_dicts]
+    assert collated["prompt_token_len"].tolist() == token_lens
+    assert collated["prompt_feat_len"].tolist() == feat_lens
+    assert collated["prompt_token"].shape == (3, max(token_lens))
+    assert collated["prompt_feat"].shape == (3, max(feat_lens), 80)
+    assert collated["embedding"].shape == (3, 192)
+    for i, d in enumerate(ref_dicts):
+        assert torch.equal(collated["prompt_token"][i, :token_lens[i]], d["prompt_token"][0])
+        assert not collated["prompt_token"][i, token_lens[i]:].any()
+        assert torch.equal(collated["prompt_feat"][i, :feat_lens[i]], d["prompt_feat"][0])
+        assert torch.equal(collated["embedding"][i], d["embedding"].view(-1))
+
+
+def test_mel_floor_is_silence():
+    assert torch.allclose(mel_spectrogram(torch.zeros(1, 4800)), torch.tensor(MEL_FLOOR))
+
+
+@pytest.mark.parametrize("flow_params", [
+    dict(n_timesteps=2),
+    dict(n_timesteps=2, cfg_rate=0.0),
+    dict(n_timesteps=2, solver="heun", guidance_interval=(0.0, 0.5)),
+])
+def test_batched_mels_match_single_ones(s3gen, ref_dicts, speech_tokens, flow_params):
+    mels, mel_lens = s3gen.forward_batch(speech_tokens, ref_dicts, **flow_params)
+    for mel, mel_len, tokens, ref_dict in zip(mels, mel_lens.tolist(), speech_tokens, ref_dicts):
+        single = s3gen.flow_inference(tokens, ref_dict=dict(ref_dict), finalize=True, **flow_params)
+        assert single.size(2) == mel_len
+        # the padding of the batch changes the float rounding, but not what the items see
+        assert torch.allclose(mel[:, :mel_len], single[0], atol=1e-5)
+
+
+def test_single_item_batch_is_inference(s3gen, ref_dicts, speech_tokens):
+    # HiFT's source excitation is random
+    torch.manual_seed(0)
+    expected, _ = s3gen.inference(speech_tokens[0], ref_dict=dict(ref_dicts[0]), n_timesteps=2)
+    torch.manual_seed(0)
+    (wav,) = s3gen.inference_batch(speech_tokens[:1], ref_dicts[:1], n_timesteps=2)
+    assert torch.equal(wav, expected)
+
+
+def test_inference_batch_lengths(s3gen, ref_dicts, speech_tokens):
+    wavs = s3gen.inference_batch(speech_tokens, ref_dicts, n_timesteps=1)
+    for wav, tokens, ref_dict in zip(wavs, speech_tokens, ref_dicts):
+        expected, _ = s3gen.inference(tokens, ref_dict=dict(ref_dict), n_timesteps=1)
+        assert wav.shape == expected.shape
+        assert wav.isfinite().all()
+
+
+class FakeS3Gen:
+    "Records the batches of `inference_batch`; the waveform of an item is its tokens"
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.fail_on = fail_on
+        self.release = threading.Event()
+        self.release.set()
+
+    def inference_batch(self, speech_tokens, ref_dicts, **flow_params):
+        self.release.wait()
+        self.batches.append(([int(tokens[0]) for tokens in speech_tokens], flow_params))
+        if self.fail_on in self.batches[-1][0]:
+            raise ValueError("bad tokens")
+        return [tokens[None].float() for tokens in speech_tokens]
+
+
+def test_batcher_groups_by_flow_params():
+    fake = FakeS3Gen()
+    fake.release.clear()  # hold the first batch, so that the others queue
+    batcher = S3GenBatcher(fake, max_batch=2, max_wait=0.01)
+    try:
+        first = batcher.submit(torch.tensor([0]), {}, n_timesteps=10)
+        while not fake.batches and not batcher.queue:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        reqs = [
+            batcher.submit(torch.tensor([i]), {}, n_timesteps=4 if i % 2 else 10, guidance_interval=[0.0, 0.5])
+            for i in range(1, 6)
+        ]
+        fake.release.set()
+        results = [req.result(timeout=10) for req in [first] + reqs]
+    finally:
+        batcher.shutdown()
+
+    assert [int(wav[0, 0]) for wav in results] == list(range(6))
+    assert fake.batches[0] == ([0], dict(n_timesteps=10))
+    # up to 2 requests with the same flow parameters per batch, in submission order
+    later = [tokens for tokens, _ in fake.batches[1:]]
+    assert later == [[1, 3], [2, 4], [5]]
+
+
+def test_batcher_errors_and_shutdown():
+    batcher = S3GenBatcher(FakeS3Gen(fail_on=1), max_wait=0.0)
+    try:
+        with pytest.raises(ValueError, match="bad tokens"):
+            batcher.submit(torch.tensor([1]), {}).result(timeout=10)
+        # the batcher keeps serving after a failed batch
+        assert batcher.submit(torch.tensor([2]), {}).result(timeout=10).tolist() == [[2.0]]
+    finally:
+        batcher.shutdown()
+    with pytest.raises(RuntimeError, match="shut down"):
+        batcher.submit(torch.tensor([3]), {})
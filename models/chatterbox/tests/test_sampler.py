@@ -0,0 +1,90 @@
+import pytest
+import torch
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from chatterbox.models.t3.inference.sampler import T3Sampler
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+DIM = 32
+
+
+def hf_distribution(logits, history, temperature, top_p, min_p, repetition_penalty):
+    "The logits-processor chain that `T3Sampler` replaces, as the decode loop ran it"
+    logits = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)(history, logits)
+    logits = logits / temperature
+    logits = MinPLogitsWarper(min_p=min_p)(history, logits)
+    logits = TopPLogitsWarper(top_p=top_p)(history, logits)
+    return torch.softmax(logits, dim=-1)
+
+
+@pytest.fixture
+def hp():
+    return T3Config.multilingual()
+
+
+@pytest.fixture
+def head_weight(hp):
+    # scaled so that min-p prunes within the top-k at the usual temperatures, as with trained weights
+    return 0.2 * torch.randn(hp.speech_tokens_dict_size, DIM, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize("top_p,min_p,repetition_penalty,temperature", [
+    (0.95, 0.05, 1.2, 0.8),
+    (0.8, 0.05, 2.0, 0.8),
+    (1.0, 0.1, 1.0, 0.8),
+    # more tokens than the top-k candidates survive: without min-p, and with min-p at a high temperature
+    (0.95, 0.0, 1.2, 0.8),
+    (1.0, 0.0, 1.2, 0.8),
+    (0.95, 0.05, 1.2, 2.0),
+])
+def test_distribution_matches_hf_processors(hp, head_weight, top_p, min_p, repetition_penalty, temperature):
+    g = torch.Generator().manual_seed(1)
+    hidden = torch.randn(2, DIM, generator=g)  # conditional and unconditional rows
+    cfg_weight = 0.5
+
+    # CFG on the logits of the full head, restricted to the valid speech vocabulary
+    full = hidden @ head_weight.T
+    full = full[:1] + cfg_weight * (full[:1] - full[1:])
+    full = full[:, :hp.stop_speech_token + 1]
+    full[:, hp.start_speech_token] = float("-inf")
+
+    # a history with repeats, which includes some of the most likely tokens
+    history = torch.randint(0, hp.start_speech_token, (1, 40), generator=g)
+    history[0, :6] = full.topk(3).indices.repeat(1, 2)
+
+    sampler = T3Sampler(
+        head_weight, hp, temperature=temperature, top_p=top_p, min_p=min_p, repetition_penalty=repetition_penalty,
+    )
+    sampler.observe(history)
+    logits = sampler.logits(hidden, cfg_weight=cfg_weight)
+    probs = sampler.distribution(logits)
+    assert torch.allclose(logits, full, atol=1e-5)
+
+    n_kept = (probs > 0).sum()
+    assert 1 < n_kept
+    assert (n_kept < sampler.top_k) == (min_p > 0.0 and temperature < 1.0)
+    expected = hf_distribution(full, history, temperature, top_p, min_p, repetition_penalty)
+    assert torch.allclose(probs, expected, atol=1e-6)
+
+
+def test_sample_uses_generator_and_counts(hp, head_weight):
+    hidden = torch.randn(4, DIM, generator=torch.Generator().manual_seed(2))
+
+    def draw(seed):
+        sampler = T3Sampler(head_weight, hp, generator=torch.Generator().manual_seed(seed), batch_size=2)
+        tokens = [sampler.sample(sampler.logits(hidden, cfg_weight=0.5)) for _ in range(5)]
+        return torch.cat(tokens, dim=1), sampler
+
+    rng_state = torch.get_rng_state()
+    tokens, sampler = draw(3)
+    assert torch.equal(torch.get_rng_state(), rng_state)
+    assert torch.equal(draw(3)[0], tokens)
+
+    assert tokens.shape == (2, 5)
+    assert (tokens != hp.start_speech_token).all() and (tokens <= hp.stop_speech_token).all()
+    expected_counts = torch.zeros_like(sampler.counts).scatter_add_(1, tokens, torch.ones_like(tokens))
+    assert torch.equal(sampler.counts, expected_counts)
+
+    sampler.select(torch.tensor([1]))
+    assert torch.equal(sampler.counts, expected_counts[1:])
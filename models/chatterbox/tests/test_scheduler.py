@@ -0,0 +1,77 @@
+from concurrent.futures import CancelledError
+
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.scheduler import T3Scheduler
+
+from conftest import make_text_tokens
+
+
+def seeded(seed):
+    "Every request samples with its own generator, so results don't depend on the order of the random draws"
+    return torch.Generator().manual_seed(seed)
+
+
+@pytest.fixture(scope="module")
+def texts(t3):
+    return [make_text_tokens(t3, n, seed)[0] for seed, n in enumerate([12, 30, 20, 8, 25])]
+
+
+def sequential(t3, t3_cond, text_tokens, cfg_weight=0.5, **kwargs):
+    text_tokens = text_tokens[None].expand(2 if cfg_weight > 0.0 else 1, -1)
+    return t3.inference(t3_cond=t3_cond, text_tokens=text_tokens, use_prefix_cache=False, cfg_weight=cfg_weight, **kwargs)
+
+
+@torch.inference_mode()
+def test_matches_sequential_inference(t3, t3_cond, texts):
+    max_new_tokens = [40, 60, 25, 60, 50]
+    cfg_weights = [0.5, 0.5, 0.0, 0.5, 0.0]
+    expected = [
+        sequential(t3, t3_cond, tokens, cfg_weight=w, max_new_tokens=n, generator=seeded(i))
+        for i, (tokens, w, n) in enumerate(zip(texts, cfg_weights, max_new_tokens))
+    ]
+
+    # 3 rows at most: requests wait for others to retire, and join a batch whose rows are compacted
+    scheduler = T3Scheduler(t3, max_rows=3, kv_tokens=4096)
+    try:
+        reqs = [
+            scheduler.submit(t3_cond, tokens, cfg_weight=w, max_new_tokens=n, generator=seeded(i))
+            for i, (tokens, w, n) in enumerate(zip(texts, cfg_weights, max_new_tokens))
+        ]
+        results = [req.result(timeout=300) for req in reqs]
+        metrics = scheduler.metrics()
+    finally:
+        scheduler.shutdown()
+
+    assert len({r.size(1) for r in results}) > 1  # requests retire at different steps
+    for req, result, tokens in zip(reqs, results, expected):
+        assert torch.equal(result, tokens)
+        assert len(req.text_positions) == result.size(1)
+    assert metrics.completed_requests == len(texts)
+    assert metrics.total_tokens == sum(r.size(1) for r in results)
+    assert metrics.active_requests == 0 and metrics.queue_depth == 0
+    assert metrics.kv_cache.used_blocks == 0
+
+
+@torch.inference_mode()
+def test_cancel(t3, t3_cond, texts):
+    expected = sequential(t3, t3_cond, texts[2], max_new_tokens=20, generator=seeded(0))
+    scheduler = T3Scheduler(t3, max_rows=2)
+    try:
+        running = scheduler.submit(t3_cond, texts[0], max_new_tokens=200)
+        queued = scheduler.submit(t3_cond, texts[1], max_new_tokens=5)
+        queued.cancel()
+        running.cancel()
+        for req in (running, queued):
+            with pytest.raises(CancelledError):
+                req.result(timeout=300)
+
+        # the batch keeps going without them
+        after = scheduler.submit(t3_cond, texts[2], max_new_tokens=20, generator=seeded(0))
+        assert torch.equal(after.result(timeout=300), expected)
+        metrics = scheduler.metrics()
+    finally:
+        scheduler.shutdown()
+    assert metrics.cancelled_requests == 2
+    assert metrics.kv_cache.used_blocks == 0
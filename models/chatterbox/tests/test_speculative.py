@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.speculative_decode_engine import speculative_sample
+
+from conftest import make_t3, make_text_tokens
+
+
+def test_speculative_sample_follows_target_distribution():
+    g = torch.Generator().manual_seed(0)
+    n_vocab, n_samples = 8, 20000
+    p = torch.softmax(2 * torch.randn(1, n_vocab, generator=g), dim=-1)
+    q = torch.softmax(2 * torch.randn(1, n_vocab, generator=g), dim=-1)
+    q[0, 3] = 0.0  # a token the draft never proposes
+    q = q / q.sum()
+
+    counts = torch.zeros(n_vocab)
+    n_accepted = 0
+    for _ in range(n_samples):
+        draft = int(torch.multinomial(q, num_samples=1, generator=g))
+        token, accepted = speculative_sample(p, q, draft, g)
+        assert token == draft or not accepted
+        counts[token] += 1
+        n_accepted += accepted
+
+    # total variation to the target, ~0.01 for this many samples
+    assert 0.5 * (counts / n_samples - p[0]).abs().sum() < 0.02
+    # the acceptance rate is the overlap of the two distributions
+    assert n_accepted / n_samples == pytest.approx(torch.minimum(p, q).sum().item(), abs=0.02)
+
+
+def test_identical_distributions_always_accept():
+    p = torch.softmax(torch.randn(1, 8, generator=torch.Generator().manual_seed(1)), dim=-1)
+    g = torch.Generator().manual_seed(2)
+    assert all(speculative_sample(p, p.clone(), d, g) == (d, True) for d in range(8))
+
+
+@pytest.fixture(scope="module")
+def confident_t3():
+    "A model whose logits have large gaps, so that near-greedy sampling is deterministic"
+    t3 = make_t3(seed=1)
+    with torch.no_grad():
+        t3.speech_head.weight.mul_(100)
+    return t3
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("draft_layers,n_draft_tokens", [(4, 3), (10, 5)])
+def test_greedy_matches_regular_decoding(confident_t3, t3_cond, draft_layers, n_draft_tokens):
+    t3 = confident_t3
+    kwargs = dict(
+        t3_cond=t3_cond, max_new_tokens=40, temperature=1e-4, min_p=0.0, top_p=1.0, use_prefix_cache=False,
+        return_text_positions=True,
+    )
+    for seed in range(3):
+        text_tokens = make_text_tokens(t3, 16, seed).expand(2, -1)
+        expected, expected_positions = t3.inference(text_tokens=text_tokens, **kwargs)
+        tokens, positions = t3.inference(
+            text_tokens=text_tokens, draft_layers=draft_layers, n_draft_tokens=n_draft_tokens, **kwargs,
+        )
+        engine = t3.decode_engine
+
+        assert torch.equal(tokens, expected)
+        # the analyzer was stepped once per generated token, never on rejected drafts
+        assert positions == expected_positions
+        assert len(t3.alignment_stream_analyzer.positions) == tokens.size(1)
+        assert 0 < engine.n_accepted < engine.n_drafted  # both accepted and rejected drafts
+        assert engine.n_verify_steps < tokens.size(1)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import torch
+
+from chatterbox.models.s3gen.streaming import S3GenStreamer, fade_in_out
+
+
+@pytest.fixture(scope="module")
+def s3gen(tts):
+    return tts.s3gen
+
+
+@pytest.fixture(scope="module")
+def ref_dict(s3gen):
+    t = torch.arange(int(1.2 * 24000)) / 24000
+    return s3gen.embed_ref((0.3 * torch.sin(2 * torch.pi * 150 * t))[None], 24000)
+
+
+@pytest.fixture(scope="module")
+def speech_tokens():
+    return torch.randint(0, 6561, (70,), generator=torch.Generator().manual_seed(0))
+
+
+# small chunks, for several of them on a short utterance
+STREAM_PARAMS = dict(chunk_tokens=12, chunk_growth=2.0, max_chunk_tokens=24, overlap_tokens=4, n_timesteps=1)
+
+
+def test_fade_in_out():
+    window = torch.from_numpy(np.hamming(8)).float()
+    fade_in, fade_out = torch.ones(2, 10), torch.full((2, 6), 3.0)
+    out = fade_in_out(fade_in, fade_out, window)
+    assert out is fade_in  # in place
+    assert torch.allclose(out[:, :4], window[:4] + 3 * window[4:])
+    assert torch.equal(out[:, 4:], torch.ones(2, 6))
+
+
+@pytest.mark.parametrize("n_tokens", [70, 9])
+def test_stream_length_matches_inference(s3gen, ref_dict, speech_tokens, n_tokens):
+    tokens = speech_tokens[:n_tokens]
+    expected, _ = s3gen.inference(tokens, ref_dict=dict(ref_dict), n_timesteps=1)
+    pieces = list(s3gen.stream(tokens, dict(ref_dict), **STREAM_PARAMS))
+    # a single final chunk when there are less tokens than the first chunk
+    assert len(pieces) > 2 if n_tokens == 70 else len(pieces) == 1
+    assert sum(piece.size(1) for piece in pieces) == expected.size(1)
+    assert all(piece.isfinite().all() for piece in pieces)
+
+
+def test_pushed_tokens_stream_as_a_whole(s3gen, ref_dict, speech_tokens):
+    "Chunks only depend on the tokens, not on how they arrive"
+    # HiFT's source excitation is random
+    torch.manual_seed(0)
+    whole = torch.cat(list(s3gen.stream(speech_tokens, dict(ref_dict), **STREAM_PARAMS)), dim=1)
+    torch.manual_seed(0)
+    pieces = torch.cat(list(s3gen.stream(speech_tokens.split(5), dict(ref_dict), **STREAM_PARAMS)), dim=1)
+    assert torch.equal(pieces, whole)
+
+
+def test_chunks_take_the_noise_of_their_frames(s3gen, ref_dict, speech_tokens):
+    streamer = S3GenStreamer(s3gen, dict(ref_dict), **STREAM_PARAMS)
+    streamer.push(speech_tokens)
+    synthesize = streamer.synthesize()
+    prompt_len = ref_dict["prompt_feat"].size(1)
+    noise = s3gen.flow.decoder.rand_noise
+    for _ in range(3):
+        next(synthesize)
+        # the flow cache holds the noise and `mu` of the overlap, the last frames of the chunk
+        overlap = streamer.flow_cache.size(2)
+        assert overlap == streamer.mel_overlap_len
+        start = prompt_len + streamer.n_frames - overlap
+        assert torch.equal(streamer.flow_cache[..., 0], noise[:, :, start:start + overlap])
+        assert streamer.mel_overlap.size(2) == overlap
+        assert streamer.hift_cache["mel"].size(2) == streamer.mel_cache_len
+        assert streamer.hift_cache["speech"].size(1) == streamer.source_cache_len
+    assert streamer.chunk_tokens == STREAM_PARAMS["max_chunk_tokens"]
+
+    list(streamer.synthesize(finalize=True))
+    assert streamer.finished
+    with pytest.raises(RuntimeError, match="finished"):
+        streamer.push(speech_tokens[:1])
+
+
+def test_overlap_must_be_below_chunk(s3gen, ref_dict):
+    with pytest.raises(ValueError, match="overlap_tokens"):
+        S3GenStreamer(s3gen, ref_dict, chunk_tokens=10, overlap_tokens=10)
@@ -0,0 +1,84 @@
+"""
+The vectorized `VoiceEncoder` inference against the implementation it replaced, kept below as `reference_inference`:
+a Python loop over the partials of each utterance, and numpy mels.
+"""
+import librosa
+import numpy as np
+import pytest
+import torch
+
+from chatterbox.models.voice_encoder import VoiceEncoder
+from chatterbox.models.voice_encoder.melspec import melspectrogram, melspectrogram_torch
+from chatterbox.models.voice_encoder.voice_encoder import get_frame_step, get_num_wins, pack
+
+
+def reference_inference(ve, mels, mel_lens, overlap=0.5, rate=None, min_coverage=0.8):
+    "The previous `VoiceEncoder.inference`, which sliced the partials one by one and averaged them per utterance"
+    frame_step = get_frame_step(overlap, rate, ve.hp)
+    n_partials, target_lens = zip(*(get_num_wins(n, frame_step, min_coverage, ve.hp) for n in mel_lens))
+    len_diff = max(target_lens) - mels.size(1)
+    if len_diff > 0:
+        mels = torch.cat((mels, torch.zeros(mels.size(0), len_diff, ve.hp.num_mels)), dim=1)
+
+    partials = torch.stack([
+        mel[i * frame_step: i * frame_step + ve.hp.ve_partial_frames]
+        for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
+    ])
+    partial_embeds = ve(partials)
+    slices = np.concatenate(([0], np.cumsum(n_partials)))
+    raw_embeds = torch.stack([partial_embeds[start:end].mean(dim=0) for start, end in zip(slices[:-1], slices[1:])])
+    return raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
+
+
+@pytest.fixture(scope="module")
+def ve():
+    torch.manual_seed(0)
+    return VoiceEncoder().eval()
+
+
+def random_mels(lengths, n_mels, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return [torch.rand(n, n_mels, generator=g) for n in lengths]
+
+
+def test_pack():
+    arrays = random_mels([3, 7, 1], 4)
+    packed = pack(arrays, seq_len=9)
+    assert packed.shape == (3, 9, 4)
+    for i, array in enumerate(arrays):
+        assert torch.equal(packed[i, :len(array)], array)
+        assert not packed[i, len(array):].any()
+    assert torch.equal(pack([[1, 2], [3]]), torch.tensor([[1, 2], [3, 0]]))
+
+
+@torch.inference_mode()
+@pytest.mark.parametrize("rate,batch_size", [(None, None), (1.3, None), (1.3, 3)])
+def test_inference_matches_reference(ve, rate, batch_size):
+    # shorter than a partial, exactly one, and several with a partial last one
+    mel_lens = [30, ve.hp.ve_partial_frames, 517, 1000]
+    mels = random_mels(mel_lens, ve.hp.num_mels)
+    embeds = ve.inference(pack(mels), mel_lens, rate=rate, batch_size=batch_size)
+    expected = reference_inference(ve, pack(mels), mel_lens, rate=rate)
+    assert torch.allclose(embeds, expected, atol=1e-6)
+
+
+def test_melspectrogram_torch(ve):
+    rng = np.random.default_rng(0)
+    wavs = (0.1 * rng.standard_normal((2, 16000))).astype(np.float32)
+    mels = melspectrogram_torch(torch.from_numpy(wavs), ve.hp)
+    for wav, mel in zip(wavs, mels):
+        assert torch.allclose(mel, torch.from_numpy(melspectrogram(wav, ve.hp)).float(), rtol=1e-4, atol=1e-5)
+
+
+@torch.inference_mode()
+def test_embeds_from_wavs_matches_reference(ve):
+    rng = np.random.default_rng(1)
+    sr = ve.hp.sample_rate
+    # two wavs of the same length share a STFT
+    wavs = [(0.1 * rng.standard_normal(n)).astype(np.float32) for n in (3 * sr, 3 * sr, int(7.3 * sr), sr // 2)]
+    embeds = ve.embeds_from_wavs(wavs, sr)
+
+    trimmed = [librosa.effects.trim(wav, top_db=20)[0] for wav in wavs]
+    mels = [torch.from_numpy(melspectrogram(wav, ve.hp).T).float() for wav in trimmed]
+    expected = reference_inference(ve, pack(mels), [len(mel) for mel in mels], rate=1.3)
+    assert np.allclose(embeds, expected.numpy(), atol=1e-6)
@@ -0,0 +1,134 @@
+import os
+import zlib
+
+import pytest
+import torch
+
+from chatterbox.mtl_tts import VoiceIndex
+
+from conftest import write_reference
+
+
+class FakeEmbedder:
+    "Embeds files by their content, as the voice encoder would, and records the files it's called with"
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, wav_fpaths):
+        self.calls.append([os.path.basename(fpath) for fpath in wav_fpaths])
+        embeds = []
+        for fpath in wav_fpaths:
+            content = open(fpath, "rb").read()
+            if content == b"corrupted":
+                raise ValueError(f"can't decode {fpath}")
+            embeds.append(torch.randn(8, generator=torch.Generator().manual_seed(zlib.crc32(content))))
+        return 3 * torch.stack(embeds)  # not normalized
+
+
+def write_voice(library, name, content: str):
+    fpath = library / name
+    fpath.write_bytes(content.encode())
+    return str(fpath)
+
+
+def voices(library):
+    return sorted(str(library / name) for name in os.listdir(library))
+
+
+@pytest.fixture
+def library(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    for i in range(4):
+        write_voice(library, f"v{i}.wav", f"voice {i}")
+    return library
+
+
+def test_refresh_embeds_only_changed_files(library, tmp_path):
+    embed = FakeEmbedder()
+    index = VoiceIndex(tmp_path / "index.safetensors", model_version="v1")
+    assert index.refresh(voices(library), embed) == (["v0.wav", "v1.wav", "v2.wav", "v3.wav"], [])
+    assert index.refresh(voices(library), embed) == ([], [])
+    assert len(embed.calls) == 1
+    assert torch.allclose(index.embeds.norm(dim=1), torch.ones(4))
+
+    # a removed, a modified (with another size) and an added file
+    os.remove(library / "v1.wav")
+    write_voice(library, "v2.wav", "voice 2, again")
+    write_voice(library, "v4.wav", "voice 4")
+    added, removed = index.refresh(voices(library), embed)
+    assert (sorted(added), removed) == (["v2.wav", "v4.wav"], ["v1.wav"])
+    assert sorted(embed.calls[-1]) == ["v2.wav", "v4.wav"]
+    assert sorted(index.names) == ["v0.wav", "v2.wav", "v3.wav", "v4.wav"]
+
+    # the embeddings follow their names
+    for name, row in zip(index.names, index.embeds):
+        expected = torch.nn.functional.normalize(FakeEmbedder()([str(library / name)]), dim=1)[0]
+        assert torch.allclose(row, expected)
+
+    # persisted, unless the model changed
+    loaded = VoiceIndex(tmp_path / "index.safetensors", model_version="v1")
+    assert loaded.names == index.names and torch.equal(loaded.embeds, index.embeds)
+    assert len(VoiceIndex(tmp_path / "index.safetensors", model_version="v2")) == 0
+
+
+def test_refresh_leaves_out_failing_files(library, tmp_path):
+    embed = FakeEmbedder()
+    write_voice(library, "bad.wav", "corrupted")
+    index = VoiceIndex(tmp_path / "index.safetensors", model_version="v1")
+    added, _ = index.refresh(voices(library), embed)
+    assert sorted(added) == ["v0.wav", "v1.wav", "v2.wav", "v3.wav"]
+    assert "bad.wav" not in index.names
+
+    # only retried once modified
+    n_calls = len(embed.calls)
+    assert index.refresh(voices(library), embed) == ([], [])
+    assert len(embed.calls) == n_calls
+    write_voice(library, "bad.wav", "fixed voice")
+    assert index.refresh(voices(library), embed) == (["bad.wav"], [])
+
+
+def test_search_and_duplicates(library, tmp_path):
+    write_voice(library, "copy.wav", "voice 2")
+    index = VoiceIndex(tmp_path / "index.safetensors", model_version="v1")
+    index.refresh(voices(library), FakeEmbedder())
+
+    query = FakeEmbedder()([str(library / "v2.wav")])
+    results = index.search(query, k=3)
+    assert len(results) == 1 and len(results[0]) == 3
+    assert sorted(name for name, _ in results[0][:2]) == ["copy.wav", "v2.wav"]
+    assert results[0][0][1] == pytest.approx(1.0)
+    assert [score for _, score in results[0]] == sorted((score for _, score in results[0]), reverse=True)
+    # all the voices when there are less than `k`
+    assert len(index.search(query[0], k=100)[0]) == len(index)
+
+    duplicates = index.near_duplicates(threshold=0.999)
+    assert [(sorted(pair[:2]), pytest.approx(pair[2])) for pair in duplicates] == [(["copy.wav", "v2.wav"], 1.0)]
+
+
+def test_assign(library, tmp_path):
+    index = VoiceIndex(tmp_path / "index.safetensors", model_version="v1")
+    assert index.assign(["Alice"]) == {}
+    index.refresh(voices(library), FakeEmbedder())
+
+    assigned = index.assign(["V2", "Alice", "Bob"], taken=["v1.wav"])
+    assert assigned["V2"] == "v2.wav"  # named after the speaker
+    assert len({assigned["Alice"], assigned["Bob"], "v1.wav", "v2.wav"}) == 4  # distinct voices while there are some
+
+    # the voice of Alice is the one least similar to the picked ones
+    scores = index.embeds @ index.embeds.T
+    picked = [index.names.index("v1.wav"), index.names.index("v2.wav")]
+    unused = [i for i in range(len(index)) if i not in picked]
+    assert assigned["Alice"] == index.names[max(unused, key=lambda i: -scores[i, picked].max())]
+
+    # voices are reused once all were picked
+    assert len(set(index.assign([f"speaker {i}" for i in range(6)]).values())) == 4
+
+
+@torch.inference_mode()
+def test_speaker_embeddings_are_the_conditionals_ones(tts, tmp_path):
+    fpaths = [write_reference(tmp_path / f"ref{i}.wav", 3 + i, 24000, seed=i) for i in range(2)]
+    embeds = tts.speaker_embeddings(fpaths)
+    conds = tts.prepare_conditionals_batch(fpaths)
+    assert torch.allclose(embeds, torch.cat([c.t3.speaker_emb for c in conds]), atol=1e-6)
+    assert torch.allclose(embeds.norm(dim=1), torch.ones(2))
@@ -0,0 +1,57 @@
+import os
+
+import torch
+
+from chatterbox.mtl_tts import Conditionals, VoiceProfileStore
+
+from conftest import make_conditionals
+
+
+def assert_same_conditionals(a: Conditionals, b: Conditionals):
+    for k, v in a.t3.__dict__.items():
+        w = getattr(b.t3, k)
+        assert torch.equal(v, w) if torch.is_tensor(v) else v == w, k
+    assert a.gen.keys() == b.gen.keys()
+    for k, v in a.gen.items():
+        w = b.gen[k]
+        assert torch.equal(v, w) and v.dtype == w.dtype if torch.is_tensor(v) else v == w, k
+
+
+def test_safetensors_round_trip(t3, tmp_path):
+    conds = make_conditionals(t3)
+    conds.gen["fmax"] = 8000  # a scalar, which goes into the header as `None` values do
+    conds.save_safetensors(tmp_path / "voice.safetensors", metadata={"key": "abc"})
+
+    loaded, metadata = Conditionals.load_safetensors(tmp_path / "voice.safetensors")
+    assert metadata == {"key": "abc"}
+    assert loaded.t3.clap_emb is None and loaded.gen["prompt_feat_len"] is None
+    assert_same_conditionals(conds, loaded)
+
+
+def test_voice_profile_store(t3, tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    wav = library / "narrator.wav"
+    wav.write_bytes(b"RIFF")
+    conds = make_conditionals(t3)
+
+    store = VoiceProfileStore(tmp_path / "profiles", library, model_version="v1")
+    assert store.covers(wav) and store.covers(library / ".." / "library" / "other.wav")
+    assert not store.covers(tmp_path / "upload.wav")
+
+    assert store.load(wav, "key") is None
+    store.save(wav, "key", conds)
+    assert os.listdir(tmp_path / "profiles") == ["narrator.wav.safetensors"]  # no temporary file left
+    assert_same_conditionals(store.load(wav, "key"), conds)
+    assert (store.hits, store.misses) == (1, 1)
+
+    # another reference content or another checkpoint miss
+    assert store.load(wav, "other key") is None
+    assert VoiceProfileStore(tmp_path / "profiles", library, model_version="v2").load(wav, "key") is None
+
+    # a corrupted profile misses, and is overwritten
+    store.path(wav).write_bytes(b"garbage")
+    assert store.load(wav, "key") is None
+    store.save(wav, "key", conds)
+    assert store.load(wav, "key") is not None
+    assert (store.hits, store.misses) == (2, 3)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Split
+
+from chatterbox.models.s3tokenizer import S3_TOKEN_RATE
+from chatterbox.models.tokenizers.tokenizer import EOT, SOT, SPACE, UNK, MTLTokenizer
+from chatterbox.mtl_tts import WordTimestamp, word_timestamps
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    "A character-level `MTLTokenizer`, without the Cangjie tables that the real one downloads"
+    specials = [SOT, EOT, UNK, SPACE, "[en]"]
+    vocab = {token: i for i, token in enumerate(specials + list("abcdefghijklmnopqrstuvwxyz.,!?'"))}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token=UNK))
+    tokenizer.pre_tokenizer = Split("", behavior="isolated")
+    tokenizer.add_special_tokens(specials)
+
+    mtl = MTLTokenizer.__new__(MTLTokenizer)
+    mtl.tokenizer = tokenizer
+    return mtl
+
+
+def encode(tokenizer, text):
+    "Text tokens as `ChatterboxMultilingualTTS.generate` builds them, with the start / stop text tokens"
+    vocab = tokenizer.tokenizer.get_vocab()
+    return [vocab[SOT]] + tokenizer.encode(text, language_id="en") + [vocab[EOT]]
+
+
+def test_word_spans(tokenizer):
+    text = "Hello big, world!"
+    seq = encode(tokenizer, text)
+    spans = tokenizer.word_spans(torch.tensor(seq))
+    assert [word for word, _, _ in spans] == ["hello", "big,", "world!"]
+    for word, start, end in spans:
+        assert tokenizer.decode(seq[start:end]) == word
+
+    # given words replace the decoded ones, when they match one to one
+    assert [w for w, _, _ in tokenizer.word_spans(seq, words=text.split())] == ["Hello", "big,", "world!"]
+    assert [w for w, _, _ in tokenizer.word_spans(seq, words=["Hello"])] == ["hello", "big,", "world!"]
+
+
+def test_word_timestamps():
+    spans = [("a", 2, 4), ("bb", 5, 8), ("c", 9, 10), ("never", 11, 14)]
+    # the alignment steps back at the 6th token; "never" is past the last position
+    positions = [0, 1, 2, 2, 3, 1, 5, 6, 7, 7, 8, 9, 9]
+    timestamps = word_timestamps(spans, positions)
+
+    def seconds(n_tokens):
+        return n_tokens / S3_TOKEN_RATE
+
+    assert timestamps == [
+        WordTimestamp("a", seconds(2), seconds(6)),
+        WordTimestamp("bb", seconds(6), seconds(10)),
+        WordTimestamp("c", seconds(11), seconds(13)),
+        WordTimestamp("never", seconds(13), seconds(13)),
+    ]
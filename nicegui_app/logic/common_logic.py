@@ -1,9 +1,11 @@
 import os
-from nicegui import ui
-from nicegui_app.models.chatterbox_wrapper import LANGUAGES
+from nicegui import run, ui
+from nicegui_app.models.chatterbox_wrapper import LANGUAGES, preload_voice, assign_voices, closest_voices
 from typing import List
 
 DEFAULT_VOICE_LIBRARY = "./voice_library"
+# Precomputed conditionals of the voice library, see `VoiceProfileStore`
+DEFAULT_VOICE_PROFILES = "./voice_profiles"
 DEFAULT_PROJECT_DIRECTORY = "./projects"
 DEFAULT_OUTPUT_DIRECTORY = "./output"
 
@@ -84,4 +86,21 @@ def load_audio_to_player(
         if profile_select:
             profile_select.value = None
             profile_select.update()
-            
\ No newline at end of file
+            
+
+
+async def preload_voice_profile(file_name: str, directory_path: str = DEFAULT_VOICE_LIBRARY):
+    """Loads a voice when it's selected, so that generation doesn't have to wait for it."""
+    if file_name:
+        await run.io_bound(preload_voice, os.path.join(directory_path, file_name))
+
+
+async def auto_assign_voices(speakers: List[str], taken: List[str] = None) -> dict:
+    """Library voice for each speaker, as distinct as possible; empty if the model isn't loaded."""
+    return await run.io_bound(assign_voices, speakers, taken)
+
+
+async def closest_library_voice(file_path: str):
+    """`(name, similarity)` of the library voice closest to an audio file, or None."""
+    matches = await run.io_bound(closest_voices, file_path, 1)
+    return matches[0] if matches else None
@@ -1,9 +1,10 @@
 import os
 import json
 import re
+import shutil
 import numpy as np
 import scipy.io.wavfile as wavfile
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from typing import Optional, List, Dict, Tuple
 
 from nicegui import run
@@ -17,6 +18,9 @@ from nicegui_app.logic.common_logic import (
     DEFAULT_OUTPUT_DIRECTORY,
 )
 
+# Subtitle cues are cut at this many characters, at word boundaries
+SUBTITLE_MAX_CHARS = 42
+
 
 def _split_text_preserving_words(text: str, max_length: int) -> List[str]:
     text = text.strip()
@@ -161,6 +165,41 @@ def cleanup_temp_files(project_name: str):
         print(f"Error during cleanup: {e}")
 
 
+def word_timestamps_path(audio_path: str) -> str:
+    """Sidecar file with the word timings of a line's audio, eg `line.wav` -> `line.words.json`."""
+    return os.path.splitext(audio_path)[0] + ".words.json"
+
+
+def load_word_timestamps(audio_path: str) -> Optional[List[Dict]]:
+    path = word_timestamps_path(audio_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading word timestamps: {e}")
+        return None
+
+
+def move_line_audio(src_path: str, dst_path: str):
+    """Moves a line's audio over another one, together with its word timings."""
+    shutil.move(src_path, dst_path)
+    src_words, dst_words = word_timestamps_path(src_path), word_timestamps_path(dst_path)
+    if os.path.exists(src_words):
+        shutil.move(src_words, dst_words)
+    elif os.path.exists(dst_words):
+        os.remove(dst_words)
+
+
+def remove_line_audio(path: str):
+    """Removes a line's audio, together with its word timings."""
+    os.remove(path)
+    words_path = word_timestamps_path(path)
+    if os.path.exists(words_path):
+        os.remove(words_path)
+
+
 def get_current_model_max_chars() -> int:
     app_state = get_state()
     model_name = app_state.active_model
@@ -225,7 +264,7 @@ def get_next_sequence_number(metadata_list: List[Dict], project_name: str) -> in
 def generate_and_save_audio(
     text: str, voice_path: str, output_path: str, language: str, controls: dict
 ):
-    sr, audio_array = generate_tts_audio(
+    sr, audio_array, words = generate_tts_audio(
         text_input=text,
         language_id=language,
         audio_prompt_path_input=voice_path,
@@ -236,9 +275,18 @@ def generate_and_save_audio(
         repetition_penalty_input=controls["repetition_penalty"],
         min_p_input=controls["min_p"],
         top_p_input=controls["top_p"],
+        return_word_timestamps=True,
+        quality_input=controls.get("quality", "standard"),
     )
     wavfile.write(output_path, sr, audio_array)
 
+    words_path = word_timestamps_path(output_path)
+    if words:
+        with open(words_path, "w", encoding="utf-8") as f:
+            json.dump([asdict(w) for w in words], f, indent=4, ensure_ascii=False)
+    elif os.path.exists(words_path):
+        os.remove(words_path)
+
     return {k: v for k, v in controls.items()}
 
 
@@ -261,6 +309,9 @@ def merge_and_save_audio(project_name: str, ui_lines: List[LineData]) -> Optiona
 
     combined_audio = []
     sample_rate = None
+    # subtitle cues, timed from the start of the merged audio
+    cues = []
+    offset = 0.0
 
     for line in metadata_lines:
         if not line.file_name:
@@ -278,6 +329,9 @@ def merge_and_save_audio(project_name: str, ui_lines: List[LineData]) -> Optiona
                 sample_rate = sr
 
             combined_audio.append(data)
+            duration = len(data) / sample_rate
+            cues.extend(_subtitle_cues(line.text, load_word_timestamps(file_path), offset, duration))
+            offset += duration
             pause_duration = ui_pauses.get(line.file_name, line.pause)
 
             if pause_duration > 0:
@@ -285,6 +339,7 @@ def merge_and_save_audio(project_name: str, ui_lines: List[LineData]) -> Optiona
                 if silence_samples > 0:
                     silence = np.zeros(silence_samples, dtype=data.dtype)
                     combined_audio.append(silence)
+                    offset += silence_samples / sample_rate
 
         except Exception as e:
             print(f"Error processing {line.file_name}: {e}")
@@ -297,4 +352,73 @@ def merge_and_save_audio(project_name: str, ui_lines: List[LineData]) -> Optiona
     output_path = os.path.join(DEFAULT_OUTPUT_DIRECTORY, output_filename)
 
     wavfile.write(output_path, sample_rate, final_wave)
+
+    base_path = os.path.splitext(output_path)[0]
+    _write_srt(base_path + ".srt", cues)
+    _write_vtt(base_path + ".vtt", cues)
     return output_filename
+
+
+def _subtitle_cues(
+    text: str, words: Optional[List[Dict]], offset: float, duration: float
+) -> List[Tuple[float, float, List[Dict]]]:
+    """
+    Cuts a line into `(start, end, words)` subtitle cues of at most SUBTITLE_MAX_CHARS characters, shifted by the
+    `offset` of the line in the merged audio. Lines without word timings, eg generated before they were recorded,
+    get a single cue over their whole audio.
+    """
+    if not words:
+        if not text.strip():
+            return []
+        return [(offset, offset + duration, [{"word": text.strip(), "start": 0.0, "end": duration}])]
+
+    cues = []
+    current = []
+    for word in words:
+        if current and len(" ".join(w["word"] for w in current + [word])) > SUBTITLE_MAX_CHARS:
+            cues.append(current)
+            current = []
+        current.append(word)
+    if current:
+        cues.append(current)
+
+    # a cue lasts until the next one starts, and the last one until the end of the line
+    timed = []
+    for i, cue in enumerate(cues):
+        end = cues[i + 1][0]["start"] if i + 1 < len(cues) else duration
+        end = min(max(end, cue[-1]["end"]), duration)
+        start = min(cue[0]["start"], end)
+        shifted = [
+            {**w, "start": offset + min(w["start"], end), "end": offset + min(w["end"], end)}
+            for w in cue
+        ]
+        timed.append((offset + start, offset + end, shifted))
+    return timed
+
+
+def _format_timestamp(seconds: float, separator: str) -> str:
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+
+def _write_srt(path: str, cues: List[Tuple[float, float, List[Dict]]]):
+    with open(path, "w", encoding="utf-8") as f:
+        for i, (start, end, words) in enumerate(cues, start=1):
+            f.write(f"{i}\n")
+            f.write(f"{_format_timestamp(start, ',')} --> {_format_timestamp(end, ',')}\n")
+            f.write(" ".join(w["word"] for w in words) + "\n\n")
+
+
+def _write_vtt(path: str, cues: List[Tuple[float, float, List[Dict]]]):
+    """WebVTT subtitles, with a timestamp tag before each word after the first, for word-by-word highlighting."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("WEBVTT\n\n")
+        for start, end, words in cues:
+            f.write(f"{_format_timestamp(start, '.')} --> {_format_timestamp(end, '.')}\n")
+            text = words[0]["word"]
+            for w in words[1:]:
+                text += f" <{_format_timestamp(w['start'], '.')}>{w['word']}"
+            f.write(text + "\n\n")
@@ -1,5 +1,5 @@
-import random
-import numpy as np
+import os
+
 import torch
 
 from chatterbox.mtl_tts import ChatterboxMultilingualTTS
@@ -70,6 +70,13 @@ repetition_penalty = {
     "step": 0.05,
     "label": "Repetition Penalty",
 }
+# Persisted `VoiceIndex` of the voice library, next to the voice profiles
+VOICE_INDEX_FILE = "voice_index.safetensors"
+quality = {
+    "options": ["draft", "standard", "high"],
+    "default": "standard",
+    "label": "Quality (draft is faster, for previews)",
+}
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 MODEL = None
@@ -83,6 +90,22 @@ def get_or_load_model():
             MODEL = ChatterboxMultilingualTTS.from_pretrained(DEVICE)
             if hasattr(MODEL, "to") and str(MODEL.device) != DEVICE:
                 MODEL.to(DEVICE)
+            # Concurrent generations (eg audiobook lines) share T3 decode steps
+            MODEL.enable_scheduler()
+            # ... and are vocoded together
+            MODEL.enable_s3gen_batching()
+            # Lines spoken by the same voice reuse its conditionals instead of re-embedding the reference audio
+            MODEL.enable_conds_cache()
+            # ... and are persisted across restarts for the voice library
+            from nicegui_app.logic.common_logic import (  # circular import
+                DEFAULT_VOICE_LIBRARY,
+                DEFAULT_VOICE_PROFILES,
+            )
+
+            MODEL.enable_voice_profiles(DEFAULT_VOICE_PROFILES, DEFAULT_VOICE_LIBRARY)
+            # Speaker embeddings of the library, to compare voices
+            MODEL.enable_voice_index(os.path.join(DEFAULT_VOICE_PROFILES, VOICE_INDEX_FILE))
+            refresh_voice_index()
             print(
                 f"Model loaded successfully. Internal device: {getattr(MODEL, 'device', 'N/A')}"
             )
@@ -92,13 +115,83 @@ def get_or_load_model():
     return MODEL
 
 
-def set_seed(seed: int):
-    torch.manual_seed(seed)
-    if DEVICE == "cuda":
-        torch.cuda.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)
-    random.seed(seed)
-    np.random.seed(seed)
+def make_generator(seed: int, device=DEVICE) -> torch.Generator:
+    """Per-request RNG, so that seeding one generation doesn't reseed the whole process."""
+    return torch.Generator(device=device).manual_seed(seed)
+
+
+def get_scheduler_metrics():
+    """Tokens/sec, queue depth etc of the T3 scheduler, or None if the model isn't loaded."""
+    if MODEL is None or MODEL.t3_scheduler is None:
+        return None
+    return MODEL.t3_scheduler.metrics()
+
+
+def preload_voice(audio_prompt_path: str):
+    """Loads (or computes) the conditionals of a voice into the cache, if the model is loaded."""
+    if MODEL is None:
+        return
+    try:
+        MODEL.load_conditionals(audio_prompt_path)
+    except Exception as e:
+        print(f"Error preloading voice {audio_prompt_path}: {e}")
+
+
+def refresh_voice_index():
+    """
+    Updates the voice index to the files of the voice library, embedding only the new or modified ones, and returns
+    it; None if the model isn't loaded.
+    """
+    if MODEL is None or MODEL.voice_index is None:
+        return None
+    from nicegui_app.logic.common_logic import DEFAULT_VOICE_LIBRARY, get_audio_files  # circular import
+
+    files = [os.path.join(DEFAULT_VOICE_LIBRARY, name) for name in get_audio_files(DEFAULT_VOICE_LIBRARY)]
+    try:
+        added, removed = MODEL.refresh_voice_index(files)
+        if added:
+            for name_a, name_b, score in MODEL.voice_index.near_duplicates():
+                if name_a in added or name_b in added:
+                    print(f"Voices '{name_a}' and '{name_b}' are near duplicates ({score:.0%} similar)")
+    except Exception as e:
+        print(f"Error updating the voice index: {e}")
+    return MODEL.voice_index
+
+
+def closest_voices(audio_prompt_path: str, k: int = 3):
+    """`(name, similarity)` of the `k` library voices closest to a reference audio, eg an upload; [] without model."""
+    index = refresh_voice_index()
+    if not index:
+        return []
+    try:
+        return index.search(MODEL.speaker_embeddings([audio_prompt_path]), k=k)[0]
+    except Exception as e:
+        print(f"Error comparing {audio_prompt_path} with the voice library: {e}")
+        return []
+
+
+def near_duplicate_voices(threshold: float = 0.95):
+    """`(name_a, name_b, similarity)` of the library voices which are near duplicates; [] without model."""
+    index = refresh_voice_index()
+    if not index:
+        return []
+    return index.near_duplicates(threshold)
+
+
+def assign_voices(speakers, taken=None):
+    """Library voice for each speaker, as distinct from each other and the `taken` ones as possible (see `VoiceIndex.assign`)."""
+    index = refresh_voice_index()
+    if not index:
+        return {}
+    return index.assign(speakers, taken=[name for name in taken or [] if name])
+
+
+def get_conds_cache_stats():
+    """Hits, misses and size of the voice conditionals cache, or None if the model isn't loaded."""
+    if MODEL is None or MODEL.conds_cache is None:
+        return None
+    cache = MODEL.conds_cache
+    return {"hits": cache.hits, "misses": cache.misses, "entries": len(cache)}
 
 
 def generate_tts_audio(
@@ -111,15 +204,22 @@ def generate_tts_audio(
     cfg_input: float = 0.5,
     repetition_penalty_input=2.0,
     min_p_input=0.05,
-    top_p_input=1.0
+    top_p_input=1.0,
+    return_word_timestamps=False,
+    quality_input="standard",
 ):
+    """
+    Returns `(sr, wav)`, or `(sr, wav, words)` with the `WordTimestamp`s of the text if `return_word_timestamps`.
+    `quality_input` is one of the S3Gen flow presets, see `quality`.
+    """
     current_model = get_or_load_model()
 
     if current_model is None:
         raise RuntimeError("TTS model is not loaded.")
 
+    generator = None
     if seed_num_input != 0:
-        set_seed(int(seed_num_input))
+        generator = make_generator(int(seed_num_input), device=current_model.device)
 
     print(f"Generating audio for text: '{text_input[:50]}...'")
 
@@ -133,7 +233,13 @@ def generate_tts_audio(
         repetition_penalty=repetition_penalty_input,
         min_p=min_p_input,
         top_p=top_p_input,
+        generator=generator,
+        return_word_timestamps=return_word_timestamps,
+        flow_preset=quality_input,
     )
+    words = None
+    if return_word_timestamps:
+        raw_wav, words = raw_wav
 
     wav = raw_wav.squeeze(0).numpy()
 
@@ -141,4 +247,6 @@ def generate_tts_audio(
         print("Clearing CUDA cache...")
         torch.cuda.empty_cache()
     print("Audio generation complete.")
+    if return_word_timestamps:
+        return (current_model.sr, wav, words)
     return (current_model.sr, wav)
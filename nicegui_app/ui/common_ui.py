@@ -1,6 +1,10 @@
 from nicegui import ui
 from nicegui_app.ui.styles import Style
-from nicegui_app.logic.common_logic import update_audio_dropdown
+from nicegui_app.logic.common_logic import (
+    update_audio_dropdown,
+    preload_voice_profile,
+    closest_library_voice,
+)
 import os
 
 
@@ -45,6 +49,7 @@ def render_saved_profiles_dropdown(classes = ""):
         .props("outlined dense")
     )
     update_audio_dropdown(profile_select)
+    profile_select.on_value_change(lambda e: preload_voice_profile(e.value))
     return profile_select
 
 
@@ -199,6 +204,11 @@ async def handle_file_upload(
             upload_component.visible = False
             player_container.visible = True
 
+        closest = await closest_library_voice(temp_filepath)
+        if closest:
+            name, similarity = closest
+            ui.notify(f"Closest library voice: {name} ({similarity:.0%} similar)", timeout=4000)
+
     except Exception as err:
         ui.notify(f"Error saving file: {err}", type="negative")
         upload_component.visible = True
@@ -12,6 +12,7 @@ from nicegui_app.models.chatterbox_wrapper import (
     top_p,
     min_p,
     repetition_penalty,
+    quality,
 )
 from nicegui_app.logic.common_logic import update_audio_dropdown, load_audio_to_player, DEFAULT_VOICE_LIBRARY
 
@@ -105,6 +106,13 @@ def _render_chatterbox_sliders(controls):
         repetition_penalty["default"],
     )
 
+    with ui.column().classes(Style.slider_box):
+        controls["quality"] = (
+            ui.select(options=quality["options"], value=quality["default"], label=quality["label"])
+            .classes("w-full")
+            .props("outlined dense")
+        )
+
     DEFAULT_SEED_VALUE = 0
     with ui.column().classes(
         "w-full mt-2 p-2 bg-gray-50 rounded-lg border border-gray-100"
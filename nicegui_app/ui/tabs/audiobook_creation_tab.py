@@ -1,4 +1,5 @@
 
+import asyncio
 import json
 import os
 import re
@@ -9,6 +10,7 @@ import nicegui_app.logic.tabs.audiobook_creation_logic as acl
 from nicegui import ui, run
 from nicegui_app.logic.app_state import get_state
 from nicegui_app.logic.common_logic import (
+    auto_assign_voices,
     get_audio_files,
     update_language_dropdown,
     DEFAULT_PROJECT_DIRECTORY,
@@ -22,6 +24,9 @@ from nicegui_app.ui.models.chatterbox_ui import chatterbox_controls
 from nicegui_app.ui.styles import Style
 from typing import List, Dict
 
+# Lines generated at once by `process_audio_generation`, ie requests in flight for the T3 scheduler
+MAX_CONCURRENT_LINES = 8
+
 
 def extract_control_values(controls_ui: dict) -> dict:
     return {k: v.value for k, v in controls_ui.items()}
@@ -97,7 +102,7 @@ def render_line_row(item: acl.LineData, project_name: str, generator_callback):
                     original_path = os.path.join(
                         DEFAULT_PROJECT_DIRECTORY, project_name, item.file_name
                     )
-                    shutil.move(candidate_state["path"], original_path)
+                    acl.move_line_audio(candidate_state["path"], original_path)
 
                     acl.update_metadata_entry(
                         project_name,
@@ -122,7 +127,7 @@ def render_line_row(item: acl.LineData, project_name: str, generator_callback):
                 temp_path = candidate_state.get("path")
                 if temp_path and os.path.exists(temp_path):
                     try:
-                        os.remove(temp_path)
+                        acl.remove_line_audio(temp_path)
                         candidate_state["path"] = None
                     except Exception as e:
                         print(f"Error removing temp file: {e}")
@@ -265,6 +270,7 @@ async def process_audio_generation(
 
     control_values = extract_control_values(controls_dict)
 
+    jobs = []
     for line in lines:
         if not line.voice:
             ui.notify(
@@ -274,43 +280,53 @@ async def process_audio_generation(
             continue
 
         file_name = f"{project_name}_{current_index:03d}.wav"
-        file_path = os.path.join(project_path, file_name)
-        voice_path = os.path.join(DEFAULT_VOICE_LIBRARY, line.voice)
+        jobs.append((line, file_name))
+        current_index += 1
 
-        try:
+    # Lines are generated concurrently, so that the T3 scheduler can batch their decoding
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_LINES)
+
+    async def generate_line(line: acl.LineData, file_name: str):
+        async with semaphore:
             # Call the wrapper function with values from UI
-            generation_params = await run.io_bound(
+            return await run.io_bound(
                 acl.generate_and_save_audio,
                 text=line.text,
-                voice_path=voice_path,
-                output_path=file_path,
+                voice_path=os.path.join(DEFAULT_VOICE_LIBRARY, line.voice),
+                output_path=os.path.join(project_path, file_name),
                 language=language,
                 controls=control_values,
             )
 
-            line.file_name = file_name
-
-            entry = {
-                "file_name": file_name,
-                "speaker": line.speaker,
-                "text": line.text,
-                "voice": line.voice,
-                "pause": line.pause,
-                "params": generation_params,
-            }
-            new_entries.append(entry)
-            current_index += 1
+    results = await asyncio.gather(
+        *(generate_line(line, file_name) for line, file_name in jobs), return_exceptions=True
+    )
 
-            ui.notify(
-                f"✅ Generated: {line.text[:20]}...",
-                type="positive",
-                position="bottom-right",
-            )
-        except Exception as e:
+    for (line, file_name), generation_params in zip(jobs, results):
+        if isinstance(generation_params, Exception):
+            e = generation_params
             ui.notify(f"Error on line '{line.text[:10]}...': {str(e)}", type="negative")
             print(f"Gen Error: {e}")
             continue
 
+        line.file_name = file_name
+
+        entry = {
+            "file_name": file_name,
+            "speaker": line.speaker,
+            "text": line.text,
+            "voice": line.voice,
+            "pause": line.pause,
+            "params": generation_params,
+        }
+        new_entries.append(entry)
+
+        ui.notify(
+            f"✅ Generated: {line.text[:20]}...",
+            type="positive",
+            position="bottom-right",
+        )
+
     if new_entries:
         metadata_list.extend(new_entries)
         with open(metadata_path, "w", encoding="utf-8") as f:
@@ -414,7 +430,7 @@ def confirm_delete_project(project_select: ui.select, lines_list_container: ui.c
     dialog.open()
 
 
-def detect_speakers(
+async def detect_speakers(
     textarea_ref: ui.textarea,
     speaker_list_container: ui.column,
     results_container: ui.column,
@@ -433,15 +449,22 @@ def detect_speakers(
 
     if new_speakers:
         results_container.set_visibility(True)
+        speaker_selects = {}
         with speaker_list_container:
-            for speaker in new_speakers:
-                speaker_row(
+            for speaker in sorted(new_speakers):
+                speaker_selects[speaker] = speaker_row(
                     speaker_name=speaker,
                     list_container=speaker_list_container,
                     single_voice_select=single_voice_select,
                     results_container=results_container,
                 )
         single_voice_select.disable()
+
+        # Distinct library voices for the speakers, other than the single voice (eg the narrator)
+        voices = await auto_assign_voices(list(speaker_selects), [single_voice_select.value])
+        for speaker, voice in voices.items():
+            if voice in speaker_selects[speaker].options:
+                speaker_selects[speaker].value = voice
     else:
         results_container.set_visibility(False)
         single_voice_select.enable()
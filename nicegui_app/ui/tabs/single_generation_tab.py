@@ -46,6 +46,7 @@ async def handle_generation_logic(
         top_p_val = controls_dict["top_p"].value
         min_p_val= controls_dict["min_p"].value
         rep_penalty_val = controls_dict["repetition_penalty"].value
+        quality_val = controls_dict["quality"].value
     except KeyError as e:
         ui.notify(f"Missing control {e}", type="negative")
         return
@@ -64,7 +65,8 @@ async def handle_generation_logic(
             cfg_input=cfg_val,
             repetition_penalty_input=rep_penalty_val,
             min_p_input=min_p_val,
-            top_p_input=top_p_val
+            top_p_input=top_p_val,
+            quality_input=quality_val,
         )
 
         byte_io = io.BytesIO()